@@ -0,0 +1,106 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django_redis import get_redis_connection
+
+from image.models import Comment, Image
+from user.models import CustomUser
+
+
+class ActionFeed:
+    """
+    Ленты уведомлений, собранные при записи (fan-out on write).
+    Для каждого получателя в Redis хранится sorted set id действий,
+    score - время создания действия. Длина ленты ограничена ACTION_FEED_MAX_LENGTH.
+    """
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
+        self.max_length = settings.ACTION_FEED_MAX_LENGTH
+
+    def get_key(self, user_id):
+        return f"feed:{user_id}"
+
+    def push(self, action, recipient_ids):
+        """Добавляет действие в ленты получателей"""
+        self.push_many((action, recipient_id) for recipient_id in recipient_ids)
+
+    def push_many(self, items):
+        """Добавляет пары (действие, получатель) одним pipeline"""
+        keys = set()
+        with self.redis.pipeline(transaction=False) as pipe:
+            for action, recipient_id in items:
+                # Свои действия в ленту не попадают
+                if recipient_id == action.user_id:
+                    continue
+                key = self.get_key(recipient_id)
+                pipe.zadd(key, {action.id: action.created.timestamp()})
+                keys.add(key)
+            for key in keys:
+                pipe.zremrangebyrank(key, 0, -self.max_length - 1)
+            pipe.execute()
+
+    def get_ids(self, user_id):
+        """Id действий из ленты пользователя, новые первыми"""
+        return [int(action_id) for action_id in
+                self.redis.zrevrange(self.get_key(user_id), 0, self.max_length - 1)]
+
+    def clear(self):
+        """Удаляет все ленты"""
+        for key in self.redis.scan_iter(match=self.get_key('*'), count=1000):
+            self.redis.delete(key)
+
+
+def get_recipient_id(action):
+    """Владелец объекта, над которым совершено действие; свои объекты и посты не в счет"""
+    if action.verb == 'posted':
+        return None
+    target = action.target
+    recipient_id = None
+    if isinstance(target, CustomUser):
+        recipient_id = target.id
+    elif isinstance(target, Image):
+        recipient_id = target.owner_id
+    elif isinstance(target, Comment):
+        recipient_id = target.image.owner_id
+    return recipient_id if recipient_id != action.user_id else None
+
+
+def get_recipient_ids(actions):
+    """
+    {id действия: id получателя} для пачки уже сохраненных действий,
+    владельцы целевых объектов загружаются одним запросом на тип
+    """
+    user_ct = ContentType.objects.get_for_model(CustomUser)
+    image_ct = ContentType.objects.get_for_model(Image)
+    comment_ct = ContentType.objects.get_for_model(Comment)
+
+    target_ids = defaultdict(set)
+    for action in actions:
+        target_ids[action.target_ct_id].add(action.target_id)
+    owners = {
+        user_ct.id: {target_id: target_id for target_id in target_ids[user_ct.id]},
+        image_ct.id: dict(Image.objects.filter(id__in=target_ids[image_ct.id]).values_list('id', 'owner_id')),
+        comment_ct.id: dict(Comment.objects.filter(id__in=target_ids[comment_ct.id])
+                            .values_list('id', 'image__owner_id')),
+    }
+
+    recipient_ids = {}
+    for action in actions:
+        recipient_id = owners.get(action.target_ct_id, {}).get(action.target_id)
+        if action.verb != 'posted' and recipient_id not in (None, action.user_id):
+            recipient_ids[action.id] = recipient_id
+    return recipient_ids
+
+
+def push_to_feeds(action):
+    """Раскладывает новое действие по лентам получателей"""
+    if action.verb == 'posted':
+        # Подписчиков может быть много - раздаем в фоне
+        from .tasks import fan_out_action
+        fan_out_action.delay(action.id)
+        return
+
+    if action.recipient_id:
+        ActionFeed().push(action, [action.recipient_id])
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from action.feed import get_recipient_ids
+from action.models import Action
+
+
+class Command(BaseCommand):
+    help = 'Заполняет получателя у действий, записанных до появления поля recipient'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help='Пауза между пачками в секундах')
+
+    def handle(self, *args, **options):
+        total = 0
+        last_id = 0
+        while True:
+            actions = list(Action.objects.filter(id__gt=last_id, recipient__isnull=True)
+                           .exclude(verb='posted').order_by('id')
+                           .only('id', 'user_id', 'verb', 'target_ct_id', 'target_id')[:options['batch_size']])
+            if not actions:
+                break
+
+            recipient_ids = get_recipient_ids(actions)
+            for action in actions:
+                action.recipient_id = recipient_ids.get(action.id)
+            Action.objects.bulk_update([action for action in actions if action.recipient_id], ['recipient'])
+
+            last_id = actions[-1].id
+            total += len(recipient_ids)
+            self.stdout.write(f'Заполнено: {total}')
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS(f'Готово, действий с получателем: {total}'))
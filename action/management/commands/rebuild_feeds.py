@@ -0,0 +1,50 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+from user.models import Follow
+from action.feed import ActionFeed
+from action.models import Action
+
+
+class Command(BaseCommand):
+    help = 'Заново собирает ленты уведомлений в Redis из таблицы Action'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--keep', action='store_true',
+                            help='Не удалять существующие ленты перед сборкой')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        feed = ActionFeed()
+        if not options['keep']:
+            feed.clear()
+
+        total = 0
+        last_id = 0
+        while True:
+            actions = list(Action.objects.filter(id__gt=last_id).order_by('id')[:batch_size])
+            if not actions:
+                break
+            feed.push_many(self.get_deliveries(actions))
+            last_id = actions[-1].id
+            total += len(actions)
+            self.stdout.write(f'Обработано действий: {total}')
+
+        self.stdout.write(self.style.SUCCESS(f'Ленты собраны, действий: {total}'))
+
+    def get_deliveries(self, actions):
+        """Пары (действие, получатель) для пачки действий"""
+        authors = {action.user_id for action in actions if action.verb == 'posted'}
+        followers = defaultdict(list)
+        for user_from_id, user_to_id in Follow.objects.filter(user_to_id__in=authors) \
+                .values_list('user_from_id', 'user_to_id'):
+            followers[user_to_id].append(user_from_id)
+
+        for action in actions:
+            if action.verb == 'posted':
+                for follower_id in followers[action.user_id]:
+                    yield action, follower_id
+            elif action.recipient_id:
+                yield action, action.recipient_id
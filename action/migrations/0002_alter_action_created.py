@@ -0,0 +1,19 @@
+# Generated by Django 4.2.17 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('action', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='action',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
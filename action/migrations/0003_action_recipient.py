@@ -0,0 +1,25 @@
+# Generated by Django 4.2.17 on 2026-10-18 12:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('action', '0002_alter_action_created'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='action',
+            name='recipient',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='action',
+            index=models.Index(fields=['recipient', '-created'], name='action_recipient_created_idx'),
+        ),
+    ]
@@ -1,20 +1,25 @@
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 
 class Action(models.Model):
      user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='actions', on_delete=models.CASCADE)
      verb = models.CharField(max_length=255)
-     created = models.DateTimeField(auto_now_add=True)
+     created = models.DateTimeField(default=timezone.now)
      target_ct = models.ForeignKey(ContentType, blank=True, null=True,
                                    related_name='target_obj', on_delete=models.CASCADE)
      target_id = models.PositiveIntegerField(null=True, blank=True)
      target = GenericForeignKey('target_ct', 'target_id')
+     # Владелец целевого объекта - кому адресовано уведомление (для 'posted' не заполняется)
+     recipient = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='notifications',
+                                   null=True, blank=True, on_delete=models.CASCADE)
 
      class Meta:
          indexes = [
              models.Index(fields=['-created']),
              models.Index(fields=['target_ct', 'target_id']),
+             models.Index(fields=['recipient', '-created'], name='action_recipient_created_idx'),
          ]
          ordering = ['-created']
\ No newline at end of file
@@ -0,0 +1,73 @@
+import gzip
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Action
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FIELDS = ('id', 'user_id', 'verb', 'created', 'target_ct_id', 'target_id')
+
+
+def archive_rows(rows, archive_dir):
+    """
+    Дописывает строки в сжатые JSONL-файлы по дате создания: archive_dir/ГГГГ-ММ-ДД.jsonl.gz.
+    gzip допускает дописывание новыми блоками, поэтому файл дня можно пополнять несколько раз
+    """
+    rows_by_date = defaultdict(list)
+    for row in rows:
+        rows_by_date[row['created'].date().isoformat()].append(row)
+
+    os.makedirs(archive_dir, exist_ok=True)
+    for day, day_rows in rows_by_date.items():
+        with gzip.open(os.path.join(archive_dir, f'{day}.jsonl.gz'), 'at', encoding='utf-8') as file:
+            for row in day_rows:
+                file.write(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def purge_actions(before, batch_size=5000, pause=0.1, archive_dir=None):
+    """
+    Удаляет действия, созданные раньше before, диапазонами id по batch_size
+    с паузой между пачками, чтобы не держать блокировку таблицы долго.
+    Если задан archive_dir, строки перед удалением архивируются.
+    Возвращает (удалено строк, затрачено секунд)
+    """
+    expired = Action.objects.filter(created__lt=before).order_by()
+    expired_ids = expired.order_by('id').values_list('id', flat=True)
+
+    deleted = 0
+    last_id = 0
+    started = time.monotonic()
+    while True:
+        # Граница пачки находится по индексу, сами id не загружаются
+        end = list(expired_ids.filter(id__gt=last_id)[batch_size - 1:batch_size])
+        batch = expired.filter(id__gt=last_id)
+        if end:
+            batch = batch.filter(id__lte=end[0])
+
+        if archive_dir:
+            rows = list(batch.order_by('id').values(*ARCHIVE_FIELDS))
+            if rows:
+                archive_rows(rows, archive_dir)
+                # Удаляем ровно то, что попало в архив
+                batch = expired.filter(id__gte=rows[0]['id'], id__lte=rows[-1]['id'])
+
+        # У Action нет зависимых объектов и сигналов - это один DELETE без сборщика каскадов
+        count, _ = batch.delete()
+        deleted += count
+        if count:
+            elapsed = time.monotonic() - started
+            logger.info(f'Удалено действий: {deleted}, {deleted / max(elapsed, 1e-6):.0f} строк/с')
+
+        if not end:
+            return deleted, time.monotonic() - started
+        last_id = end[0]
+        if pause:
+            time.sleep(pause)
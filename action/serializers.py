@@ -1,8 +1,65 @@
+from collections import defaultdict
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
 from rest_framework import serializers
 from image.models import Image, Comment
+from image.relations import get_relations
 from image.serializers import ImageSerializer, CommentSerializer
 from .models import Action
 from user.common_serializers import CustomUserSerializer
+from user.models import CustomUser
+
+
+def get_target_querysets():
+    """Запросы для целей действий с учетом того, что нужно их сериализаторам"""
+    return {
+        Image: Image.objects.select_related('owner', 'category').prefetch_related('tags'),
+        Comment: Comment.objects.select_related('image', 'owner'),
+        CustomUser: CustomUser.objects.all(),
+    }
+
+
+def prefetch_targets(actions):
+    """
+    Загружает цели действий одним запросом на тип объекта и кладет их в кеш GenericForeignKey,
+    чтобы action.target не делал запрос для каждого действия
+    """
+    ids_by_ct = defaultdict(set)
+    for action in actions:
+        if action.target_ct_id and action.target_id:
+            ids_by_ct[action.target_ct_id].add(action.target_id)
+
+    querysets = get_target_querysets()
+    targets = {}
+    for ct_id, target_ids in ids_by_ct.items():
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        if model is None:
+            continue
+        queryset = querysets.get(model, model._default_manager.all())
+        for target_id, target in queryset.in_bulk(target_ids).items():
+            targets[ct_id, target_id] = target
+
+    target_field = Action._meta.get_field('target')
+    for action in actions:
+        target = targets.get((action.target_ct_id, action.target_id))
+        # Удаленная цель не загружается повторно при обращении к action.target
+        action._target_missing = target is None
+        target_field.set_cached_value(action, target)
+
+
+class ActionListSerializer(serializers.ListSerializer):
+    """Подгружает цели всех действий страницы перед сериализацией"""
+
+    def to_representation(self, data):
+        actions = list(data.all() if isinstance(data, models.Manager) else data)
+        prefetch_targets(actions)
+
+        request = self.context.get('request')
+        if request:
+            get_relations(request).prime_images([action.target.id for action in actions
+                                                 if not action._target_missing
+                                                 and isinstance(action.target, Image)])
+        return super().to_representation(actions)
 
 
 class ActionSerializer(serializers.ModelSerializer):
@@ -11,11 +68,12 @@ class ActionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Action
         exclude = ['target_id', 'target_ct']
+        list_serializer_class = ActionListSerializer
 
     def get_target_object(self, obj):
         """Возвращает имя и полный URL целевого объекта"""
         request = self.context.get('request')  # Получаем объект request
-        if not obj.target:
+        if getattr(obj, '_target_missing', False) or not obj.target:
             return None
 
         if isinstance(obj.target, Image):
@@ -39,4 +97,4 @@ class ActionSerializer(serializers.ModelSerializer):
         if representation.get('target_object') is None:
             del representation['target_object']
 
-        return representation
\ No newline at end of file
+        return representation
@@ -3,15 +3,47 @@ import logging
 from celery.exceptions import MaxRetriesExceededError
 from django.conf import settings
 from celery import shared_task, signals
+from user.models import Follow
+from .feed import ActionFeed
 from .models import Action
-from datetime import timedelta
+from .retention import purge_actions
+from .utils import ActionBuffer
 from django.utils.timezone import now
 
 logger = logging.getLogger(__name__)
 
 @shared_task
 def delete_old_action():
-    """Удаляет старые действия"""
-    one_week_ago = now() - timedelta(weeks=1)
-    deleted_count, _ = Action.objects.filter(created__lt=one_week_ago).delete()
-    return (f"Удалено {deleted_count} старых действий")
+    """Удаляет старые действия пачками, при ACTION_ARCHIVE_DIR предварительно архивирует их"""
+    deleted_count, elapsed = purge_actions(now() - settings.ACTION_RETENTION,
+                                           batch_size=settings.ACTION_RETENTION_BATCH_SIZE,
+                                           pause=settings.ACTION_RETENTION_PAUSE,
+                                           archive_dir=settings.ACTION_ARCHIVE_DIR)
+    return (f"Удалено {deleted_count} старых действий за {elapsed:.1f} с, "
+            f"{deleted_count / max(elapsed, 1e-6):.0f} строк/с")
+
+
+@shared_task
+def flush_actions():
+    """Записывает накопленные действия в БД одной вставкой на пачку"""
+    flushed = ActionBuffer().flush(settings.ACTION_FLUSH_BATCH_SIZE)
+    return f"Записано действий: {flushed}"
+
+
+@shared_task
+def fan_out_action(action_id, chunk_size=1000):
+    """Добавляет пост в ленты всех подписчиков автора"""
+    action = Action.objects.get(id=action_id)
+    feed = ActionFeed()
+    follower_ids = Follow.objects.filter(user_to_id=action.user_id) \
+        .values_list('user_from_id', flat=True)
+
+    chunk = []
+    for follower_id in follower_ids.iterator(chunk_size=chunk_size):
+        chunk.append(follower_id)
+        if len(chunk) >= chunk_size:
+            feed.push(action, chunk)
+            chunk = []
+    if chunk:
+        feed.push(action, chunk)
+    return f"Действие {action_id} разослано подписчикам"
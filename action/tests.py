@@ -1,3 +1,108 @@
+import gzip
+import json
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from image.models import Category, Comment, Image
+from user.models import CustomUser
+from .models import Action
+from .retention import purge_actions
+
+
+@mock.patch('action.views.ActionFeed.get_ids', return_value=[])
+@mock.patch('image.relations.LikeStore.liked_image_ids', return_value=set())
+@mock.patch('image.relations.FavoriteSessionManager.get_favorites', return_value=set())
+class ActionFeedQueriesTest(APITestCase):
+    """Количество запросов ленты не должно зависеть от количества действий на странице"""
+
+    def setUp(self):
+        self.owner = CustomUser.objects.create_user(username='owner', email='owner@example.com', password='pass')
+        self.category = Category.objects.create(name='nature')
+        self.client.force_authenticate(self.owner)
+
+    def add_actions(self, count):
+        for _ in range(count):
+            number = CustomUser.objects.count()
+            actor = CustomUser.objects.create_user(username=f'actor{number}', email=f'actor{number}@example.com',
+                                                   password='pass')
+            image = Image.objects.create(category=self.category, owner=self.owner,
+                                         title=f'image {number}', image='images/test.jpg')
+            image.tags.add('sky', 'tree')
+            comment = Comment.objects.create(image=image, owner=actor, text='nice')
+
+            Action.objects.create(user=actor, verb='liked', target=image, recipient=self.owner)
+            Action.objects.create(user=actor, verb='commented', target=comment, recipient=self.owner)
+            Action.objects.create(user=actor, verb='followed', target=self.owner, recipient=self.owner)
+
+    def get_feed_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('action'), {'limit': 100})
+        self.assertEqual(response.status_code, 200)
+        return len(queries), len(response.data['results'])
+
+    def test_query_count_does_not_grow_with_page_size(self, *mocks):
+        self.add_actions(2)
+        small_queries, small_count = self.get_feed_queries()
+
+        self.add_actions(6)
+        large_queries, large_count = self.get_feed_queries()
+
+        self.assertEqual(small_count, 6)
+        self.assertEqual(large_count, 24)
+        self.assertEqual(small_queries, large_queries)
+
+    def test_targets_are_serialized(self, *mocks):
+        self.add_actions(1)
+        response = self.client.get(reverse('action'))
+
+        verbs = {action['verb']: action for action in response.data['results']}
+        self.assertCountEqual(verbs['liked']['target_object']['tags'], ['sky', 'tree'])
+        self.assertIn('text', verbs['commented']['target_object'])
+        self.assertNotIn('target_object', verbs['followed'])
+
+
+class PurgeActionsTest(TestCase):
+    """Удаление устаревших действий пачками по диапазонам id"""
+
+    def setUp(self):
+        user = CustomUser.objects.create_user(username='user', email='user@example.com', password='pass')
+        self.now = timezone.now()
+        # Старые и новые действия вперемешку, чтобы диапазоны id содержали и те, и другие
+        Action.objects.bulk_create([
+            Action(user=user, verb='posted', created=self.now - timedelta(days=100 if number % 3 else 1))
+            for number in range(25)
+        ])
+        self.fresh_ids = set(Action.objects.filter(created__gte=self.now - timedelta(days=10))
+                             .values_list('id', flat=True))
+
+    def test_deletes_only_expired_in_batches(self):
+        with CaptureQueriesContext(connection) as queries:
+            deleted, _ = purge_actions(self.now - timedelta(days=10), batch_size=4, pause=0)
+
+        self.assertEqual(deleted, 25 - len(self.fresh_ids))
+        self.assertEqual(set(Action.objects.values_list('id', flat=True)), self.fresh_ids)
+        # 16 устаревших действий - четыре пачки по batch_size и последний DELETE для остатка
+        statements = [query['sql'] for query in queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(statements), 5)
+
+    def test_archive_matches_deleted_rows(self):
+        with tempfile.TemporaryDirectory() as archive_dir:
+            deleted, _ = purge_actions(self.now - timedelta(days=10), batch_size=4, pause=0,
+                                       archive_dir=archive_dir)
+            rows = []
+            for name in os.listdir(archive_dir):
+                with gzip.open(os.path.join(archive_dir, name), 'rt', encoding='utf-8') as file:
+                    rows += [json.loads(line) for line in file]
 
-# Create your tests here.
+        self.assertEqual(len(rows), deleted)
+        self.assertEqual(len({row['id'] for row in rows}), deleted)
+        self.assertFalse({row['id'] for row in rows} & self.fresh_ids)
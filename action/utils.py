@@ -1,19 +1,94 @@
-import datetime
-from django.utils import timezone
+import json
+from django.conf import settings
+from django.core.cache import cache
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django_redis import get_redis_connection
+from user.models import CustomUser
+from .feed import get_recipient_id, push_to_feeds
 from .models import Action
 
-def create_action(user, verb, target=None):
-    now = timezone.now()
-    last_minute = now - datetime.timedelta(seconds=60)
-    similar_actions = Action.objects.filter(user_id = user.id, verb=verb, created__gte=last_minute)
 
-    if target:
-        target_ct = ContentType.objects.get_for_model(target)
-        similar_actions = similar_actions.filter(target_ct = target_ct, target_id = target.id)
+class ActionBuffer:
+    """
+    Буфер новых действий в Redis list.
+    Действия записываются в БД пачкой задачей flush_actions, а не отдельным INSERT в запросе.
+    """
+    key = 'actions:pending'
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
+
+    def push(self, action):
+        return self.redis.rpush(self.key, json.dumps({
+            'user_id': action.user_id,
+            'verb': action.verb,
+            'target_ct_id': action.target_ct_id,
+            'target_id': action.target_id,
+            'recipient_id': action.recipient_id,
+            'created': action.created.isoformat(),
+        }))
+
+    def push_back(self, items):
+        """Возвращает незаписанные действия в начало буфера"""
+        if items:
+            self.redis.lpush(self.key, *[json.dumps(item) for item in reversed(items)])
+
+    def pop(self, count):
+        # LPOP с количеством есть только в Redis 6.2+, LRANGE + LTRIM в транзакции работает везде
+        with self.redis.pipeline() as pipe:
+            pipe.lrange(self.key, 0, count - 1)
+            pipe.ltrim(self.key, count, -1)
+            items, _ = pipe.execute()
+        return [json.loads(item) for item in items]
+
+    def flush(self, batch_size=1000):
+        """Записывает накопленные действия в БД и раскладывает их по лентам"""
+        flushed = 0
+        while True:
+            items = self.pop(batch_size)
+            if not items:
+                return flushed
+            try:
+                # Пользователь мог быть удален, пока действие ждало записи
+                user_ids = set(CustomUser.objects.filter(id__in={item['user_id'] for item in items})
+                               .values_list('id', flat=True))
+                actions = Action.objects.bulk_create([
+                    Action(user_id=item['user_id'], verb=item['verb'],
+                           target_ct_id=item['target_ct_id'], target_id=item['target_id'],
+                           recipient_id=item.get('recipient_id'), created=parse_datetime(item['created']))
+                    for item in items if item['user_id'] in user_ids
+                ])
+            except Exception:
+                self.push_back(items)
+                raise
+            for action in actions:
+                push_to_feeds(action)
+            flushed += len(actions)
+
+
+def get_dedup_key(user, verb, target):
+    if target is None:
+        return f'action:{user.id}:{verb}'
+    target_ct = ContentType.objects.get_for_model(target)
+    return f'action:{user.id}:{verb}:{target_ct.id}:{target.id}'
+
+
+def create_action(user, verb, target=None):
+    """
+    Записывает действие, если такого же не было за последние ACTION_DEDUP_SECONDS.
+    Проверка идет по ключу с истечением в кеше, само действие попадает в ActionBuffer
+    (или сразу в БД при ACTION_LOG_SYNC)
+    """
+    if not cache.add(get_dedup_key(user, verb, target), 1, timeout=settings.ACTION_DEDUP_SECONDS):
+        return False
 
-    if not similar_actions:
-        action = Action(user=user, verb=verb, target=target)
+    action = Action(user=user, verb=verb, target=target, created=timezone.now())
+    action.recipient_id = get_recipient_id(action)
+    if settings.ACTION_LOG_SYNC:
         action.save()
-        return True
-    return False
+        push_to_feeds(action)
+    else:
+        ActionBuffer().push(action)
+    return True
@@ -4,8 +4,9 @@ from rest_framework.generics import ListAPIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.filters import SearchFilter, OrderingFilter
 from django_filters.rest_framework import DjangoFilterBackend
-from image.models import Comment, Image
-from user.models import CustomUser
+from image.models import Image
+from pinterest.pagination import KeysetPagination
+from .feed import ActionFeed
 from .filters import ActionFilter
 from .serializers import ActionSerializer
 from .models import Action
@@ -18,54 +19,29 @@ class ActionView(ListAPIView):
     filterset_class = ActionFilter
     search_fields = ['user__username', 'verb']
     ordering_fields = ['created']
+    pagination_class = KeysetPagination
+    cursor_ordering = '-created'
 
     def get_queryset(self):
-        # Исключаем действия, совершённые самим пользователем
-        queryset = Action.objects.exclude(user=self.request.user)
-
-        # Получаем ContentType для моделей
-        user_ct = ContentType.objects.get_for_model(CustomUser)
+        # Лента уже собрана при записи - достаточно достать действия по id
+        action_ids = ActionFeed().get_ids(self.request.user.id)
+        if action_ids:
+            return Action.objects.filter(id__in=action_ids).select_related('user')
+        return self.get_queryset_from_db().select_related('user')
+
+    def get_queryset_from_db(self):
+        """Собирает ленту запросом к Action, если в Redis ее нет"""
         image_ct = ContentType.objects.get_for_model(Image)
-        comment_ct = ContentType.objects.get_for_model(Comment)
-
-        # 1. Действия "followed": когда кто-то подписался на текущего пользователя
-        q_follow = Q(
-            target_ct=user_ct,
-            target_id=self.request.user.id,
-            verb__iexact='followed'
-        )
 
-        # 2. Действия "commented": оставленные комментарии,
-        # при этом комментарий должен принадлежать изображению, чей владелец — текущий пользователь
-        comment_ids = Comment.objects.filter(image__owner=self.request.user) \
-            .values_list('id', flat=True)
-        q_comment = Q(
-            target_ct=comment_ct,
-            target_id__in=list(comment_ids),
-            verb__iexact='commented'
-        )
+        # 1. Подписки, лайки и комментарии, адресованные текущему пользователю -
+        # получатель записан в действии, это диапазон по индексу (recipient, -created)
+        q_recipient = Q(recipient=self.request.user)
 
-        # 3. Действия "liked": лайки под изображениями, принадлежащими текущему пользователю
-        image_ids = Image.objects.filter(owner=self.request.user) \
-            .values_list('id', flat=True)
-        q_like = Q(
-            target_ct=image_ct,
-            target_id__in=list(image_ids),
-            verb__iexact='liked'
-        )
-
-        # 4. Действия "posted": когда followings выкладывают фото.
-        # То есть, если пользователь, совершающий действие, входит в число пользователей на кого подписан
-        # текущий пользователь,
-        # а действие имеет verb "posted" и target — изображение
-        following_ids = self.request.user.followings.values_list('id', flat=True)
+        # 2. Действия "posted": когда followings выкладывают фото
         q_post = Q(
-            user_id__in=list(following_ids),
-            verb__iexact='posted',
+            user_id__in=self.request.user.followings.values('id'),
+            verb='posted',
             target_ct=image_ct
         )
 
-        # Объединяем все условия через OR
-        queryset = queryset.filter(q_follow | q_comment | q_like | q_post)
-
-        return queryset
+        return Action.objects.filter(q_recipient | q_post).exclude(user=self.request.user)
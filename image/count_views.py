@@ -1,24 +1,83 @@
-from django.core.cache import cache
+from django.db.models import F
+from django_redis import get_redis_connection
 
-from image.admin import ImageAdmin
 from image.models import Image
+from image.search import SearchIndex
+from image.trending import TrendingIndex
+from user.stats import change_owner_stats
+
+
+# Вычитает перенесенный в БД прирост и удаляет обнулившийся ключ одной атомарной операцией
+DECR_OR_DELETE = """
+local value = redis.call('DECRBY', KEYS[1], ARGV[1])
+if value <= 0 then
+    redis.call('DEL', KEYS[1])
+end
+return value
+"""
 
 
 class CountViewsImage:
+    """
+    Счетчик просмотров изображений.
+    В Redis копится только прирост с последней синхронизации,
+    текущее значение = Image.views + прирост.
+    """
+    key_pattern = "image:*:views:pending"
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
 
     def get_cache_key(self, image_id):
-        return f"image:{image_id}:views"
-
-    def incr(self, image_id):
-        cache_key = self.get_cache_key(image_id)
-        if not cache.get(cache_key):
-            image = Image.objects.get(id=image_id)
-            cache.set(cache_key, image.views)
-        return cache.incr(cache_key)
-
-    def get(self, image_id):
-        cache_key = self.get_cache_key(image_id)
-        if not cache.get(cache_key):
-            image = Image.objects.get(id=image_id)
-            cache.set(cache_key, image.views)
-        return cache.get(cache_key)
+        return f"image:{image_id}:views:pending"
+
+    def incr(self, image_id, base=0):
+        """Увеличивает счетчик за один атомарный запрос к Redis"""
+        return base + self.redis.incr(self.get_cache_key(image_id))
+
+    def get(self, image_id, base=None):
+        """Количество просмотров; base - значение Image.views, если оно уже загружено"""
+        if base is None:
+            base = Image.objects.filter(id=image_id).values_list('views', flat=True).first() or 0
+        pending = self.redis.get(self.get_cache_key(image_id))
+        return base + int(pending or 0)
+
+    def sync_to_db(self, chunk_size=500):
+        """
+        Переносит накопленные приросты в БД пачками.
+        Ключи обходятся через SCAN, в БД обновляется только колонка views.
+        """
+        synced = 0
+        keys = []
+        for key in self.redis.scan_iter(match=self.key_pattern, count=chunk_size):
+            keys.append(key)
+            if len(keys) >= chunk_size:
+                synced += self._flush(keys)
+                keys = []
+        if keys:
+            synced += self._flush(keys)
+        return synced
+
+    def _flush(self, keys):
+        deltas = {}
+        for key, value in zip(keys, self.redis.mget(keys)):
+            if value is not None and int(value) > 0:
+                image_id = int(key.split(b':')[1])
+                deltas[key] = (image_id, int(value))
+        if not deltas:
+            return 0
+
+        images = [Image(id=image_id, views=F('views') + delta)
+                  for image_id, delta in deltas.values()]
+        Image.objects.bulk_update(images, ['views'])
+        TrendingIndex().record_many(dict(deltas.values()), 'view')
+        SearchIndex().update_popularity(image_id for image_id, _ in deltas.values())
+        change_owner_stats('total_views', dict(deltas.values()))
+
+        # Вычитаем только перенесенное - просмотры, пришедшие во время синхронизации, сохранятся
+        decr_or_delete = self.redis.register_script(DECR_OR_DELETE)
+        with self.redis.pipeline(transaction=False) as pipe:
+            for key, (_, delta) in deltas.items():
+                decr_or_delete(keys=[key], args=[delta], client=pipe)
+            pipe.execute()
+        return len(deltas)
@@ -0,0 +1,197 @@
+import itertools
+import threading
+import time
+from array import array
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from PIL import Image as PiLImage
+
+from image.models import Image
+
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# Версия хешей: увеличивается, когда хеши пишутся не только для новых изображений
+VERSION_KEY = 'duplicates:version'
+
+_index = None
+_loader = None
+_index_lock = threading.Lock()
+
+
+def dhash(file):
+    """
+    Перцептивный dHash: 64 бита - сравнение яркости соседних пикселей изображения 9x8.
+    Возвращается знаковое число, чтобы поместиться в BigIntegerField.
+    """
+    image = PiLImage.open(file)
+    image.draft('L', (64, 64))
+    image = image.convert('L').resize((9, 8), PiLImage.LANCZOS)
+    pixels = list(image.getdata())
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = value << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return to_signed(value)
+
+
+def to_signed(value):
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def to_unsigned(value):
+    return value & ((1 << HASH_BITS) - 1)
+
+
+def get_version():
+    return cache.get(VERSION_KEY, 0)
+
+
+def bump_version():
+    """Вызывается после записи хешей существующих изображений - индексы процессов перезагрузятся"""
+    cache.add(VERSION_KEY, 0, timeout=None)
+    cache.incr(VERSION_KEY)
+
+
+class HammingIndex:
+    """
+    Индекс хешей для поиска по расстоянию Хэмминга (multi-index hashing).
+    Хеш делится на 4 части по 16 бит, для каждой части - словарь значение -> позиции.
+    Если расстояние <= d, хотя бы одна часть отличается не больше чем на d // 4 бит,
+    поэтому достаточно проверить корзины с такими отличиями.
+
+    Между полными загрузками догружаются только изображения с id больше загруженных.
+    Хеши старых изображений (compute_phashes) меняют версию, и индекс загружается заново.
+    """
+
+    def __init__(self):
+        self.ids = array('q')
+        self.hashes = array('Q')
+        self.tables = [defaultdict(list) for _ in range(CHUNKS)]
+        self.max_id = 0
+        self.version = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self):
+        """Полная загрузка; версия читается до хешей, чтобы запись во время загрузки не потерялась"""
+        self.version = get_version()
+        self.loaded_at = time.monotonic()
+        self.refresh()
+
+    def is_stale(self):
+        """Хеши старых изображений изменились или индекс давно не загружался целиком"""
+        return (self.version != get_version()
+                or time.monotonic() - self.loaded_at > settings.DUPLICATE_INDEX_RELOAD_INTERVAL)
+
+    def refresh(self):
+        """Догружает из БД хеши изображений, добавленных после последней загрузки"""
+        with self.lock:
+            rows = Image.objects.filter(id__gt=self.max_id, phash__isnull=False) \
+                .order_by('id').values_list('id', 'phash')
+            for image_id, phash in rows.iterator(chunk_size=10000):
+                self._add(image_id, phash)
+
+    def _add(self, image_id, phash):
+        value = to_unsigned(phash)
+        position = len(self.ids)
+        self.ids.append(image_id)
+        self.hashes.append(value)
+        for chunk, table in enumerate(self.tables):
+            table[self._chunk(value, chunk)].append(position)
+        self.max_id = image_id
+
+    def search(self, phash, max_distance):
+        """Список (расстояние, id) в пределах max_distance, ближайшие первыми"""
+        value = to_unsigned(phash)
+        radius = max_distance // CHUNKS
+        candidates = set()
+        for chunk, table in enumerate(self.tables):
+            for probe in self._probes(self._chunk(value, chunk), radius):
+                candidates.update(table.get(probe, ()))
+
+        results = []
+        for position in candidates:
+            distance = bin(self.hashes[position] ^ value).count('1')
+            if distance <= max_distance:
+                results.append((distance, self.ids[position]))
+        return sorted(results)
+
+    def _chunk(self, value, chunk):
+        return (value >> (chunk * CHUNK_BITS)) & CHUNK_MASK
+
+    def _probes(self, value, radius):
+        """Значения части, отличающиеся от value не больше чем на radius бит"""
+        yield value
+        for distance in range(1, radius + 1):
+            for bits in itertools.combinations(range(CHUNK_BITS), distance):
+                probe = value
+                for bit in bits:
+                    probe ^= 1 << bit
+                yield probe
+
+
+def get_index():
+    """
+    Индекс процесса, догруженный новыми изображениями.
+    Полная загрузка идет в фоновом потоке, пока ее нет - возвращается None
+    (прежний индекс, если он есть, работает до замены новым)
+    """
+    index = _index
+    if index is None or index.is_stale():
+        warm_up()
+    if index is not None:
+        index.refresh()
+    return index
+
+
+def warm_up():
+    """Запускает полную загрузку индекса в фоне, если она еще не идет"""
+    global _loader
+    with _index_lock:
+        if _loader is not None and _loader.is_alive():
+            return
+        _loader = threading.Thread(target=_load_index, name='duplicates-index', daemon=True)
+        _loader.start()
+
+
+def _load_index():
+    global _index
+    try:
+        index = HammingIndex()
+        index.load()
+        _index = index
+    finally:
+        # У потока свое соединение с БД
+        connection.close()
+
+
+def find_duplicate(phash, exclude_id=None):
+    """Исходное изображение для почти совпадающего хеша или None"""
+    index = get_index()
+    if index is None:
+        # Индекс еще загружается - находим хотя бы точные копии по индексу БД
+        image_ids = list(Image.objects.filter(phash=phash).exclude(id=exclude_id)
+                         .order_by('id').values_list('id', flat=True)[:10])
+    else:
+        matches = index.search(phash, settings.DUPLICATE_MAX_DISTANCE)
+        image_ids = [image_id for _, image_id in matches if image_id != exclude_id]
+    if not image_ids:
+        return None
+
+    # Удаленные изображения могли остаться в индексе - берем ближайшее существующее
+    images = Image.objects.in_bulk(image_ids)
+    for image_id in image_ids:
+        if image_id in images:
+            image = images[image_id]
+            return image.duplicate_of or image
+    return None
@@ -0,0 +1,71 @@
+import fcntl
+import os
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+
+DIM = 1792  # Размер эмбеддинга EfficientNet-B4
+
+
+class EmbeddingStore:
+    """
+    Хранилище эмбеддингов изображений в EMBEDDING_STORE_DIR.
+    Append-only файлы: ids.i8 - id изображений (int64), vectors.f2 - нормированные векторы
+    (float16, DIM чисел подряд). Пишут несколько воркеров, поэтому запись идет под flock.
+    Если изображение записано несколько раз, актуальна последняя запись.
+    Запись могла оборваться посередине, поэтому число записей - по более короткому файлу,
+    а хвосты незаконченной записи обрезаются перед следующей.
+    """
+    row_size = DIM * 2
+
+    def __init__(self, path=None):
+        self.path = str(path or settings.EMBEDDING_STORE_DIR)
+        self.ids_path = os.path.join(self.path, 'ids.i8')
+        self.vectors_path = os.path.join(self.path, 'vectors.f2')
+
+    def append(self, image_ids, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = (vectors / np.maximum(norms, 1e-12)).astype(np.float16)
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock():
+            self._truncate(len(self))
+            # Сначала векторы, потом id: id без вектора читатель не увидит
+            with open(self.vectors_path, 'ab') as file:
+                file.write(vectors.tobytes())
+            with open(self.ids_path, 'ab') as file:
+                file.write(image_ids.tobytes())
+
+    def __len__(self):
+        if not os.path.exists(self.ids_path) or not os.path.exists(self.vectors_path):
+            return 0
+        return min(os.path.getsize(self.ids_path) // 8,
+                   os.path.getsize(self.vectors_path) // self.row_size)
+
+    def read(self, start=0):
+        """id и векторы (memmap) начиная с записи start"""
+        count = len(self)
+        if count <= start:
+            return np.empty(0, dtype=np.int64), np.empty((0, DIM), dtype=np.float16)
+        ids = np.fromfile(self.ids_path, dtype=np.int64, count=count - start, offset=start * 8)
+        vectors = np.memmap(self.vectors_path, dtype=np.float16, mode='r',
+                            offset=start * self.row_size, shape=(count - start, DIM))
+        return ids, vectors
+
+    def _truncate(self, count):
+        """Обрезает оба файла до count целых записей"""
+        for path, size in ((self.ids_path, count * 8), (self.vectors_path, count * self.row_size)):
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                os.truncate(path, size)
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.path, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,93 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count
+from django_redis import get_redis_connection
+from taggit.models import Tag, TaggedItem
+
+from image.models import Category, Image
+
+
+class FacetCounts:
+    """
+    Количество изображений по тегам и категориям в Redis sorted set'ах (score - количество).
+    Счетчики меняются инкрементально при создании и удалении изображений и изменении тегов,
+    при отсутствии индекса он заполняется из БД.
+    """
+    tags_key = 'facets:tags'
+    categories_key = 'facets:categories'
+    built_key = 'facets:built'
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
+
+    def change_tags(self, tag_ids, amount):
+        self._change(self.tags_key, tag_ids, amount)
+
+    def change_category(self, category_id, amount):
+        self._change(self.categories_key, [category_id], amount)
+
+    def _change(self, key, member_ids, amount):
+        member_ids = list(member_ids)
+        if not member_ids or not self.redis.exists(self.built_key):
+            # Индекс еще не построен - его заполнит rebuild() при первом чтении
+            return
+        with self.redis.pipeline(transaction=False) as pipe:
+            for member_id in member_ids:
+                pipe.zincrby(key, amount, member_id)
+            if amount < 0:
+                pipe.zremrangebyscore(key, '-inf', 0)
+            pipe.execute()
+
+    def top(self, limit=20):
+        """Самые частые теги и категории: {'tags': [...], 'categories': [...]}"""
+        if not self.redis.exists(self.built_key):
+            self.rebuild()
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zrevrange(self.tags_key, 0, limit - 1, withscores=True)
+            pipe.zrevrange(self.categories_key, 0, limit - 1, withscores=True)
+            tags, categories = pipe.execute()
+
+        tag_counts = [(int(tag_id), int(count)) for tag_id, count in tags]
+        category_counts = [(int(category_id), int(count)) for category_id, count in categories]
+        tag_names = dict(Tag.objects.filter(id__in=[tag_id for tag_id, _ in tag_counts])
+                         .values_list('id', 'name'))
+        category_names = dict(Category.objects.filter(id__in=[category_id for category_id, _ in category_counts])
+                              .values_list('id', 'name'))
+        return {
+            'tags': [{'id': tag_id, 'name': tag_names[tag_id], 'count': count}
+                     for tag_id, count in tag_counts if tag_id in tag_names],
+            'categories': [{'id': category_id, 'name': category_names[category_id], 'count': count}
+                           for category_id, count in category_counts if category_id in category_names],
+        }
+
+    def rebuild(self):
+        """Заполняет счетчики по данным БД"""
+        image_ct = ContentType.objects.get_for_model(Image)
+        tag_counts = TaggedItem.objects.filter(content_type=image_ct).order_by() \
+            .values_list('tag_id').annotate(count=Count('id'))
+        category_counts = Image.objects.order_by() \
+            .values_list('category_id').annotate(count=Count('id'))
+
+        with self.redis.pipeline() as pipe:
+            pipe.delete(self.tags_key, self.categories_key)
+            if tag_counts:
+                pipe.zadd(self.tags_key, dict(tag_counts))
+            if category_counts:
+                pipe.zadd(self.categories_key, dict(category_counts))
+            pipe.set(self.built_key, 1)
+            pipe.execute()
+
+
+def filtered_facets(queryset, limit=20):
+    """Количество по тегам и категориям среди изображений queryset (текущие фильтры)"""
+    image_ct = ContentType.objects.get_for_model(Image)
+    image_ids = queryset.order_by().values('id')
+    tags = TaggedItem.objects.filter(content_type=image_ct, object_id__in=image_ids).order_by() \
+        .values('tag_id', 'tag__name').annotate(count=Count('id')).order_by('-count', 'tag__name')[:limit]
+    categories = Image.objects.filter(id__in=image_ids).order_by() \
+        .values('category_id', 'category__name').annotate(count=Count('id')) \
+        .order_by('-count', 'category__name')[:limit]
+    return {
+        'tags': [{'id': row['tag_id'], 'name': row['tag__name'], 'count': row['count']} for row in tags],
+        'categories': [{'id': row['category_id'], 'name': row['category__name'], 'count': row['count']}
+                       for row in categories],
+    }
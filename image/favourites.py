@@ -1,45 +1,139 @@
 from django.conf import settings
+from django.db import transaction
+from django_redis import get_redis_connection
 
 from image.models import FavoriteDatabaseManager
 
 
+class FavoriteStore:
+    """
+    Избранное авторизованных пользователей в Redis.
+    Для каждого пользователя хранится set id изображений, загруженный из БД при первом обращении
+    (маркер 0 означает, что set загружен). Пользователи с изменениями копятся в set и переносятся
+    в БД пачкой задачей flush_favorites - одна запись на пользователя, сколько бы изменений ни было.
+    """
+    dirty_key = 'favorites:dirty'
+    loaded_marker = 0
+    ttl = 24 * 60 * 60
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
+
+    def get_key(self, user_id):
+        return f'user:{user_id}:favorites'
+
+    def get(self, user_id):
+        self._ensure_loaded(user_id)
+        return {int(image_id) for image_id in self.redis.smembers(self.get_key(user_id))} - {self.loaded_marker}
+
+    def contains(self, user_id, image_id):
+        self._ensure_loaded(user_id)
+        return bool(self.redis.sismember(self.get_key(user_id), image_id))
+
+    def add(self, user_id, *image_ids):
+        self._change(user_id, 'sadd', image_ids)
+
+    def remove(self, user_id, *image_ids):
+        self._change(user_id, 'srem', image_ids)
+
+    def flush(self, batch_size=500):
+        """Переносит избранное измененных пользователей в БД"""
+        flushed = 0
+        while True:
+            user_ids = [int(user_id) for user_id in self.redis.spop(self.dirty_key, batch_size) or []]
+            if not user_ids:
+                return flushed
+
+            with self.redis.pipeline(transaction=False) as pipe:
+                for user_id in user_ids:
+                    pipe.smembers(self.get_key(user_id))
+                members = pipe.execute()
+
+            favorites = {}
+            for user_id, image_ids in zip(user_ids, members):
+                # Без маркера set истек или не загружался - записывать нечего
+                image_ids = {int(image_id) for image_id in image_ids}
+                if self.loaded_marker in image_ids:
+                    favorites[user_id] = sorted(image_ids - {self.loaded_marker})
+            try:
+                with transaction.atomic():
+                    FavoriteDatabaseManager.save_many(favorites)
+            except Exception:
+                # Записывается все избранное пользователя, поэтому повторная запись безопасна
+                self.redis.sadd(self.dirty_key, *user_ids)
+                raise
+            flushed += len(favorites)
+
+    def _change(self, user_id, command, image_ids):
+        if not image_ids:
+            return
+        self._ensure_loaded(user_id)
+        key = self.get_key(user_id)
+        with self.redis.pipeline(transaction=False) as pipe:
+            getattr(pipe, command)(key, *image_ids)
+            pipe.expire(key, self.ttl)
+            pipe.sadd(self.dirty_key, user_id)
+            pipe.execute()
+
+    def _ensure_loaded(self, user_id):
+        key = self.get_key(user_id)
+        if self.redis.exists(key):
+            return
+        image_ids = FavoriteDatabaseManager.load_from_db(user_id)
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.sadd(key, self.loaded_marker, *image_ids)
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+
+
 class FavoriteSessionManager:
+    """
+    Избранное текущего пользователя: авторизованных - в FavoriteStore,
+    анонимных - списком в сессии (в памяти - set)
+    """
 
     def __init__(self, request):
         self.session = request.session
         self.user = request.user
+        self.store = FavoriteStore() if self.user.is_authenticated else None
 
     def get_favorites(self):
-        """Получаем список избранных изображений из сессии.
-        Если в сессии нет избранных, смотрим в БД (для авторизованных пользователей)"""
-        favorites = self.session.get(settings.FAVORITE_SESSION_ID, [])
-        if not favorites:
-            if self.user.is_authenticated:
-                favorites = FavoriteDatabaseManager.load_from_db(self.user)
+        """Множество id избранных изображений"""
+        if self.store:
+            return self.store.get(self.user.id)
+        return set(self.session.get(settings.FAVORITE_SESSION_ID, []))
 
-        return favorites
+    def is_favorite(self, image_id):
+        if self.store:
+            return self.store.contains(self.user.id, image_id)
+        return image_id in self.get_favorites()
 
     def add_favorite(self, image_id):
         """Добавляем изображение в избранное"""
+        if self.store:
+            self.store.add(self.user.id, image_id)
+            return
         favorites = self.get_favorites()
         if image_id not in favorites:
-            favorites.append(image_id)
-            self.session["favorite_images"] = favorites
-            self._save()
-
-    def save_favorites(self, favorites):
-        self.session['favorite_images'] = list(favorites)
+            favorites.add(image_id)
+            self._save(favorites)
 
     def remove_favorite(self, image_id):
         """Удаляем изображение из избранного"""
+        if self.store:
+            self.store.remove(self.user.id, image_id)
+            return
         favorites = self.get_favorites()
         if image_id in favorites:
-            favorites.remove(image_id)
-            if not favorites:
-                del self.session["favorite_images"]
-            else:
-                self.session["favorite_images"] = favorites
-            self._save()
-
-    def _save(self):
-        self.session.modified = True
\ No newline at end of file
+            favorites.discard(image_id)
+            self._save(favorites)
+
+    def pop_session_favorites(self):
+        """Забирает избранное, накопленное в сессии до входа"""
+        return set(self.session.pop(settings.FAVORITE_SESSION_ID, []))
+
+    def _save(self, favorites):
+        if favorites:
+            self.session[settings.FAVORITE_SESSION_ID] = sorted(favorites)
+        else:
+            self.session.pop(settings.FAVORITE_SESSION_ID, None)
@@ -1,5 +1,13 @@
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db.models import IntegerField
+from django.db.models.expressions import RawSQL
 from django_filters import rest_framework as filters
+from rest_framework.filters import SearchFilter
+from taggit.models import TaggedItem
 from .models import Image
+from .search import SearchIndex
 
 class CharFilterInFilter(filters.BaseInFilter, filters.CharFilter):
     pass
@@ -7,8 +15,58 @@ class CharFilterInFilter(filters.BaseInFilter, filters.CharFilter):
 class ImageFilter(filters.FilterSet):
     created = filters.DateFromToRangeFilter()
     category = filters.CharFilter(field_name='category__name', lookup_expr='iexact')
-    tags = CharFilterInFilter(field_name='tags__name',  lookup_expr='in')
+    tags = CharFilterInFilter(method='filter_tags')
 
     class Meta:
         model = Image
         fields = ['created']
+
+    def filter_tags(self, queryset, name, value):
+        """Подзапрос вместо JOIN, чтобы изображение с несколькими тегами не повторялось"""
+        tagged = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Image),
+                                           tag__name__in=value).values('object_id')
+        return queryset.filter(id__in=tagged)
+
+
+class ImageSearchFilter(SearchFilter):
+    """
+    Поиск по полнотекстовому индексу вместо icontains по связанным таблицам.
+    Индекс возвращает id изображений в порядке релевантности, они записываются во временную
+    таблицу соединения (id, ранг), и ранг подставляется в аннотацию search_rank
+    (0 - самое релевантное) поиском по ее первичному ключу.
+    """
+    ranks_table = 'image_search_ranks'
+
+    def filter_queryset(self, request, queryset, view):
+        search_terms = self.get_search_terms(request)
+        if not search_terms:
+            return queryset
+
+        image_ids = SearchIndex().search(search_terms, settings.SEARCH_MAX_RESULTS)
+        if not image_ids:
+            return queryset.none()
+        self.save_ranks(connections[queryset.db], image_ids)
+
+        image_table = connections[queryset.db].ops.quote_name(queryset.model._meta.db_table)
+        search_rank = RawSQL(f'SELECT rank FROM {self.ranks_table} WHERE image_id = {image_table}.id', (),
+                             output_field=IntegerField())
+        return queryset.filter(id__in=RawSQL(f'SELECT image_id FROM {self.ranks_table}', ())) \
+            .annotate(search_rank=search_rank)
+
+    def save_ranks(self, connection, image_ids):
+        """Ранги во временной таблице: она видна только этому соединению, а страница выбирается в том же запросе"""
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE TEMPORARY TABLE IF NOT EXISTS {self.ranks_table} '
+                           f'(image_id bigint PRIMARY KEY, rank integer NOT NULL)')
+            cursor.execute(f'DELETE FROM {self.ranks_table}')
+            cursor.executemany(f'INSERT INTO {self.ranks_table} (image_id, rank) VALUES (%s, %s)',
+                               [(image_id, rank) for rank, image_id in enumerate(image_ids)])
+
+    def get_schema_operation_parameters(self, view):
+        return [{
+            'name': self.search_param,
+            'required': False,
+            'in': 'query',
+            'description': 'Поиск по названию, категории, тегам и автору.',
+            'schema': {'type': 'string'},
+        }]
@@ -0,0 +1,181 @@
+import logging
+import os
+import threading
+
+import torch
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from PIL import Image as PiLImage
+from torchvision import models
+
+logger = logging.getLogger(__name__)
+
+TOP_COUNT = 5
+THRESHOLD = 0.08
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+
+_models = {}
+_lock = threading.Lock()
+
+
+class TaggerNet(torch.nn.Module):
+    """EfficientNet, который кроме логитов возвращает эмбеддинг с предпоследнего слоя"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, batch):
+        embeddings = torch.flatten(self.model.avgpool(self.model.features(batch)), 1)
+        return self.model.classifier(embeddings), embeddings
+
+
+class TorchBackend:
+    """Прогон модели в torch, полная точность"""
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, batch):
+        with torch.inference_mode():
+            return self.model(batch)
+
+
+class OnnxBackend:
+    """
+    Прогон модели в ONNX Runtime на CPU.
+    Модель экспортируется в TAGGER_CACHE_DIR один раз, при quantize=True
+    веса дополнительно квантуются в int8.
+    """
+
+    def __init__(self, model, crop_size, quantize=False):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImproperlyConfigured('Для TAGGER_BACKEND="onnx" нужен пакет onnxruntime')
+
+        path = export_onnx(model, crop_size)
+        if quantize:
+            path = quantize_onnx(path)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = settings.TAGGER_TORCH_THREADS
+        options.inter_op_num_threads = settings.TAGGER_TORCH_INTEROP_THREADS
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, batch):
+        logits, embeddings = self.session.run(None, {'input': batch.numpy()})
+        return torch.from_numpy(logits), torch.from_numpy(embeddings)
+
+
+def export_onnx(model, crop_size):
+    path = os.path.join(settings.TAGGER_CACHE_DIR, 'efficientnet_b4_embeddings.onnx')
+    if not os.path.exists(path):
+        os.makedirs(settings.TAGGER_CACHE_DIR, exist_ok=True)
+        # Пишем во временный файл, чтобы параллельные воркеры не прочитали недописанную модель
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        torch.onnx.export(model, torch.zeros(1, 3, crop_size, crop_size), tmp_path,
+                          input_names=['input'], output_names=['logits', 'embeddings'],
+                          dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'},
+                                        'embeddings': {0: 'batch'}},
+                          opset_version=17)
+        os.replace(tmp_path, path)
+        logger.info(f'Модель экспортирована в {path}')
+    return path
+
+
+def quantize_onnx(path):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized_path = path.replace('.onnx', '.int8.onnx')
+    if not os.path.exists(quantized_path):
+        tmp_path = f'{quantized_path}.{os.getpid()}.tmp'
+        quantize_dynamic(path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, quantized_path)
+        logger.info(f'Квантованная модель сохранена в {quantized_path}')
+    return quantized_path
+
+
+def create_backend(name, model, crop_size):
+    if name == 'torch':
+        return TorchBackend(model)
+    if name == 'onnx':
+        return OnnxBackend(model, crop_size)
+    if name == 'onnx-int8':
+        return OnnxBackend(model, crop_size, quantize=True)
+    raise ImproperlyConfigured(f'Неизвестный TAGGER_BACKEND: {name}, доступны: {", ".join(BACKENDS)}')
+
+
+class TagModel:
+    """
+    Модель для предсказания тегов.
+    Веса берутся из локального кеша TAGGER_CACHE_DIR (скачиваются только при первом запуске),
+    названия классов - из метаданных весов, предобработка детерминированная.
+    Прогон выполняет backend из TAGGER_BACKEND.
+    """
+
+    def __init__(self, backend=None):
+        configure_threads()
+        torch.hub.set_dir(str(settings.TAGGER_CACHE_DIR))
+
+        self.weights = models.EfficientNet_B4_Weights.IMAGENET1K_V1
+        self.model = TaggerNet(models.efficientnet_b4(weights=self.weights))
+        self.model.eval()  # Переключаем в режим оценки
+        self.labels = self.weights.meta['categories']
+        self.transform = self.weights.transforms()
+
+        self.backend_name = backend or settings.TAGGER_BACKEND
+        self.backend = create_backend(self.backend_name, self.model, self.crop_size)
+
+    @property
+    def crop_size(self):
+        return self.transform.crop_size[0]
+
+    def preprocess(self, image_path):
+        image = PiLImage.open(image_path).convert('RGB')
+        return self.transform(image)
+
+    def predict_batch(self, batch):
+        tags, _ = self.predict_batch_with_embeddings(batch)
+        return tags
+
+    def predict_batch_with_embeddings(self, batch):
+        """Теги и эмбеддинги (numpy float32) для батча"""
+        logits, embeddings = self.backend(batch)
+        return [self.get_tags(row) for row in logits], embeddings.numpy()
+
+    def get_tags(self, logits):
+        """Теги из топ-5 с вероятностью выше порога, иначе самый вероятный"""
+        probabilities = torch.nn.functional.softmax(logits, dim=0)
+        top_probs, top_catids = torch.topk(probabilities, TOP_COUNT)
+
+        tags = [self.labels[top_catids[i]] for i in range(TOP_COUNT) if top_probs[i] > THRESHOLD]
+        if not tags:
+            tags = [self.labels[top_catids[0]]]
+        return tags
+
+
+def configure_threads():
+    torch.set_num_threads(settings.TAGGER_TORCH_THREADS)
+    try:
+        torch.set_num_interop_threads(settings.TAGGER_TORCH_INTEROP_THREADS)
+    except RuntimeError:
+        # Можно задать только до первого параллельного вычисления в процессе
+        pass
+
+
+def get_model(backend=None):
+    """Модель загружается один раз на процесс"""
+    backend = backend or settings.TAGGER_BACKEND
+    if backend not in _models:
+        with _lock:
+            if backend not in _models:
+                _models[backend] = TagModel(backend)
+    return _models[backend]
+
+
+def warm_up():
+    """Загружает модель и делает пустой прогон, чтобы первая задача не была медленной"""
+    model = get_model()
+    model.predict_batch(torch.zeros(1, 3, model.crop_size, model.crop_size))
+    logger.info(f'Модель для тегов загружена, backend: {model.backend_name}')
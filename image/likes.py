@@ -0,0 +1,242 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+
+from image.models import Image
+from image.search import SearchIndex
+from user.models import CustomUser
+from user.stats import change_owner_stats
+
+
+class LikeStore:
+    """
+    Лайки изображений в Redis.
+    Для каждого изображения хранится set id пользователей (маркер 0 означает, что set загружен).
+    Ни чтение страницы, ни лайк не грузят set в запросе - лайк пользователя проверяется запросом к БД,
+    а set'ы загружает задача load_likes. До загрузки лайк пишется в set вслепую: без маркера
+    такой set считается незагруженным.
+    Изменения копятся в hash и переносятся в БД пачкой задачей flush_likes (write-behind).
+    """
+    pending_key = 'likes:pending'
+    processing_key = 'likes:processing'
+    flush_lock_key = 'likes:flush:lock'
+    loaded_marker = 0
+    ttl = 24 * 60 * 60
+    loading_ttl = 60
+    flush_lock_ttl = 5 * 60
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
+
+    def get_key(self, image_id):
+        return f'image:{image_id}:likes'
+
+    def get_loading_key(self, image_id):
+        return f'image:{image_id}:likes:loading'
+
+    def add(self, image_id, user_id):
+        """Ставит лайк, возвращает False, если лайк уже был"""
+        return self._change(image_id, user_id, liked=True)
+
+    def remove(self, image_id, user_id):
+        """Убирает лайк, возвращает False, если лайка не было"""
+        return self._change(image_id, user_id, liked=False)
+
+    def is_liked(self, image_id, user_id):
+        return image_id in self.liked_image_ids(user_id, [image_id])
+
+    def liked_image_ids(self, user_id, image_ids):
+        """Id изображений из image_ids, которые лайкнул пользователь - один pipeline на страницу"""
+        image_ids = list(image_ids)
+        with self.redis.pipeline(transaction=False) as pipe:
+            for image_id in image_ids:
+                pipe.sismember(self.get_key(image_id), user_id)
+                pipe.sismember(self.get_key(image_id), self.loaded_marker)
+            results = pipe.execute()
+
+        liked = {image_id for image_id, member in zip(image_ids, results[::2]) if member}
+        missing = [image_id for image_id, loaded in zip(image_ids, results[1::2]) if not loaded]
+        if missing:
+            # У популярного изображения set может быть огромным - в запросе его не грузим
+            liked |= self._liked_in_db(user_id, missing)
+            self._schedule_load(missing)
+        return liked
+
+    def load(self, image_ids):
+        """Загружает set'ы лайков из БД (задача load_likes)"""
+        self._ensure_loaded(image_ids)
+        self.redis.delete(*[self.get_loading_key(image_id) for image_id in image_ids])
+
+    def count(self, image_id):
+        self._ensure_loaded([image_id])
+        return self.redis.scard(self.get_key(image_id)) - 1
+
+    def flush(self):
+        """
+        Переносит накопленные лайки в БД и обновляет total_likes.
+        Пачка переименовывается в processing_key и удаляется только после фиксации транзакции,
+        поэтому при ошибке БД она не теряется и будет перенесена при следующем запуске
+        """
+        if not self.redis.set(self.flush_lock_key, 1, nx=True, ex=self.flush_lock_ttl):
+            return 0
+        try:
+            return self._flush()
+        finally:
+            self.redis.delete(self.flush_lock_key)
+
+    def _flush(self):
+        # Пачка, оставшаяся после ошибки, старше новых изменений - переносим сначала ее
+        if not self.redis.exists(self.processing_key):
+            try:
+                self.redis.rename(self.pending_key, self.processing_key)
+            except ResponseError:
+                # Нет изменений
+                return 0
+        pending = self.redis.hgetall(self.processing_key)
+        if not pending:
+            return 0
+
+        added, removed = [], []
+        for field, value in pending.items():
+            image_id, user_id = map(int, field.split(b':'))
+            if value == b'1':
+                added.append((image_id, user_id))
+            else:
+                removed.append((image_id, user_id))
+
+        image_ids = {image_id for image_id, _ in added + removed}
+        with transaction.atomic():
+            self._save(added, removed, image_ids)
+        self.redis.delete(self.processing_key)
+        SearchIndex().update_popularity(image_ids)
+        return len(pending)
+
+    def _save(self, added, removed, image_ids):
+        through = Image.users_like.through
+
+        if added:
+            # Изображения и пользователи могли быть удалены до переноса
+            existing_images = set(Image.objects.filter(id__in=image_ids).values_list('id', flat=True))
+            existing_users = set(CustomUser.objects.filter(id__in={user_id for _, user_id in added})
+                                 .values_list('id', flat=True))
+            through.objects.bulk_create([
+                through(image_id=image_id, customuser_id=user_id)
+                for image_id, user_id in added
+                if image_id in existing_images and user_id in existing_users
+            ], ignore_conflicts=True)
+
+        if removed:
+            users_by_image = defaultdict(list)
+            for image_id, user_id in removed:
+                users_by_image[image_id].append(user_id)
+            condition = Q()
+            for image_id, user_ids in users_by_image.items():
+                condition |= Q(image_id=image_id, customuser_id__in=user_ids)
+            through.objects.filter(condition).delete()
+
+        likes_count = through.objects.filter(image_id=OuterRef('pk')).order_by() \
+            .values('image_id').annotate(count=Count('*')).values('count')
+        old_likes = dict(Image.objects.filter(id__in=image_ids).values_list('id', 'total_likes'))
+        Image.objects.filter(id__in=image_ids) \
+            .update(total_likes=Coalesce(Subquery(likes_count), 0))
+        new_likes = Image.objects.filter(id__in=image_ids).values_list('id', 'total_likes')
+        change_owner_stats('total_likes', {image_id: total_likes - old_likes[image_id]
+                                           for image_id, total_likes in new_likes})
+
+    def _change(self, image_id, user_id, liked):
+        key = self.get_key(image_id)
+        loaded = self.redis.sismember(key, self.loaded_marker)
+        if not loaded:
+            # Set не грузим в запросе: прежнее состояние берем из БД по одной строке
+            was_liked = image_id in self._liked_in_db(user_id, [image_id])
+
+        with self.redis.pipeline() as pipe:
+            if liked:
+                pipe.sadd(key, user_id)
+            else:
+                pipe.srem(key, user_id)
+            pipe.expire(key, self.ttl)
+            # Последнее действие пользователя перекрывает предыдущие до переноса в БД
+            pipe.hset(self.pending_key, f'{image_id}:{user_id}', int(liked))
+            changed = pipe.execute()[0]
+
+        if not loaded:
+            self._schedule_load([image_id])
+            return was_liked != liked
+        return bool(changed)
+
+    def _liked_in_db(self, user_id, image_ids):
+        """Лайки пользователя из БД с учетом изменений, еще не перенесенных в БД"""
+        liked = set(Image.users_like.through.objects.filter(customuser_id=user_id, image_id__in=image_ids)
+                    .values_list('image_id', flat=True))
+        fields = [f'{image_id}:{user_id}' for image_id in image_ids]
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(self.processing_key, fields)
+            pipe.hmget(self.pending_key, fields)
+            batches = pipe.execute()
+        for values in batches:
+            for image_id, value in zip(image_ids, values):
+                if value == b'1':
+                    liked.add(image_id)
+                elif value == b'0':
+                    liked.discard(image_id)
+        return liked
+
+    def _schedule_load(self, image_ids):
+        """Ставит загрузку set'ов в очередь, если она еще не запланирована"""
+        with self.redis.pipeline(transaction=False) as pipe:
+            for image_id in image_ids:
+                pipe.set(self.get_loading_key(image_id), 1, nx=True, ex=self.loading_ttl)
+            results = pipe.execute()
+        image_ids = [image_id for image_id, scheduled in zip(image_ids, results) if scheduled]
+        if image_ids:
+            from .tasks import load_likes
+            load_likes.delay(image_ids)
+
+    def _ensure_loaded(self, image_ids):
+        """Загружает из БД set'ы лайков, которых нет в Redis или которые записаны вслепую"""
+        with self.redis.pipeline(transaction=False) as pipe:
+            for image_id in image_ids:
+                pipe.sismember(self.get_key(image_id), self.loaded_marker)
+            results = pipe.execute()
+        missing = [image_id for image_id, loaded in zip(image_ids, results) if not loaded]
+        if not missing:
+            return
+
+        users_by_image = defaultdict(list)
+        for image_id, user_id in Image.users_like.through.objects.filter(image_id__in=missing) \
+                .values_list('image_id', 'customuser_id'):
+            users_by_image[image_id].append(user_id)
+
+        with self.redis.pipeline(transaction=False) as pipe:
+            for image_id in missing:
+                key = self.get_key(image_id)
+                pipe.sadd(key, self.loaded_marker, *users_by_image[image_id])
+                pipe.expire(key, self.ttl)
+            pipe.execute()
+
+        # В БД еще нет изменений, ожидающих переноса, - накладываем их поверх,
+        # после записи из БД, чтобы лайк, снятый во время загрузки, не вернулся
+        missing = set(missing)
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(self.processing_key)
+            pipe.hgetall(self.pending_key)
+            batches = pipe.execute()
+        changes = {}
+        for pending in batches:
+            for field, value in pending.items():
+                image_id, user_id = map(int, field.split(b':'))
+                if image_id in missing:
+                    changes[image_id, user_id] = value == b'1'
+        if changes:
+            with self.redis.pipeline(transaction=False) as pipe:
+                for (image_id, user_id), liked in changes.items():
+                    if liked:
+                        pipe.sadd(self.get_key(image_id), user_id)
+                    else:
+                        pipe.srem(self.get_key(image_id), user_id)
+                pipe.execute()
@@ -0,0 +1,145 @@
+import json
+import os
+import time
+
+import torch
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from PIL import Image as PiLImage
+from taggit.models import TaggedItem
+from torch.utils.data import DataLoader, Dataset
+
+from image.embeddings import EmbeddingStore
+from image.inference import get_model
+from image.models import Image
+from image.tagging import bulk_add_tags, save_predictions
+
+
+class ImageFiles(Dataset):
+    """Загрузка и предобработка изображений в процессах DataLoader"""
+
+    def __init__(self, items, transform):
+        self.items = items
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        image_id, image_url = self.items[index]
+        try:
+            image = PiLImage.open(os.path.join(settings.MEDIA_ROOT, image_url)).convert('RGB')
+            return image_id, self.transform(image)
+        except (OSError, ValueError):
+            return image_id, None
+
+
+def collate(samples):
+    """Пропускает изображения, которые не удалось открыть"""
+    samples = [(image_id, tensor) for image_id, tensor in samples if tensor is not None]
+    if not samples:
+        return [], None
+    image_ids, tensors = zip(*samples)
+    return list(image_ids), torch.stack(tensors)
+
+
+class Command(BaseCommand):
+    help = ('Генерирует теги и эмбеддинги для всех изображений без тегов; можно продолжить после остановки. '
+            'С --embeddings - эмбеддинги для всех изображений, которых нет в хранилище')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.TAGGER_BATCH_SIZE)
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Процессов для загрузки и предобработки изображений')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Сколько изображений читать из БД за раз')
+        parser.add_argument('--limit', type=int, default=None)
+        parser.add_argument('--checkpoint', default=None,
+                            help='Файл прогресса, по умолчанию backfill_tags.json или backfill_embeddings.json')
+        parser.add_argument('--reset', action='store_true', help='Начать сначала, игнорируя checkpoint')
+        parser.add_argument('--embeddings', action='store_true',
+                            help='Обработать и изображения с тегами (в том числе заданными пользователем): '
+                                 'сохраняются эмбеддинги, теги добавляются только изображениям без тегов')
+
+    def handle(self, *args, **options):
+        embeddings_only = options['embeddings']
+        checkpoint_path = options['checkpoint'] or str(
+            settings.BASE_DIR / ('backfill_embeddings.json' if embeddings_only else 'backfill_tags.json'))
+        checkpoint = {'last_id': 0, 'processed': 0}
+        if not options['reset'] and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as file:
+                checkpoint = json.load(file)
+            self.stdout.write(f"Продолжаем с id > {checkpoint['last_id']}")
+
+        model = get_model()
+        image_ct = ContentType.objects.get_for_model(Image)
+        tagged = TaggedItem.objects.filter(content_type=image_ct).values('object_id')
+        store = EmbeddingStore()
+        stored_ids = set(store.read()[0].tolist()) if embeddings_only else set()
+
+        started = time.monotonic()
+        processed = 0
+        while options['limit'] is None or processed < options['limit']:
+            chunk_size = options['chunk_size']
+            if options['limit'] is not None:
+                chunk_size = min(chunk_size, options['limit'] - processed)
+
+            images = Image.objects.filter(id__gt=checkpoint['last_id'])
+            if not embeddings_only:
+                images = images.exclude(id__in=tagged)
+            items = list(images.order_by('id').values_list('id', 'image')[:chunk_size])
+            if not items:
+                break
+            if embeddings_only:
+                last_id = items[-1][0]
+                items = [item for item in items if item[0] not in stored_ids]
+                if not items:
+                    checkpoint['last_id'] = last_id
+                    self.save_checkpoint(checkpoint_path, checkpoint)
+                    continue
+                untagged = {image_id for image_id, _ in items} - set(
+                    tagged.filter(object_id__in=[image_id for image_id, _ in items])
+                    .values_list('object_id', flat=True))
+
+            loader = DataLoader(ImageFiles(items, model.transform),
+                                batch_size=options['batch_size'],
+                                num_workers=options['workers'],
+                                collate_fn=collate)
+            for position, (image_ids, batch) in enumerate(loader):
+                if image_ids:
+                    tags, embeddings = model.predict_batch_with_embeddings(batch)
+                    if embeddings_only:
+                        # Теги пользователя не дополняем предсказанными
+                        bulk_add_tags({image_id: image_tags for image_id, image_tags in zip(image_ids, tags)
+                                       if image_id in untagged})
+                        store.append(image_ids, embeddings)
+                    else:
+                        save_predictions(dict(zip(image_ids, tags)), dict(zip(image_ids, embeddings)))
+
+                # Батчи идут по порядку, поэтому последний id батча - граница прогресса
+                last_item = min((position + 1) * options['batch_size'], len(items)) - 1
+                checkpoint['last_id'] = items[last_item][0]
+                checkpoint['processed'] += len(image_ids)
+                processed += len(image_ids)
+                self.save_checkpoint(checkpoint_path, checkpoint)
+
+            elapsed = time.monotonic() - started
+            self.stdout.write(f'Обработано: {processed}, '
+                              f'{processed / elapsed:.1f} изображений/с, '
+                              f"последний id: {checkpoint['last_id']}")
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово: {processed} изображений за {elapsed:.0f} с '
+            f'({processed / max(elapsed, 1e-9):.1f} изображений/с)'
+        ))
+        if embeddings_only and processed:
+            self.stdout.write('Для перераспределения кластеров выполните rebuild_similarity_index')
+
+    def save_checkpoint(self, path, checkpoint):
+        """Записывает прогресс атомарно, чтобы не испортить файл при остановке"""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(checkpoint, file)
+        os.replace(tmp_path, path)
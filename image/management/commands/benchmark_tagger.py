@@ -0,0 +1,69 @@
+import os
+import time
+
+import torch
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from image.inference import BACKENDS, TOP_COUNT, get_model
+from image.models import Image
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает скорость и точность backend\'ов модели для тегов с torch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=BACKENDS)
+        parser.add_argument('--images', type=int, default=256, help='Сколько последних изображений взять')
+        parser.add_argument('--batch-size', type=int, default=settings.TAGGER_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        reference = get_model('torch')
+        batches = self.load_batches(reference, options['images'], options['batch_size'])
+        if not batches:
+            self.stdout.write(self.style.WARNING('Нет изображений для сравнения'))
+            return
+        total = sum(len(batch) for batch in batches)
+        self.stdout.write(f'Изображений: {total}, размер батча: {options["batch_size"]}')
+
+        reference_logits = None
+        for name in ['torch'] + [name for name in options['backends'] if name != 'torch']:
+            model = get_model(name)
+            # Первый прогон не считаем - в нем инициализация
+            model.backend(batches[0][:1])
+
+            started = time.perf_counter()
+            logits = torch.cat([model.backend(batch)[0] for batch in batches])
+            elapsed = time.perf_counter() - started
+
+            line = (f'{name:<10} {total / elapsed:8.1f} изобр./с '
+                    f'{elapsed * 1000 / total:8.1f} мс/изобр.')
+            if reference_logits is None:
+                reference_logits = logits
+            else:
+                line += '  ' + self.compare(reference, reference_logits, logits)
+            self.stdout.write(line)
+
+    def load_batches(self, model, count, batch_size):
+        image_urls = Image.objects.order_by('-id').values_list('image', flat=True)[:count]
+        tensors = []
+        for image_url in image_urls:
+            try:
+                tensors.append(model.preprocess(os.path.join(settings.MEDIA_ROOT, image_url)))
+            except (OSError, ValueError):
+                continue
+        return [torch.stack(tensors[i:i + batch_size]) for i in range(0, len(tensors), batch_size)]
+
+    def compare(self, model, reference_logits, logits):
+        """Совпадение с torch: топ-1, пересечение топ-5 и итоговые теги"""
+        top1 = (reference_logits.argmax(dim=1) == logits.argmax(dim=1)).float().mean().item()
+
+        reference_top = reference_logits.topk(TOP_COUNT, dim=1).indices.tolist()
+        top = logits.topk(TOP_COUNT, dim=1).indices.tolist()
+        overlap = sum(len(set(a) & set(b)) for a, b in zip(reference_top, top)) / (TOP_COUNT * len(top))
+
+        same_tags = sum(
+            set(model.get_tags(a)) == set(model.get_tags(b))
+            for a, b in zip(reference_logits, logits)
+        ) / len(logits)
+        return f'топ-1: {top1:.1%}  топ-5: {overlap:.1%}  теги: {same_tags:.1%}'
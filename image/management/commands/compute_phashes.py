@@ -0,0 +1,40 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from image.duplicates import bump_version, dhash
+from image.models import Image
+
+
+class Command(BaseCommand):
+    help = 'Считает перцептивный хеш для изображений, загруженных до появления поиска дубликатов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total = 0
+        last_id = 0
+        while True:
+            rows = list(Image.objects.filter(id__gt=last_id, phash__isnull=True)
+                        .order_by('id').values_list('id', 'image')[:options['batch_size']])
+            if not rows:
+                break
+
+            images = []
+            for image_id, image_url in rows:
+                try:
+                    images.append(Image(id=image_id, phash=dhash(os.path.join(settings.MEDIA_ROOT, image_url))))
+                except OSError:
+                    self.stderr.write(f'Не удалось открыть изображение {image_id}')
+            Image.objects.bulk_update(images, ['phash'])
+
+            last_id = rows[-1][0]
+            total += len(images)
+            self.stdout.write(f'Обработано: {total}')
+
+        if total:
+            # Хеши старых изображений не попадают в индексы процессов при догрузке новых
+            bump_version()
+        self.stdout.write(self.style.SUCCESS(f'Готово, хешей посчитано: {total}'))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from image.models import Image
+from image.search import SearchIndex
+
+
+class Command(BaseCommand):
+    help = 'Заново строит полнотекстовый индекс изображений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        index = SearchIndex()
+        index.clear()
+
+        total = 0
+        last_id = 0
+        while True:
+            image_ids = list(Image.objects.filter(id__gt=last_id).order_by('id')
+                             .values_list('id', flat=True)[:options['batch_size']])
+            if not image_ids:
+                break
+            index.index_images(image_ids)
+            last_id = image_ids[-1]
+            total += len(image_ids)
+            self.stdout.write(f'Проиндексировано: {total}')
+
+        self.stdout.write(self.style.SUCCESS(f'Готово, изображений в индексе: {total}'))
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from image.similarity import SimilarityIndex
+
+
+class Command(BaseCommand):
+    help = 'Обучает IVF-индекс похожих изображений по хранилищу эмбеддингов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nlist', type=int, default=None,
+                            help='Количество кластеров, по умолчанию - корень из числа векторов')
+        parser.add_argument('--iterations', type=int, default=10)
+        parser.add_argument('--sample', type=int, default=100000,
+                            help='Сколько векторов использовать для обучения центроидов')
+
+    def handle(self, *args, **options):
+        index = SimilarityIndex()
+        started = time.monotonic()
+        nlist = index.train(nlist=options['nlist'],
+                            iterations=options['iterations'],
+                            sample=options['sample'])
+        if not nlist:
+            self.stdout.write(self.style.WARNING('Хранилище эмбеддингов пусто'))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f'Индекс собран: векторов {len(index.store)}, кластеров {nlist}, '
+            f'{time.monotonic() - started:.1f} с'
+        ))
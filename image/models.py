@@ -38,7 +38,12 @@ class Image(models.Model):
     views = models.PositiveIntegerField(default=0)
     total_likes = models.PositiveIntegerField(default=0)
     tags = TaggableManager(blank=True)
-
+    renditions = models.JSONField(default=dict, blank=True)
+    phash = models.BigIntegerField(null=True, blank=True, db_index=True)
+    duplicate_of = models.ForeignKey('self',
+                                     related_name='duplicates',
+                                     null=True, blank=True,
+                                     on_delete=models.SET_NULL)
 
     class Meta:
         indexes = [models.Index(fields=['-created'])]
@@ -93,19 +98,25 @@ class Comment(models.Model):
 
 class FavoriteDatabaseManager:
     @staticmethod
-    def save_to_db(user, favorite_images):
-        """Сохраняет избранные изображения в БД для авторизованного пользователя."""
-        favorite, created = Favorite.objects.get_or_create(user=user)
-        favorite.images = list(favorite_images)
-        favorite.save()
+    def save_many(favorites_by_user):
+        """Сохраняет избранное пользователей в БД: {id пользователя: [id изображений]}"""
+        if not favorites_by_user:
+            return
+        existing = Favorite.objects.in_bulk(list(favorites_by_user), field_name='user_id')
+        for user_id, favorite in existing.items():
+            favorite.images = favorites_by_user[user_id]
+        Favorite.objects.bulk_update(existing.values(), ['images'])
+        Favorite.objects.bulk_create([
+            Favorite(user_id=user_id, images=images)
+            for user_id, images in favorites_by_user.items() if user_id not in existing
+        ], ignore_conflicts=True)
 
     @staticmethod
-    def load_from_db(user):
-        """Загружает избранные изображения из БД."""
-        try:
-            return list(Favorite.objects.get(user=user).images)
-        except Favorite.DoesNotExist:
-            return list()
+    def load_from_db(user_id):
+        """Загружает id избранных изображений из БД."""
+        images = Favorite.objects.filter(user_id=user_id).values_list('images', flat=True).first()
+        # Раньше id хранились строками
+        return [int(image_id) for image_id in images or []]
 
 
 class Favorite(models.Model):
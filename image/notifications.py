@@ -0,0 +1,180 @@
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django_redis import get_redis_connection
+
+from image.models import Image
+from user.models import CustomUser, Follow
+
+
+class DigestBuffer:
+    """
+    Новые посты для подписчиков в режиме дайджеста.
+    Для каждого получателя копится Redis list id изображений, получатели с непустым
+    буфером хранятся в set; периодическая задача забирает буферы и отправляет по одному письму.
+    """
+    recipients_key = 'digest:recipients'
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
+
+    def get_key(self, user_id):
+        return f'digest:{user_id}'
+
+    def append(self, image_id, user_ids):
+        with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.rpush(self.get_key(user_id), image_id)
+                pipe.ltrim(self.get_key(user_id), -settings.NOTIFICATION_DIGEST_MAX_IMAGES, -1)
+            if user_ids:
+                pipe.sadd(self.recipients_key, *user_ids)
+            pipe.execute()
+
+    def pop(self, count):
+        """Забирает буферы не более count получателей: {id пользователя: [id изображений]}"""
+        user_ids = [int(user_id) for user_id in self.redis.spop(self.recipients_key, count) or []]
+        if not user_ids:
+            return {}
+        with self.redis.pipeline() as pipe:
+            for user_id in user_ids:
+                pipe.lrange(self.get_key(user_id), 0, -1)
+                pipe.delete(self.get_key(user_id))
+            results = pipe.execute()
+        return {user_id: [int(image_id) for image_id in image_ids]
+                for user_id, image_ids in zip(user_ids, results[::2]) if image_ids}
+
+    def push_back(self, buffers):
+        """Возвращает неотправленные буферы, чтобы отправить их в следующий раз"""
+        with self.redis.pipeline(transaction=False) as pipe:
+            for user_id, image_ids in buffers.items():
+                pipe.lpush(self.get_key(user_id), *reversed(image_ids))
+            if buffers:
+                pipe.sadd(self.recipients_key, *buffers)
+            pipe.execute()
+
+
+class NotifiedSet:
+    """
+    Подписчики, которым уже отправлено уведомление об изображении (Redis set).
+    Повторный запуск задачи после сбоя пропускает их, поэтому письма не дублируются.
+    """
+    ttl = 7 * 24 * 60 * 60
+
+    def __init__(self, image_id):
+        self.redis = get_redis_connection('default')
+        self.key = f'image:{image_id}:notified'
+
+    def filter_new(self, user_ids):
+        with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.sismember(self.key, user_id)
+            notified = pipe.execute()
+        return [user_id for user_id, is_notified in zip(user_ids, notified) if not is_notified]
+
+    def add(self, user_ids):
+        if not user_ids:
+            return
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.sadd(self.key, *user_ids)
+            pipe.expire(self.key, self.ttl)
+            pipe.execute()
+
+
+def get_follower_ranges(user_id, chunk_size):
+    """
+    Диапазоны id подписок (start, end] по chunk_size подписчиков.
+    Границы находятся по индексу, сами подписчики не загружаются; у последнего диапазона end = None
+    """
+    follows = Follow.objects.filter(user_to_id=user_id).order_by('id').values_list('id', flat=True)
+    start = 0
+    while True:
+        boundary = list(follows.filter(id__gt=start)[chunk_size - 1:chunk_size])
+        if not boundary:
+            yield start, None
+            return
+        yield start, boundary[0]
+        start = boundary[0]
+
+
+def get_followers(user_id, start, end):
+    """Список (id, e-mail, режим уведомлений) подписчиков из диапазона подписок"""
+    follows = Follow.objects.filter(user_to_id=user_id, id__gt=start)
+    if end is not None:
+        follows = follows.filter(id__lte=end)
+    return list(follows.order_by('id')
+                .values_list('user_from_id', 'user_from__email', 'user_from__notification_mode'))
+
+
+def send_post_notifications(image, followers):
+    """
+    Отправляет письма о новом изображении через одно SMTP-соединение,
+    подписчикам в режиме дайджеста изображение добавляется в буфер.
+    Обработанные сразу отмечаются, так что при ошибке повтор продолжит с необработанных.
+    Возвращает количество отправленных писем
+    """
+    notified = NotifiedSet(image.id)
+    emails = {user_id: email for user_id, email, _ in followers}
+    recipient_ids = notified.filter_new([user_id for user_id, email, _ in followers if email])
+    if not recipient_ids:
+        return 0
+
+    modes = {user_id: mode for user_id, _, mode in followers}
+    digest_ids = [user_id for user_id in recipient_ids if modes[user_id] == CustomUser.NOTIFICATION_DIGEST]
+    if digest_ids:
+        DigestBuffer().append(image.id, digest_ids)
+        notified.add(digest_ids)
+        recipient_ids = [user_id for user_id in recipient_ids if modes[user_id] != CustomUser.NOTIFICATION_DIGEST]
+
+    subject = f'Пользователь {image.owner.username} запостил новую картинку:'
+    message = f'Ссылка на изображение {image.title}: {settings.SITE_URL}{image.get_absolute_url()}'
+
+    sent = []
+    try:
+        with get_connection() as connection:
+            for user_id in recipient_ids:
+                connection.send_messages([EmailMessage(subject, message, settings.EMAIL_HOST_USER,
+                                                       [emails[user_id]], connection=connection)])
+                sent.append(user_id)
+    finally:
+        notified.add(sent)
+    return len(sent)
+
+
+def send_digests(batch_size):
+    """
+    Отправляет накопленные дайджесты пачками по batch_size получателей через одно SMTP-соединение.
+    Неотправленные из-за ошибки буферы возвращаются. Возвращает количество отправленных писем
+    """
+    buffer = DigestBuffer()
+    total = 0
+    while True:
+        buffers = buffer.pop(batch_size)
+        if not buffers:
+            return total
+
+        emails = dict(CustomUser.objects.filter(id__in=list(buffers)).values_list('id', 'email'))
+        images = Image.objects.select_related('owner') \
+            .in_bulk({image_id for image_ids in buffers.values() for image_id in image_ids})
+
+        sent = []
+        try:
+            with get_connection() as connection:
+                for user_id, image_ids in buffers.items():
+                    user_images = [images[image_id] for image_id in image_ids if image_id in images]
+                    if emails.get(user_id) and user_images:
+                        connection.send_messages([EmailMessage(
+                            f'Новые картинки от ваших подписок: {len(user_images)}',
+                            render_digest(user_images), settings.EMAIL_HOST_USER,
+                            [emails[user_id]], connection=connection,
+                        )])
+                    sent.append(user_id)
+        finally:
+            sent_ids = set(sent)
+            buffer.push_back({user_id: image_ids for user_id, image_ids in buffers.items()
+                              if user_id not in sent_ids})
+        total += len(sent)
+
+
+def render_digest(images):
+    lines = [f'{image.owner.username}: {image.title} - {settings.SITE_URL}{image.get_absolute_url()}'
+             for image in images]
+    return 'Новые картинки пользователей, на которых вы подписаны:\n\n' + '\n'.join(lines)
@@ -0,0 +1,59 @@
+from image.favourites import FavoriteSessionManager
+from image.likes import LikeStore
+from user.graph import SocialGraph
+
+
+class ViewerRelations:
+    """
+    Отношения текущего пользователя к объектам ответа: лайки, избранное и подписки.
+    Создается один раз на запрос (get_relations), флаги загружаются сразу для всей страницы
+    одним обращением на вид отношения и запоминаются.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.user = request.user
+        self.liked = {}
+        self.following = {}
+        self.favorites = None
+
+    def prime_images(self, image_ids):
+        """Загружает лайки текущего пользователя для изображений страницы"""
+        image_ids = [image_id for image_id in image_ids if image_id not in self.liked]
+        if not image_ids:
+            return
+        liked = set()
+        if self.user.is_authenticated:
+            liked = LikeStore().liked_image_ids(self.user.id, image_ids)
+        self.liked.update((image_id, image_id in liked) for image_id in image_ids)
+
+    def prime_users(self, user_ids):
+        """Загружает подписки текущего пользователя на пользователей страницы"""
+        user_ids = [user_id for user_id in user_ids if user_id not in self.following]
+        if not user_ids:
+            return
+        following = set()
+        if self.user.is_authenticated:
+            following = SocialGraph().following_ids(self.user.id, user_ids)
+        self.following.update((user_id, user_id in following) for user_id in user_ids)
+
+    def is_liked(self, image_id):
+        self.prime_images([image_id])
+        return self.liked[image_id]
+
+    def is_favorite(self, image_id):
+        if self.favorites is None:
+            self.favorites = FavoriteSessionManager(self.request).get_favorites()
+        return image_id in self.favorites
+
+    def is_following(self, user_id):
+        self.prime_users([user_id])
+        return self.following[user_id]
+
+
+def get_relations(request):
+    """ViewerRelations текущего запроса"""
+    relations = getattr(request, '_viewer_relations', None)
+    if relations is None:
+        relations = request._viewer_relations = ViewerRelations(request)
+    return relations
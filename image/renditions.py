@@ -0,0 +1,148 @@
+import logging
+import math
+import os
+
+import billiard
+from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image as PiLImage, ImageOps
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = (150, 150)
+# Значения EXIF Orientation, при которых ширина и высота меняются местами
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+_pool = None
+
+
+def get_pool():
+    """
+    Пул процессов для кодирования версий, создается один раз на процесс воркера.
+    Пул из billiard: дочерние процессы prefork-воркера Celery - демоны, и multiprocessing
+    не дает им создавать свои процессы, а billiard дает.
+    """
+    global _pool
+    processes = settings.IMAGE_RENDITION_PROCESSES
+    if processes <= 1:
+        return None
+    if _pool is None:
+        _pool = billiard.get_context('spawn').Pool(processes=processes)
+    return _pool
+
+
+def get_formats():
+    """Форматы из настроек, которые умеет сохранять установленный Pillow"""
+    PiLImage.init()
+    formats = []
+    for image_format in settings.IMAGE_RENDITION_FORMATS:
+        if image_format.upper() in PiLImage.SAVE:
+            formats.append(image_format)
+        else:
+            logger.warning(f'Формат {image_format} не поддерживается Pillow, версии не создаются')
+    return formats
+
+
+def get_rendition_name(image_name, width, image_format):
+    name, _ = os.path.splitext(image_name)
+    return f'{name}_{width}w.{image_format}'
+
+
+def decode(image_path, max_width):
+    """
+    Декодирует изображение один раз.
+    JPEG сразу декодируется в уменьшенном масштабе (draft), но не меньше max_width.
+    Возвращает изображение с учетом EXIF-поворота и исходную ширину.
+    """
+    image = PiLImage.open(image_path)
+    orientation = image.getexif().get(0x0112)
+    width, height = image.size
+    if orientation in ROTATED_ORIENTATIONS:
+        width, height = height, width
+
+    if image.format == 'JPEG' and width > max_width:
+        scale = max_width / width
+        image.draft('RGB', (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    return image, width
+
+
+def render_width(image, width, formats, image_name, media_root, quality):
+    """Уменьшает изображение до ширины width и сохраняет его во всех форматах"""
+    height = max(1, round(image.height * width / image.width))
+    resized = image.resize((width, height), PiLImage.LANCZOS, reducing_gap=3.0)
+
+    renditions = {}
+    for image_format in formats:
+        rendition_name = get_rendition_name(image_name, width, image_format)
+        resized.save(os.path.join(media_root, rendition_name),
+                     format=image_format.upper(), quality=quality)
+        renditions[image_format] = rendition_name
+    return width, renditions
+
+
+def create_renditions(image_name):
+    """
+    Создает версии изображения всех ширин и форматов из настроек, а также миниатюру.
+    Возвращает словарь {формат: {ширина: путь относительно MEDIA_ROOT}}
+    """
+    image_path = os.path.join(settings.MEDIA_ROOT, image_name)
+    widths = sorted(settings.IMAGE_RENDITION_WIDTHS)
+    formats = get_formats()
+
+    image, original_width = decode(image_path, widths[-1])
+    # Увеличенные версии не создаем
+    widths = [width for width in widths if width < original_width]
+
+    args = (formats, image_name, str(settings.MEDIA_ROOT), settings.IMAGE_RENDITION_QUALITY)
+    pool = get_pool()
+    if pool and len(widths) > 1:
+        results = pool.starmap(render_width, [(image, width, *args) for width in widths])
+    else:
+        results = [render_width(image, width, *args) for width in widths]
+
+    renditions = {image_format: {} for image_format in formats}
+    for width, rendered in results:
+        for image_format, rendition_name in rendered.items():
+            renditions[image_format][str(width)] = rendition_name
+
+    save_thumbnail(image, image_path)
+    return renditions
+
+
+def save_thumbnail(image, image_path):
+    """Миниатюра 150x150 в формате оригинала"""
+    thumbnail = image.copy()
+    thumbnail.thumbnail(THUMBNAIL_SIZE)
+    name, extension = os.path.splitext(image_path)
+    if extension.lower() in ('.jpg', '.jpeg'):
+        thumbnail = thumbnail.convert('RGB')
+    thumbnail.save(f'{name}_thumbnail{extension}')
+
+
+def get_srcset(renditions, request=None):
+    """Словарь {формат: строка srcset} для версий изображения"""
+    srcset = {}
+    for image_format, widths in renditions.items():
+        sources = []
+        for width, rendition_name in sorted(widths.items(), key=lambda item: int(item[0])):
+            url = default_storage.url(rendition_name)
+            if request:
+                url = request.build_absolute_uri(url)
+            sources.append(f'{url} {width}w')
+        srcset[image_format] = ', '.join(sources)
+    return srcset
+
+
+def delete_renditions(renditions, keep=()):
+    """Удаляет файлы версий, кроме используемых другими изображениями"""
+    for widths in renditions.values():
+        for rendition_name in widths.values():
+            if rendition_name in keep:
+                continue
+            path = os.path.join(settings.MEDIA_ROOT, rendition_name)
+            if os.path.exists(path):
+                os.remove(path)
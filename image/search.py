@@ -0,0 +1,104 @@
+import math
+import sqlite3
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from taggit.models import TaggedItem
+
+from image.models import Image
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS images USING fts5(
+    title, category, tags, owner, boost UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+)
+"""
+
+_local = threading.local()
+
+
+class SearchIndex:
+    """
+    Полнотекстовый индекс изображений в отдельной базе SQLite (FTS5), rowid - id изображения.
+    Результаты ранжируются по BM25 с весами колонок, усиленному популярностью изображения (boost).
+    Индекс обновляется сигналами при изменении изображений и их тегов.
+    Файл индекса локален для хоста: процессы на других хостах его не видят и не обновляют.
+    """
+    # Веса колонок title, category, tags, owner для bm25()
+    weights = (10.0, 3.0, 5.0, 2.0)
+
+    def __init__(self, path=None):
+        self.path = str(path or settings.SEARCH_INDEX_PATH)
+
+    @property
+    def connection(self):
+        """Одно соединение на поток"""
+        connections = getattr(_local, 'connections', None)
+        if connections is None:
+            connections = _local.connections = {}
+        if self.path not in connections:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(SCHEMA)
+            connections[self.path] = connection
+        return connections[self.path]
+
+    def search(self, query_terms, limit):
+        """Id изображений, подходящих под все слова запроса, лучшие первыми"""
+        match = ' '.join('"{}"*'.format(term.replace('"', '""')) for term in query_terms if term)
+        if not match:
+            return []
+        rows = self.connection.execute(
+            'SELECT rowid FROM images WHERE images MATCH ? '
+            'ORDER BY bm25(images, ?, ?, ?, ?) * (1 + boost) LIMIT ?',
+            (match, *self.weights, limit),
+        )
+        return [image_id for image_id, in rows]
+
+    def index_images(self, image_ids):
+        """Добавляет или обновляет документы изображений"""
+        image_ids = list(image_ids)
+        if not image_ids:
+            return
+        image_ct = ContentType.objects.get_for_model(Image)
+        tags = defaultdict(list)
+        for image_id, tag_name in TaggedItem.objects.filter(content_type=image_ct, object_id__in=image_ids) \
+                .values_list('object_id', 'tag__name'):
+            tags[image_id].append(tag_name)
+
+        rows = Image.objects.filter(id__in=image_ids) \
+            .values_list('id', 'title', 'category__name', 'owner__username', 'views', 'total_likes')
+        documents = [
+            (image_id, title, category, ' '.join(tags[image_id]), owner, self.get_boost(views, total_likes))
+            for image_id, title, category, owner, views, total_likes in rows
+        ]
+
+        with self.connection as connection:
+            connection.executemany('DELETE FROM images WHERE rowid = ?', [(i,) for i in image_ids])
+            connection.executemany(
+                'INSERT INTO images (rowid, title, category, tags, owner, boost) VALUES (?, ?, ?, ?, ?, ?)',
+                documents,
+            )
+
+    def update_popularity(self, image_ids):
+        """Пересчитывает boost изображений после синхронизации просмотров и лайков"""
+        rows = Image.objects.filter(id__in=list(image_ids)).values_list('id', 'views', 'total_likes')
+        with self.connection as connection:
+            connection.executemany(
+                'UPDATE images SET boost = ? WHERE rowid = ?',
+                [(self.get_boost(views, total_likes), image_id) for image_id, views, total_likes in rows],
+            )
+
+    def remove(self, image_ids):
+        with self.connection as connection:
+            connection.executemany('DELETE FROM images WHERE rowid = ?', [(i,) for i in image_ids])
+
+    def clear(self):
+        with self.connection as connection:
+            connection.execute('DELETE FROM images')
+
+    def get_boost(self, views, total_likes):
+        return settings.SEARCH_POPULARITY_WEIGHT * math.log1p(views + 5 * total_likes)
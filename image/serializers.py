@@ -1,8 +1,10 @@
+from django.db import models
 from rest_framework import serializers
 from taggit.models import Tag
 from taggit.serializers import TagListSerializerField
-from .favourites import FavoriteSessionManager
 from .models import Image, Comment, Category
+from .relations import get_relations
+from .renditions import get_srcset
 from user.common_serializers import CustomUserSerializer
 
 
@@ -35,16 +37,43 @@ class CategorySerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class ImageSerializer(serializers.HyperlinkedModelSerializer):
+class ImageListSerializer(serializers.ListSerializer):
+    """Загружает лайки текущего пользователя сразу для всех изображений страницы"""
+
+    def to_representation(self, data):
+        images = list(data.all() if isinstance(data, models.Manager) else data)
+        request = self.context.get('request')
+        if request:
+            get_relations(request).prime_images([image.id for image in images])
+        return super().to_representation(images)
+
+
+class ViewerFieldsMixin:
+    """Флаги текущего пользователя из ViewerRelations запроса"""
+
+    def get_is_like(self, obj):
+        request = self.context.get('request')
+        return bool(request) and get_relations(request).is_liked(obj.id)
+
+    def get_is_favorite(self, obj):
+        request = self.context.get('request')
+        return bool(request) and get_relations(request).is_favorite(obj.id)
+
+
+class ImageSerializer(ViewerFieldsMixin, serializers.HyperlinkedModelSerializer):
     owner = serializers.StringRelatedField(read_only=True)
     tags = TagListSerializerField(required=False)
     category = serializers.SlugRelatedField(queryset=Category.objects.all(), slug_field='name')
     views = serializers.IntegerField(read_only=True)
+    srcset = serializers.SerializerMethodField(read_only=True)
+    is_like = serializers.SerializerMethodField(read_only=True)
+    is_favorite = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
         model = Image
-        exclude = ('users_like', 'updated', 'created')
+        exclude = ('users_like', 'updated', 'created', 'renditions', 'phash', 'duplicate_of')
         read_only_fields = ('total_likes', )
+        list_serializer_class = ImageListSerializer
 
     def create(self, validated_data):
         tags_data = validated_data.pop('tags', [])
@@ -61,8 +90,11 @@ class ImageSerializer(serializers.HyperlinkedModelSerializer):
             raise serializers.ValidationError("The image size should not exceed 10MB.")
         return value
 
+    def get_srcset(self, obj):
+        return get_srcset(obj.renditions, self.context.get('request'))
 
-class ImageDetailSerializer(serializers.ModelSerializer):
+
+class ImageDetailSerializer(ViewerFieldsMixin, serializers.ModelSerializer):
     views = serializers.SerializerMethodField(read_only=True)
     comments = CommentSerializer(many=True, read_only=True)
     owner = CustomUserSerializer(read_only=True)
@@ -70,12 +102,14 @@ class ImageDetailSerializer(serializers.ModelSerializer):
     category = serializers.SlugRelatedField(read_only=True, slug_field='name')
     is_like =  serializers.SerializerMethodField(read_only=True)
     is_favorite =  serializers.SerializerMethodField(read_only=True)
+    srcset = serializers.SerializerMethodField(read_only=True)
 
 
     class Meta:
         model = Image
-        exclude = ('users_like',)
+        exclude = ('users_like', 'renditions', 'phash', 'duplicate_of')
         read_only_fields = ('total_likes', 'title', 'image', 'tags')
+        list_serializer_class = ImageListSerializer
 
     def update(self, instance, validated_data):
         tags_data = validated_data.pop('tags', [])
@@ -92,21 +126,10 @@ class ImageDetailSerializer(serializers.ModelSerializer):
 
         return instance
 
-    def get_is_like(self, obj):
-        request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            return obj.users_like.filter(id=request.user.id).exists()
-        return False
+    def get_srcset(self, obj):
+        return get_srcset(obj.renditions, self.context.get('request'))
 
     def get_views(self, obj):
         # Получаем количество просмотров из контекста
         return self.context.get('views', 0)
 
-    def get_is_favorite(self, obj):
-        request = self.context.get('request')
-        session_manager = FavoriteSessionManager(request)
-        favorites = session_manager.get_favorites()
-        if str(obj.id) in favorites:
-            return True
-        return False
-
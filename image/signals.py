@@ -1,25 +1,121 @@
 import os
 from django.contrib.auth.signals import user_logged_in
-from .models import FavoriteDatabaseManager
-from .favourites import FavoriteSessionManager
+from .favourites import FavoriteSessionManager, FavoriteStore
 from django.conf import settings
-from django.db.models.signals import m2m_changed, post_delete
+from django.db.models import Q
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
+from .facets import FacetCounts
 from .models import Image
+from .renditions import delete_renditions
+from .search import SearchIndex
+from .trending import TrendingIndex
+from user.models import CustomUser
+from user.stats import change_stats
 
 @receiver(m2m_changed, sender=Image.users_like.through)
-def users_like_changed(sender, instance, **kwargs):
+def users_like_changed(sender, instance, action, reverse, **kwargs):
     """
-    Сохраняем количество лайков
+    Сохраняем количество лайков при изменении через ORM (например, из админки).
+    Лайки из API переносятся в БД пачкой задачей flush_likes
     """
-    instance.total_likes = instance.users_like.count()
-    instance.save()
+    if reverse or action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    Image.objects.filter(pk=instance.pk).update(total_likes=instance.users_like.count())
+
+
+@receiver(pre_save, sender=Image)
+def remember_category(sender, instance, **kwargs):
+    """Запоминаем прежнюю категорию, чтобы поправить счетчики фасетов"""
+    if instance.pk:
+        instance._old_category_id = Image.objects.filter(pk=instance.pk) \
+            .values_list('category_id', flat=True).first()
+
+
+@receiver(post_save, sender=Image)
+def index_image(sender, instance, created, **kwargs):
+    """Обновляем поисковый индекс, счетчики категорий и профиля после сохранения транзакции"""
+    transaction.on_commit(lambda: SearchIndex().index_images([instance.id]))
+    if created:
+        transaction.on_commit(lambda: change_stats({instance.owner_id: {'images_count': 1}}))
+
+    old_category_id = None if created else getattr(instance, '_old_category_id', None)
+    if old_category_id == instance.category_id:
+        return
+
+    def change_category():
+        facets = FacetCounts()
+        if old_category_id is not None:
+            facets.change_category(old_category_id, -1)
+        facets.change_category(instance.category_id, 1)
+    transaction.on_commit(change_category)
+
+
+@receiver(m2m_changed, sender=Image.tags.through)
+def image_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Теги изображения входят в поисковый документ и в счетчики фасетов"""
+    if reverse:
+        return
+    if action == 'pre_clear':
+        instance._cleared_tag_ids = list(instance.tags.values_list('id', flat=True))
+        return
+    if action == 'pre_remove':
+        # pk_set содержит и теги, которых у изображения не было
+        instance._removed_tag_ids = list(instance.tags.filter(id__in=pk_set or ()).values_list('id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if action == 'post_clear':
+        tag_ids = getattr(instance, '_cleared_tag_ids', ())
+    elif action == 'post_remove':
+        tag_ids = getattr(instance, '_removed_tag_ids', ())
+    else:
+        tag_ids = pk_set or ()
+    amount = 1 if action == 'post_add' else -1
+    transaction.on_commit(lambda: FacetCounts().change_tags(tag_ids, amount))
+    transaction.on_commit(lambda: SearchIndex().index_images([instance.id]))
+    if action != 'post_add':
+        # Иначе изображение занимает место в топе тега, пока не затухнет
+        transaction.on_commit(lambda: TrendingIndex().remove_tags(instance.id, tag_ids))
+
+
+@receiver(pre_delete, sender=Image)
+def remember_tags(sender, instance, **kwargs):
+    """После удаления теги изображения уже не получить"""
+    instance._tag_ids = list(instance.tags.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=Image)
+def find_shared_renditions(sender, instance, **kwargs):
+    """
+    Дубликаты могут использовать версии исходного изображения -
+    запоминаем файлы, которые нужны другим изображениям кластера.
+    Исходное изображение при удалении передает кластер самому старому дубликату:
+    иначе duplicate_of обнулится (SET_NULL) и при удалении любого из бывших дубликатов
+    общие файлы посчитаются свободными
+    """
+    root_id = instance.duplicate_of_id or instance.id
+    cluster = Image.objects.filter(Q(id=root_id) | Q(duplicate_of_id=root_id)).exclude(id=instance.id)
+    instance._renditions_in_use = {
+        rendition_name
+        for renditions in cluster.values_list('renditions', flat=True)
+        for widths in renditions.values()
+        for rendition_name in widths.values()
+    }
+
+    if instance.duplicate_of_id is None:
+        new_root_id = cluster.order_by('id').values_list('id', flat=True).first()
+        if new_root_id is not None:
+            cluster.exclude(id=new_root_id).update(duplicate_of_id=new_root_id)
+            Image.objects.filter(id=new_root_id).update(duplicate_of=None)
 
 
 @receiver(post_delete, sender=Image)
-def delete_image(sender, instance, **kwargs):
+def delete_image(sender, instance, origin=None, **kwargs):
     """
-    Удаляем миниатюру и оригинальное изображения
+    Удаляем миниатюру, все версии и оригинальное изображения
     """
     image_path = os.path.join(settings.MEDIA_ROOT, instance.image.name)
     if os.path.exists(image_path):
@@ -30,17 +126,25 @@ def delete_image(sender, instance, **kwargs):
     if os.path.exists(thumbnail_path):
         os.remove(thumbnail_path)
 
+    delete_renditions(instance.renditions, keep=getattr(instance, '_renditions_in_use', ()))
+    TrendingIndex().remove(instance.id, instance.category_id, getattr(instance, '_tag_ids', ()))
+    SearchIndex().remove([instance.id])
 
-@receiver(user_logged_in)
-def merge_favorites_on_login(sender, request, user, **kwargs):
-    # Получаем избранное из сессии
-    session_manager = FavoriteSessionManager(request)
-    favorites = set(session_manager.get_favorites())  # Избранное из сессии
+    facets = FacetCounts()
+    facets.change_category(instance.category_id, -1)
+    facets.change_tags(getattr(instance, '_tag_ids', ()), -1)
 
-    if favorites:  # Если в сессии есть избранные
-        db_favorites = set(FavoriteDatabaseManager.load_from_db(user))
-        merged_favorites = favorites | db_favorites  # Объединяем множества
-        session_manager.save_favorites(merged_favorites)
-        FavoriteDatabaseManager.save_to_db(user, merged_favorites)  # Записываем в БД
+    # При удалении пользователя удаляются и его счетчики
+    if not isinstance(origin, CustomUser):
+        change_stats({instance.owner_id: {'images_count': -1,
+                                          'total_views': -instance.views,
+                                          'total_likes': -instance.total_likes}})
 
 
+@receiver(user_logged_in)
+def merge_favorites_on_login(sender, request, user, **kwargs):
+    """Избранное, добавленное до входа, переносим в избранное пользователя"""
+    session_manager = FavoriteSessionManager(request)
+    favorites = session_manager.pop_session_favorites()
+    if favorites:
+        FavoriteStore().add(user.id, *favorites)
@@ -0,0 +1,161 @@
+import math
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from image.embeddings import EmbeddingStore
+
+ASSIGN_CHUNK = 65536
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def assign(vectors, centroids):
+    """Номер ближайшего центроида для каждого вектора, по частям, чтобы не занимать много памяти"""
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_CHUNK):
+        chunk = np.asarray(vectors[start:start + ASSIGN_CHUNK], dtype=np.float32)
+        assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+class SimilarityIndex:
+    """
+    IVF-индекс для поиска похожих изображений по эмбеддингам.
+    Векторы разбиты k-means на кластеры; запрос сравнивается с центроидами,
+    а точные скалярные произведения считаются только в SIMILAR_NPROBE ближайших кластерах.
+    Центроиды хранятся в ivf.npz рядом с эмбеддингами (команда rebuild_similarity_index),
+    новые векторы из хранилища добавляются в ближайший кластер при обращении к индексу.
+    Пока индекс не обучен, поиск идет перебором.
+    """
+
+    def __init__(self, store=None):
+        self.store = store or EmbeddingStore()
+        self.index_path = os.path.join(self.store.path, 'ivf.npz')
+        self.loaded_mtime = None
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.centroids = None
+        self.lists = []
+        self.count = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = None
+        self.positions = {}
+
+    def refresh(self):
+        """Перечитывает индекс после пересборки и добавляет новые векторы из хранилища"""
+        with self.lock:
+            mtime = os.path.getmtime(self.index_path) if os.path.exists(self.index_path) else None
+            if mtime != self.loaded_mtime:
+                self._load()
+                self.loaded_mtime = mtime
+            if len(self.store) > self.count:
+                self._add(*self.store.read())
+
+    def _load(self):
+        self._reset()
+        if not os.path.exists(self.index_path):
+            return
+        with np.load(self.index_path) as data:
+            self.centroids = data['centroids']
+            assignments = data['assignments']
+
+        ids, vectors = self.store.read()
+        count = min(len(assignments), len(ids))
+        assignments = assignments[:count]
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+        self.lists = [[order[bounds[cluster]:bounds[cluster + 1]]]
+                      for cluster in range(len(self.centroids))]
+        self._set_rows(ids, vectors, 0, count)
+
+    def _add(self, ids, vectors):
+        start = self.count
+        if self.centroids is not None:
+            assignments = assign(vectors[start:], self.centroids)
+            for cluster in np.unique(assignments):
+                self.lists[cluster].append(np.flatnonzero(assignments == cluster) + start)
+        self._set_rows(ids, vectors, start, len(ids))
+
+    def _set_rows(self, ids, vectors, start, end):
+        self.ids = ids
+        self.vectors = vectors
+        # Для повторно записанных изображений актуальна последняя позиция
+        self.positions.update(zip(ids[start:end].tolist(), range(start, end)))
+        self.count = end
+
+    def search(self, vector, limit, exclude_id=None):
+        """Список (сходство, id) ближайших изображений"""
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.centroids is None:
+            candidates = np.arange(self.count)
+        else:
+            nprobe = min(settings.SIMILAR_NPROBE, len(self.centroids))
+            nearest = np.argpartition(-(self.centroids @ vector), nprobe - 1)[:nprobe]
+            candidates = np.concatenate([part for cluster in nearest for part in self.lists[cluster]]
+                                        or [np.empty(0, dtype=np.int64)])
+        if not len(candidates):
+            return []
+
+        candidates = np.sort(candidates)
+        candidate_ids = self.ids[candidates]
+        # Устаревшие записи и само изображение пропускаем
+        actual = np.array([self.positions[image_id] == position and image_id != exclude_id
+                           for image_id, position in zip(candidate_ids.tolist(), candidates.tolist())])
+        candidates, candidate_ids = candidates[actual], candidate_ids[actual]
+        if not len(candidates):
+            return []
+
+        scores = np.asarray(self.vectors[candidates], dtype=np.float32) @ vector
+        top = np.argsort(-scores)[:limit]
+        return [(float(scores[i]), int(candidate_ids[i])) for i in top]
+
+    def similar(self, image_id, limit):
+        position = self.positions.get(image_id)
+        if position is None:
+            return []
+        return self.search(self.vectors[position], limit, exclude_id=image_id)
+
+    def train(self, nlist=None, iterations=10, sample=100000):
+        """
+        Обучает центроиды сферическим k-means на выборке векторов
+        и сохраняет их вместе с кластерами всех векторов
+        """
+        ids, vectors = self.store.read()
+        if not len(ids):
+            return 0
+        nlist = min(nlist or max(1, int(math.sqrt(len(ids)))), len(ids))
+
+        rng = np.random.default_rng(0)
+        sample_positions = np.sort(rng.choice(len(ids), min(sample, len(ids)), replace=False))
+        data = np.asarray(vectors[sample_positions], dtype=np.float32)
+        nlist = min(nlist, len(data))
+        centroids = data[rng.choice(len(data), nlist, replace=False)]
+
+        for _ in range(iterations):
+            assignments = assign(data, centroids)
+            for cluster in range(nlist):
+                members = data[assignments == cluster]
+                # Пустой кластер получает случайную точку выборки
+                centroid = members.mean(axis=0) if len(members) else data[rng.integers(len(data))]
+                centroids[cluster] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+        tmp_path = self.index_path.replace('.npz', '.tmp.npz')
+        np.savez(tmp_path, centroids=centroids, assignments=assign(vectors, centroids))
+        os.replace(tmp_path, self.index_path)
+        return nlist
+
+
+def get_index():
+    """Индекс загружается один раз на процесс и догружается при каждом обращении"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = SimilarityIndex()
+    _index.refresh()
+    return _index
@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django_redis import get_redis_connection
+from taggit.models import Tag, TaggedItem
+
+from image.embeddings import EmbeddingStore
+from image.facets import FacetCounts
+from image.models import Image
+from image.search import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+
+class TaggingQueue:
+    """
+    Очередь изображений, ожидающих автоматические теги.
+    Изображения копятся в Redis list и обрабатываются пачками одним прогоном модели.
+    """
+    key = 'tagging:pending'
+    scheduled_key = 'tagging:scheduled'
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
+
+    def push(self, image_id, image_url):
+        """Добавляет изображение, возвращает длину очереди"""
+        return self.redis.rpush(self.key, json.dumps([image_id, image_url]))
+
+    def push_back(self, items):
+        """Возвращает необработанные изображения в начало очереди"""
+        if items:
+            self.redis.lpush(self.key, *[json.dumps(item) for item in reversed(items)])
+
+    def pop(self, count):
+        # LPOP с количеством есть только в Redis 6.2+, LRANGE + LTRIM в транзакции работает везде
+        with self.redis.pipeline() as pipe:
+            pipe.lrange(self.key, 0, count - 1)
+            pipe.ltrim(self.key, count, -1)
+            items, _ = pipe.execute()
+        return [json.loads(item) for item in items]
+
+    def mark_scheduled(self, timeout):
+        """
+        Отмечает, что задача для очереди запланирована. Возвращает False, если отметка уже есть.
+        Отметка снимается воркером перед разбором очереди, timeout страхует от потерянной задачи
+        """
+        return bool(self.redis.set(self.scheduled_key, 1, nx=True, ex=timeout))
+
+    def clear_scheduled(self):
+        self.redis.delete(self.scheduled_key)
+
+    def __len__(self):
+        return self.redis.llen(self.key)
+
+
+def enqueue_tagging(image_id, image_url):
+    """
+    Ставит изображение в очередь на теги.
+    Пачка запускается, когда набралось TAGGER_BATCH_SIZE изображений
+    или прошло TAGGER_BATCH_LATENCY_MS после первого изображения пачки.
+    Отложенная задача ставится не чаще одной за раз - по отметке в Redis, а не по длине очереди,
+    которую могут изменить возвращенные после ошибки или параллельно добавленные изображения
+    """
+    from .tasks import tag_pending_images
+
+    queue = TaggingQueue()
+    length = queue.push(image_id, image_url)
+    if length >= settings.TAGGER_BATCH_SIZE:
+        tag_pending_images.delay()
+    elif queue.mark_scheduled(settings.TAGGER_SCHEDULED_TIMEOUT):
+        tag_pending_images.apply_async(countdown=settings.TAGGER_BATCH_LATENCY_MS / 1000)
+
+
+def predict_batch(model, items):
+    """
+    Теги и эмбеддинги для пачки [id, путь]: словари {id: теги} и {id: вектор}.
+    Изображения, которые не удалось открыть, пропускаются
+    """
+    import torch
+
+    image_ids, tensors = [], []
+    for image_id, image_url in items:
+        try:
+            tensors.append(model.preprocess(os.path.join(settings.MEDIA_ROOT, image_url)))
+            image_ids.append(image_id)
+        except (OSError, ValueError) as exception:
+            logger.warning(f'Не удалось открыть изображение {image_id}: {exception}')
+    if not tensors:
+        return {}, {}
+    tags, embeddings = model.predict_batch_with_embeddings(torch.stack(tensors))
+    return dict(zip(image_ids, tags)), dict(zip(image_ids, embeddings))
+
+
+def save_predictions(tags_by_image, embeddings_by_image):
+    """Сохраняет теги и эмбеддинги пачки"""
+    bulk_add_tags(tags_by_image)
+    if embeddings_by_image:
+        EmbeddingStore().append(list(embeddings_by_image), list(embeddings_by_image.values()))
+
+
+def bulk_add_tags(tags_by_image):
+    """
+    Добавляет теги изображениям массовыми вставками.
+    tags_by_image - словарь {id изображения: [названия тегов]}
+    """
+    names = {name for tags in tags_by_image.values() for name in tags}
+    if not names:
+        return
+
+    new_tags = []
+    existing_names = set(Tag.objects.filter(name__in=names).values_list('name', flat=True))
+    for name in names - existing_names:
+        tag = Tag(name=name)
+        tag.slug = tag.slugify(name)
+        new_tags.append(tag)
+    Tag.objects.bulk_create(new_tags, ignore_conflicts=True)
+
+    tag_ids = dict(Tag.objects.filter(name__in=names).values_list('name', 'id'))
+    # Теги, не вставленные из-за совпадения slug, создаем по одному - taggit подберет slug сам
+    for name in names - tag_ids.keys():
+        tag_ids[name] = Tag.objects.create(name=name).id
+
+    image_ct = ContentType.objects.get_for_model(Image)
+    existing_images = set(Image.objects.filter(id__in=list(tags_by_image)).values_list('id', flat=True))
+    existing_items = set(TaggedItem.objects.filter(content_type=image_ct, object_id__in=existing_images)
+                         .values_list('object_id', 'tag_id'))
+    new_items = {
+        (image_id, tag_ids[name])
+        for image_id, tags in tags_by_image.items() if image_id in existing_images
+        for name in tags
+    } - existing_items
+    TaggedItem.objects.bulk_create([
+        TaggedItem(content_type=image_ct, object_id=image_id, tag_id=tag_id)
+        for image_id, tag_id in new_items
+    ], ignore_conflicts=True)
+
+    # bulk_create не отправляет сигналы, поэтому поисковый индекс и фасеты обновляем явно
+    SearchIndex().index_images(existing_images)
+    FacetCounts().change_tags([tag_id for _, tag_id in new_items], 1)
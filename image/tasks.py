@@ -2,43 +2,66 @@ import os
 import logging
 from celery.exceptions import MaxRetriesExceededError
 from django.conf import settings
-from celery import shared_task, signals
+from celery import current_app, shared_task, signals
 from django.core.cache import cache
-from django.core.mail import send_mail
+from smtplib import SMTPException
 from PIL import Image as PiLImage
 from user.models import CustomUser
+from .count_views import CountViewsImage
+from .facets import FacetCounts
+from .favourites import FavoriteStore
+from .likes import LikeStore
 from .models import Image
+from .notifications import get_follower_ranges, get_followers, send_digests, send_post_notifications
+from .renditions import create_renditions
+from .tagging import TaggingQueue, predict_batch, save_predictions
+from .trending import TrendingIndex
 
 logger = logging.getLogger(__name__)
 
 
-@shared_task(bind=True, max_retries=3, default_retry_delay=30)
-def send_notification_email(self, subject, message, recipient_email):
-    """
-    Отправляет e-mail подписчику.
-    """
-    send_mail(subject, message, 'eldar00319g@gmail.com', [recipient_email])
-    # logger.info(f'Письмо успешно отправлено на {recipient_email}')
-    return f'Письмо отправлено на {recipient_email}'
-
-
 @shared_task(bind=True, max_retries=3, default_retry_delay=10)
 def post_image(self, image_id, user_id):
     """
     Задание по отправке уведомления о новом посте подписчикам.
+    Подписчики делятся на диапазоны по id подписки, каждый диапазон отправляет отдельная задача.
     """
-    image = Image.objects.get(id=image_id)
-    user = CustomUser.objects.prefetch_related('followers').get(id=user_id)
+    chunks = 0
+    for start, end in get_follower_ranges(user_id, settings.NOTIFICATION_CHUNK_SIZE):
+        notify_followers.delay(image_id, user_id, start, end)
+        chunks += 1
 
-    subject = f'Пользователь {user.username} запостил новую картинку:'
-    url = image.get_absolute_url()
-    message = f'Ссылка на изображение {image.title}: {settings.SITE_URL}{url}'
+    # logger.info(f'Уведомления успешно поставлены в очередь для подписчиков пользователя {user}')
+    return f'Уведомления поставлены на очередь для изображения id: {image_id}, задач: {chunks}'
 
-    for follower in user.followers.all():
-        send_notification_email.delay(subject, message, follower.email)
 
-    # logger.info(f'Уведомления успешно поставлены в очередь для подписчиков пользователя {user}')
-    return f'Уведомления поставлены на очередь для изображения: {image}, id: {image.id}'
+@shared_task(bind=True, max_retries=3, default_retry_delay=30)
+def notify_followers(self, image_id, user_id, start, end):
+    """
+    Отправляет письма подписчикам из диапазона подписок (start, end] через одно SMTP-соединение.
+    Уже уведомленные подписчики пропускаются, поэтому повтор задачи безопасен.
+    """
+    lock_key = f'notify:{image_id}:{start}'
+    # Одновременно диапазон обрабатывает только одна задача
+    if not cache.add(lock_key, 1, timeout=600):
+        return f'Диапазон {start}-{end} изображения {image_id} уже обрабатывается'
+    try:
+        image = Image.objects.select_related('owner').filter(id=image_id).first()
+        if image is None:
+            return f'Изображение {image_id} удалено'
+        sent = send_post_notifications(image, get_followers(user_id, start, end))
+    except SMTPException as exc:
+        raise self.retry(exc=exc)
+    finally:
+        cache.delete(lock_key)
+    return f'Отправлено писем: {sent}, изображение id: {image_id}'
+
+
+@shared_task
+def send_notification_digests():
+    """Отправляет подписчикам в режиме дайджеста одно письмо с новыми постами за период"""
+    sent = send_digests(settings.NOTIFICATION_CHUNK_SIZE)
+    return f'Отправлено дайджестов: {sent}'
 
 
 @shared_task(bind=True, max_retries=3, default_retry_delay=10)
@@ -59,31 +82,91 @@ def generate_thumbnail(self, image_url):
     return thumbnail_path
 
 
-@shared_task(bind=True, max_retries=3, default_retry_delay=30)
-def generate_image_tags(self, image_id, image_url):
+@shared_task(bind=True, max_retries=3, default_retry_delay=10)
+def generate_renditions(self, image_id, image_url):
+    """
+    Генерирует версии картинки разных ширин и форматов и миниатюру.
+    """
+    renditions = create_renditions(image_url)
+    Image.objects.filter(id=image_id).update(renditions=renditions)
+    return renditions
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=10)
+def tag_pending_images(self):
     """
-    Генерирует теги для изображения
+    Генерирует теги для пачки изображений из очереди одним прогоном модели
     """
-    tags = predict_tags(image_url)
-    image = Image.objects.get(id=image_id)
-    for tag in tags:
-        image.tags.add(tag)
-    return tags
+    # torch импортируется только в воркерах image_queue
+    from .inference import get_model
+
+    queue = TaggingQueue()
+    # Изображения, добавленные после этого момента, запланируют новую задачу
+    queue.clear_scheduled()
+    items = queue.pop(settings.TAGGER_BATCH_SIZE)
+    if not items:
+        return 'Очередь пуста'
+
+    try:
+        tags_by_image, embeddings_by_image = predict_batch(get_model(), items)
+        save_predictions(tags_by_image, embeddings_by_image)
+    except Exception as exception:
+        queue.push_back(items)
+        queue.mark_scheduled(settings.TAGGER_SCHEDULED_TIMEOUT)
+        raise self.retry(exc=exception)
+
+    # Пока обрабатывали пачку, могли прийти новые изображения
+    if len(queue) and queue.mark_scheduled(settings.TAGGER_SCHEDULED_TIMEOUT):
+        tag_pending_images.delay()
+    return f'Теги сгенерированы для изображений: {len(tags_by_image)}'
 
 @shared_task
 def sync_views_to_db():
     """Сохраняет просмотры из Redis в БД"""
-    keys = cache.keys("image:*:views")
-    # image_dict = {}
-    for key in keys:
-        image_id = key.split(":")[1]
-        views = int(cache.get(key))
-        image = Image.objects.get(id=image_id)
-        image.views = views
-        image.save()
-        # image_dict[f"{image.id}"] = views
-    # return {"Синхронизация завершена": image_dict}
-    return "Синхронизация завершена"
+    synced = CountViewsImage().sync_to_db()
+    return f"Синхронизация завершена, изображений: {synced}"
+
+@shared_task
+def flush_likes():
+    """Переносит лайки из Redis в БД"""
+    flushed = LikeStore().flush()
+    return f"Перенесено изменений лайков: {flushed}"
+
+@shared_task
+def load_likes(image_ids):
+    """Загружает в Redis set'ы лайков изображений, не найденные при чтении страницы"""
+    LikeStore().load(image_ids)
+    return f"Загружены лайки изображений: {len(image_ids)}"
+
+@shared_task
+def flush_favorites():
+    """Переносит измененное избранное из Redis в БД"""
+    flushed = FavoriteStore().flush()
+    return f"Сохранено избранное пользователей: {flushed}"
+
+@shared_task
+def update_trending():
+    """Пересчитывает индекс трендовых изображений"""
+    updated = TrendingIndex().update()
+    return f"Индекс трендов обновлен, изображений: {updated}"
+
+@shared_task
+def rebuild_facets():
+    """Пересчитывает счетчики фасетов по БД, исправляя возможное расхождение"""
+    FacetCounts().rebuild()
+    return "Счетчики фасетов пересчитаны"
+
+@signals.worker_process_init.connect
+def warm_up_tagger(**kwargs):
+    """Загружает модель для тегов при старте процесса воркера image_queue"""
+    if not settings.TAGGER_WARMUP:
+        return
+    queues = current_app.amqp.queues.consume_from
+    if queues and 'image_queue' not in queues:
+        return
+    from .inference import warm_up
+    warm_up()
+
 
 @signals.task_failure.connect
 def task_failure_handler(sender, task_id, exception, args, kwargs, traceback, einfo, **extras):
@@ -100,55 +183,3 @@ def task_failure_handler(sender, task_id, exception, args, kwargs, traceback, ei
         logger.info(f"Повтор задачи {sender.name} (ID: {task_id}) из-за ошибки: {exception}")
     except MaxRetriesExceededError:
         logger.error(f"Достигнут лимит повторов для задачи {sender.name} (ID: {task_id})")
-
-
-import torch
-import torchvision.transforms as transforms
-from torchvision import models
-import requests
-
-
-def predict_tags(image_url):
-    """
-    Функция для предсказания тегов
-    Возвращает список наиболее подходящих тегов
-    """
-    image_path = os.path.join(settings.MEDIA_ROOT, image_url)
-
-    #  Выбираем модель
-    model = models.efficientnet_b4(weights=models.EfficientNet_B4_Weights.IMAGENET1K_V1)
-    model.eval()  # Переключаем в режим оценки
-
-    # Предобработка изображения
-    transform = transforms.Compose([
-        transforms.Resize((380, 380)),
-        transforms.AutoAugment(transforms.AutoAugmentPolicy.IMAGENET),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
-
-    # Загружаем изображение
-    image = PiLImage.open(image_path).convert("RGB")
-    image = transform(image).unsqueeze(0)
-
-    # Запуск предсказания
-    with torch.no_grad():
-        outputs = model(image)
-
-    # Получаем топ-5
-    top_count = 5
-    probabilities = torch.nn.functional.softmax(outputs[0], dim=0)
-    top_probs, top_catids = torch.topk(probabilities, top_count)
-
-    # Загружаем список классов ImageNet
-    labels_path = "https://raw.githubusercontent.com/pytorch/hub/master/imagenet_classes.txt"
-    labels = requests.get(labels_path).text.splitlines()
-
-    threshold = 0.08
-    tags = [labels[top_catids[i]] for i in range(top_count) if top_probs[i] > threshold]
-
-    if not tags:
-        max_index = top_probs.index(max(top_probs))
-        tags = [labels[top_catids[max_index]]]
-
-    return tags
\ No newline at end of file
@@ -1,3 +1,662 @@
-from django.test import TestCase
+import os
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.db import DatabaseError
+from django.db.models.signals import m2m_changed
+from smtplib import SMTPException
+
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django_redis import get_redis_connection
+from PIL import Image as PiLImage
+from rest_framework.test import APIClient
+from taggit.models import Tag
+
+from user.models import CustomUser, Follow
+from .count_views import CountViewsImage
+from .embeddings import DIM, EmbeddingStore
+from .facets import FacetCounts
+from .favourites import FavoriteStore
+from .likes import LikeStore
+from . import duplicates, renditions
+from .models import Category, Favorite, Image
+from .notifications import (DigestBuffer, get_follower_ranges, get_followers, send_digests,
+                            send_post_notifications)
+from .search import SearchIndex
+from .trending import TrendingIndex
+
+# Тесты хранилищ работают с отдельной базой Redis и очищают ее
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/15',
+        'OPTIONS': {'CLIENT_CLASS': 'django_redis.client.DefaultClient'},
+    }
+}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class RedisTestCase(TestCase):
+
+    def setUp(self):
+        self.redis = get_redis_connection('default')
+        self.redis.flushdb()
+        self.addCleanup(self.redis.flushdb)
+
+
+@mock.patch('image.tasks.load_likes.delay')
+@mock.patch('image.likes.SearchIndex')
+@mock.patch('image.signals.SearchIndex')
+class LikeStoreTest(RedisTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner = CustomUser.objects.create_user(username='owner', email='owner@example.com', password='pass')
+        self.user = CustomUser.objects.create_user(username='user', email='user@example.com', password='pass')
+        category = Category.objects.create(name='nature')
+        self.images = [Image.objects.create(category=category, owner=self.owner,
+                                            title=f'image {number}', image='images/test.jpg')
+                       for number in range(3)]
+
+    def test_flush_writes_likes(self, *mocks):
+        store = LikeStore()
+        store.add(self.images[0].id, self.user.id)
+        store.add(self.images[1].id, self.user.id)
+        store.remove(self.images[1].id, self.user.id)
+
+        self.assertEqual(store.flush(), 2)
+        self.assertEqual(list(self.user.liked_images.values_list('id', flat=True)), [self.images[0].id])
+        self.images[0].refresh_from_db()
+        self.assertEqual(self.images[0].total_likes, 1)
+        self.assertEqual(store.flush(), 0)
+
+    def test_failed_flush_keeps_batch(self, *mocks):
+        store = LikeStore()
+        store.add(self.images[0].id, self.user.id)
+
+        with mock.patch.object(LikeStore, '_save', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                store.flush()
+        self.assertFalse(self.user.liked_images.exists())
+
+        # Лайк, поставленный после ошибки, переносится следующим запуском вместе с прежней пачкой
+        store.add(self.images[1].id, self.user.id)
+        store.flush()
+        store.flush()
+        self.assertCountEqual(self.user.liked_images.values_list('id', flat=True),
+                              [self.images[0].id, self.images[1].id])
+
+    def test_like_on_cold_set_does_not_load_it(self, *mocks):
+        load_likes = mocks[-1]
+        self.images[0].users_like.add(self.owner)
+        self.images[1].users_like.add(self.user)
+        store = LikeStore()
+
+        # Один запрос к БД - только строка лайка пользователя, а не весь set
+        with self.assertNumQueries(1):
+            self.assertTrue(store.add(self.images[0].id, self.user.id))
+        self.assertFalse(store.add(self.images[0].id, self.user.id))
+        self.assertTrue(store.remove(self.images[1].id, self.user.id))
+        self.assertFalse(self.redis.sismember(store.get_key(self.images[0].id), store.loaded_marker))
+        self.assertEqual(load_likes.call_count, 2)
+
+        # Загрузка добавляет лайки из БД и не возвращает снятый лайк
+        store.load([self.images[0].id, self.images[1].id])
+        self.assertEqual(store.redis.smembers(store.get_key(self.images[0].id)),
+                         {b'0', str(self.owner.id).encode(), str(self.user.id).encode()})
+        self.assertEqual(store.redis.smembers(store.get_key(self.images[1].id)), {b'0'})
+        with self.assertNumQueries(0):
+            self.assertEqual(store.liked_image_ids(self.user.id, [self.images[0].id, self.images[1].id]),
+                             {self.images[0].id})
+
+    def test_cold_sets_are_checked_in_db_and_loaded_in_background(self, *mocks):
+        load_likes = mocks[-1]
+        self.images[0].users_like.add(self.user)
+        store = LikeStore()
+
+        with self.assertNumQueries(1):
+            liked = store.liked_image_ids(self.user.id, [image.id for image in self.images])
+        self.assertEqual(liked, {self.images[0].id})
+        self.assertFalse(self.redis.exists(store.get_key(self.images[0].id)))
+        load_likes.assert_called_once_with([image.id for image in self.images])
+
+        # Повторное чтение не ставит загрузку второй раз
+        store.liked_image_ids(self.user.id, [self.images[0].id])
+        load_likes.assert_called_once()
+
+        store.load([image.id for image in self.images])
+        with self.assertNumQueries(0):
+            self.assertEqual(store.liked_image_ids(self.user.id, [image.id for image in self.images]),
+                             {self.images[0].id})
+
+    def test_cold_check_sees_changes_not_yet_flushed(self, *mocks):
+        self.images[0].users_like.add(self.user)
+        store = LikeStore()
+        store.redis.hset(store.pending_key, f'{self.images[0].id}:{self.user.id}', 0)
+        store.redis.hset(store.pending_key, f'{self.images[1].id}:{self.user.id}', 1)
+
+        self.assertEqual(store.liked_image_ids(self.user.id, [self.images[0].id, self.images[1].id]),
+                         {self.images[1].id})
+
+
+class FavoriteStoreTest(RedisTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user(username='user', email='user@example.com', password='pass')
+
+    def test_failed_flush_keeps_users_dirty(self):
+        store = FavoriteStore()
+        store.add(self.user.id, 1, 2)
+
+        with mock.patch('image.favourites.FavoriteDatabaseManager.save_many', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                store.flush()
+        self.assertFalse(Favorite.objects.exists())
+
+        self.assertEqual(store.flush(), 1)
+        self.assertEqual(Favorite.objects.get(user=self.user).images, [1, 2])
+
+
+@mock.patch('image.signals.SearchIndex')
+class SharedRenditionsTest(RedisTestCase):
+    """Файлы версий, общие для дубликатов, удаляются только вместе с последним изображением кластера"""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+
+        self.path = os.path.join(media_root.name, 'image_320w.webp')
+        open(self.path, 'wb').close()
+        renditions = {'webp': {'320': 'image_320w.webp'}}
+
+        owner = CustomUser.objects.create_user(username='owner', email='owner@example.com', password='pass')
+        category = Category.objects.create(name='nature')
+        self.original = Image.objects.create(category=category, owner=owner, title='original',
+                                             image='original.jpg', renditions=renditions)
+        self.duplicates = [Image.objects.create(category=category, owner=owner, title=f'duplicate {number}',
+                                                image=f'duplicate{number}.jpg', renditions=renditions,
+                                                duplicate_of=self.original)
+                           for number in range(2)]
+
+    def test_cluster_survives_original_deletion(self, *mocks):
+        self.original.delete()
+        first, second = self.duplicates
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertIsNone(first.duplicate_of_id)
+        self.assertEqual(second.duplicate_of_id, first.id)
+        self.assertTrue(os.path.exists(self.path))
+
+        second.delete()
+        self.assertTrue(os.path.exists(self.path))
+
+        first.delete()
+        self.assertFalse(os.path.exists(self.path))
+
+
+@override_settings(IMAGE_RENDITION_WIDTHS=[40, 80, 200], IMAGE_RENDITION_FORMATS=['webp'])
+class RenditionsTest(SimpleTestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        self.media_root = media_root.name
+        PiLImage.new('RGB', (120, 60), 'red').save(os.path.join(self.media_root, 'image.jpg'))
+
+    def assert_renditions(self, result):
+        # Версию шире оригинала не создаем
+        self.assertEqual(result, {'webp': {'40': 'image_40w.webp', '80': 'image_80w.webp'}})
+        with PiLImage.open(os.path.join(self.media_root, 'image_80w.webp')) as rendition:
+            self.assertEqual(rendition.size, (80, 40))
+        with PiLImage.open(os.path.join(self.media_root, 'image_thumbnail.jpg')) as thumbnail:
+            self.assertEqual(thumbnail.size, (120, 60))
+
+    @override_settings(IMAGE_RENDITION_PROCESSES=1)
+    def test_create_renditions(self):
+        self.assert_renditions(renditions.create_renditions('image.jpg'))
+
+    @override_settings(IMAGE_RENDITION_PROCESSES=2)
+    def test_create_renditions_in_pool(self):
+        self.addCleanup(setattr, renditions, '_pool', None)
+        pool = renditions.get_pool()
+        self.addCleanup(pool.join)
+        self.addCleanup(pool.terminate)
+        self.assert_renditions(renditions.create_renditions('image.jpg'))
+
+
+class EmbeddingStoreTest(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = EmbeddingStore(directory.name)
+
+    def vectors(self, *positions):
+        """Единичные векторы - по ним видно, с какой записью совпал вектор"""
+        return [[float(index == position) for index in range(DIM)] for position in positions]
+
+    def test_interrupted_write_does_not_shift_later_rows(self):
+        self.store.append([1, 2], self.vectors(1, 2))
+        # Запись оборвалась: половина вектора без id
+        with open(self.store.vectors_path, 'ab') as file:
+            file.write(b'\0' * DIM)
+        self.assertEqual(len(self.store), 2)
+
+        self.store.append([3], self.vectors(3))
+        ids, vectors = self.store.read()
+        self.assertEqual(ids.tolist(), [1, 2, 3])
+        self.assertEqual([int(vector.argmax()) for vector in vectors], [1, 2, 3])
+
+
+@mock.patch('image.count_views.SearchIndex')
+@mock.patch('image.signals.SearchIndex')
+class CountViewsImageTest(RedisTestCase):
+
+    def setUp(self):
+        super().setUp()
+        owner = CustomUser.objects.create_user(username='owner', email='owner@example.com', password='pass')
+        category = Category.objects.create(name='nature')
+        self.image = Image.objects.create(category=category, owner=owner, title='image',
+                                          image='images/test.jpg', views=10)
+
+    def test_pending_views_are_synced(self, *mocks):
+        counter = CountViewsImage()
+        for _ in range(3):
+            counter.incr(self.image.id, base=self.image.views)
+
+        self.assertEqual(counter.sync_to_db(), 1)
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.views, 13)
+        self.assertFalse(self.redis.exists(counter.get_cache_key(self.image.id)))
+        self.assertEqual(counter.get(self.image.id), 13)
+
+    def test_views_during_sync_are_kept(self, *mocks):
+        counter = CountViewsImage()
+        counter.incr(self.image.id)
+        bulk_update = Image.objects.bulk_update
+
+        def update_with_new_view(*args, **kwargs):
+            # Просмотр пришел между чтением прироста и его вычитанием
+            counter.incr(self.image.id)
+            return bulk_update(*args, **kwargs)
+
+        with mock.patch.object(Image.objects, 'bulk_update', side_effect=update_with_new_view):
+            counter.sync_to_db()
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.views, 11)
+        self.assertEqual(self.redis.get(counter.get_cache_key(self.image.id)), b'1')
+
+        counter.sync_to_db()
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.views, 12)
+
+
+@mock.patch('image.signals.SearchIndex')
+class TrendingIndexTest(RedisTestCase):
+
+    def setUp(self):
+        super().setUp()
+        owner = CustomUser.objects.create_user(username='owner', email='owner@example.com', password='pass')
+        self.category = Category.objects.create(name='nature')
+        self.images = [Image.objects.create(category=self.category, owner=owner, title=f'image {number}',
+                                            image='images/test.jpg', views=number * 10)
+                       for number in range(3)]
+        self.images[0].tags.add('sky')
+
+    def test_rebuild_orders_by_activity(self, *mocks):
+        index = TrendingIndex()
+        index.rebuild()
+
+        # У первого изображения нет событий - в индекс оно не попадает
+        expected = [self.images[2].id, self.images[1].id]
+        self.assertEqual(index.top(), expected)
+        self.assertEqual(index.top(category_id=self.category.id), expected)
+
+    def test_update_applies_decay(self, *mocks):
+        index = TrendingIndex()
+        index.update()
+        index.record(self.images[0].id, 'like')
+        index.update()
+        score = self.redis.zscore(index.global_key, self.images[0].id)
+        self.assertAlmostEqual(score, 5, places=2)
+
+        # Прошел период полураспада
+        self.redis.set(index.updated_key, float(self.redis.get(index.updated_key)) - index.half_life)
+        index.update()
+        self.assertAlmostEqual(self.redis.zscore(index.global_key, self.images[0].id), score / 2, places=2)
+        tag_id = self.images[0].tags.get().id
+        self.assertAlmostEqual(self.redis.zscore(index.get_tag_key(tag_id), self.images[0].id), score / 2, places=2)
+
+    @override_settings(TRENDING_INDEX_SIZE=2)
+    def test_update_trims_index(self, *mocks):
+        index = TrendingIndex()
+        index.update()
+        index.record_many({self.images[0].id: 1, self.images[1].id: 3, self.images[2].id: 2}, 'view')
+        index.update()
+        self.assertEqual(self.redis.zcard(index.global_key), 2)
+        # Просмотры из БД (0, 10, 20) плюс новые - самое слабое изображение вытеснено
+        self.assertEqual(index.top(), [self.images[2].id, self.images[1].id])
+
+
+@mock.patch('image.duplicates.warm_up')
+@mock.patch('image.signals.SearchIndex')
+class DuplicateIndexTest(RedisTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, duplicates, '_index', None)
+        duplicates._index = None
+        owner = CustomUser.objects.create_user(username='owner', email='owner@example.com', password='pass')
+        category = Category.objects.create(name='nature')
+        self.images = [Image.objects.create(category=category, owner=owner, title=f'image {number}',
+                                            image='images/test.jpg', phash=phash)
+                       for number, phash in enumerate([None, 0b1111])]
+
+    def load_index(self):
+        # Фоновая загрузка закрывает соединение потока - в тесте загружаем в текущем
+        duplicates._index = duplicates.HammingIndex()
+        duplicates._index.load()
+
+    def test_exact_copies_are_found_while_index_loads(self, search_index, warm_up):
+        self.assertEqual(duplicates.find_duplicate(0b1111), self.images[1])
+        self.assertIsNone(duplicates.find_duplicate(0b1110))
+        warm_up.assert_called()
+
+        self.load_index()
+        self.assertEqual(duplicates.find_duplicate(0b1110), self.images[1])
+
+    def test_hashes_of_old_images_reload_index(self, search_index, warm_up):
+        self.load_index()
+        Image.objects.filter(id=self.images[0].id).update(phash=0b11110000)
+        # Догрузка берет только новые id - хеш старого изображения ждет полной загрузки
+        self.assertIsNone(duplicates.find_duplicate(0b11110000))
+        warm_up.assert_not_called()
+
+        duplicates.bump_version()
+        self.assertTrue(duplicates.get_index().is_stale())
+        warm_up.assert_called_once()
+        self.load_index()
+        self.assertEqual(duplicates.find_duplicate(0b11110000), self.images[0])
+
+
+@mock.patch('image.tasks.load_likes.delay')
+@mock.patch('image.duplicates.warm_up')
+@mock.patch('image.views.enqueue_tagging')
+@mock.patch('image.views.generate_thumbnail.delay')
+@mock.patch('image.views.generate_renditions.delay')
+@mock.patch('image.views.post_image.delay')
+@mock.patch('image.signals.SearchIndex')
+class DuplicateUploadTest(RedisTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        self.addCleanup(setattr, duplicates, '_index', None)
+        duplicates._index = None
+
+        self.user = CustomUser.objects.create_user(username='user', email='user@example.com', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name='nature')
+        self.original = Image.objects.create(category=category, owner=self.user, title='original',
+                                             image='images/original.jpg', phash=duplicates.dhash(self.file()))
+        self.original.tags.add('sky')
+        duplicates._index = duplicates.HammingIndex()
+        duplicates._index.load()
+
+    def file(self):
+        content = tempfile.SpooledTemporaryFile()
+        image = PiLImage.linear_gradient('L').convert('RGB')
+        image.save(content, format='JPEG')
+        content.seek(0)
+        return SimpleUploadedFile('copy.jpg', content.read(), content_type='image/jpeg')
+
+    def upload(self):
+        response = self.client.post('/images/', {'title': 'copy', 'slug': 'copy', 'category': 'nature',
+                                                   'image': self.file()},
+                                    format='multipart')
+        self.assertEqual(response.status_code, 201, response.data)
+        return Image.objects.get(title='copy')
+
+    def test_ready_renditions_are_reused(self, search_index, post_image, generate_renditions,
+                                         generate_thumbnail, enqueue_tagging, *mocks):
+        renditions = {'webp': {'236': 'images/original_236w.webp'}, 'avif': {}}
+        Image.objects.filter(id=self.original.id).update(renditions=renditions)
+
+        image = self.upload()
+        self.assertEqual(image.duplicate_of, self.original)
+        self.assertEqual(image.renditions, renditions)
+        self.assertEqual(list(image.tags.names()), ['sky'])
+        generate_thumbnail.assert_called_once_with(image.image.name)
+        generate_renditions.assert_not_called()
+        enqueue_tagging.assert_not_called()
+
+    def test_empty_renditions_are_generated(self, search_index, post_image, generate_renditions,
+                                            generate_thumbnail, enqueue_tagging, *mocks):
+        # Исходное меньше всех ширин: форматы есть, версий нет
+        Image.objects.filter(id=self.original.id).update(renditions={'webp': {}, 'avif': {}})
+
+        image = self.upload()
+        self.assertEqual(image.duplicate_of, self.original)
+        generate_renditions.assert_called_once_with(image.id, image.image.name)
+        generate_thumbnail.assert_not_called()
+
+
+class ImageSearchTest(RedisTestCase):
+    """Поиск через API: порядок по релевантности и переиндексация по сигналам"""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(SEARCH_INDEX_PATH=os.path.join(directory.name, 'search.sqlite3')))
+
+        self.owner = CustomUser.objects.create_user(username='owner', email='owner@example.com', password='pass')
+        self.category = Category.objects.create(name='nature')
+        self.client = APIClient()
+
+    def create(self, title, tags=(), views=0):
+        with self.captureOnCommitCallbacks(execute=True):
+            image = Image.objects.create(category=self.category, owner=self.owner, title=title,
+                                         image='images/test.jpg', views=views)
+            image.tags.add(*tags)
+        return image
+
+    def search(self, query):
+        response = self.client.get('/images/', {'search': query})
+        self.assertEqual(response.status_code, 200)
+        return [image['title'] for image in response.data['results']]
+
+    def test_title_match_ranks_above_tag_match(self):
+        # Без поиска порядок обратный - по дате создания
+        self.create('blue sky')
+        self.create('mountain lake', tags=['sky'])
+        self.assertEqual(self.search('sky'), ['blue sky', 'mountain lake'])
+
+    def test_popularity_boosts_equal_matches(self):
+        self.create('sunset one')
+        popular = self.create('sunset two')
+        self.assertEqual(self.search('sunset'), ['sunset one', 'sunset two'])
+
+        Image.objects.filter(id=popular.id).update(views=1000)
+        SearchIndex().update_popularity([popular.id])
+        self.assertEqual(self.search('sunset'), ['sunset two', 'sunset one'])
+
+    def test_tag_changes_are_reindexed(self):
+        image = self.create('mountain lake', tags=['sky'])
+        self.assertEqual(self.search('forest'), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            image.tags.remove('sky')
+            image.tags.add('forest')
+        self.assertEqual(self.search('sky'), [])
+        self.assertEqual(self.search('forest'), ['mountain lake'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            image.tags.clear()
+        self.assertEqual(self.search('forest'), [])
+
+
+@mock.patch('image.signals.SearchIndex')
+class TagFacetsTest(RedisTestCase):
+    """Счетчики тегов меняются только на теги, которые действительно были у изображения"""
+
+    def setUp(self):
+        super().setUp()
+        owner = CustomUser.objects.create_user(username='owner', email='owner@example.com', password='pass')
+        category = Category.objects.create(name='nature')
+        self.images = [Image.objects.create(category=category, owner=owner, title=f'image {number}',
+                                            image='images/test.jpg')
+                       for number in range(2)]
+        self.images[0].tags.add('sky')
+        self.images[1].tags.add('sky', 'forest')
+        self.facets = FacetCounts()
+        self.facets.rebuild()
+
+    def tag_counts(self):
+        return {tag['name']: tag['count'] for tag in self.facets.top()['tags']}
+
+    def test_removing_unattached_tag_keeps_counts(self, *mocks):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.images[0].tags.remove('sky', 'forest')
+        self.assertEqual(self.tag_counts(), {'sky': 1, 'forest': 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.images[1].tags.clear()
+        self.assertEqual(self.tag_counts(), {})
+
+    def test_remove_signal_with_unattached_tag_keeps_counts(self, *mocks):
+        # Другие менеджеры тегов могут передать в pk_set все запрошенные теги
+        pk_set = set(Tag.objects.values_list('id', flat=True))
+        with self.captureOnCommitCallbacks(execute=True):
+            for action in ('pre_remove', 'post_remove'):
+                m2m_changed.send(sender=Image.tags.through, instance=self.images[0], action=action,
+                                 reverse=False, model=Tag, pk_set=pk_set, using='default')
+        self.assertEqual(self.tag_counts(), {'sky': 1, 'forest': 1})
+
+
+@mock.patch('image.signals.SearchIndex')
+class PostNotificationsTest(RedisTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner = CustomUser.objects.create_user(username='owner', email='owner@example.com', password='pass')
+        self.image = Image.objects.create(category=Category.objects.create(name='nature'), owner=self.owner,
+                                          title='image', image='images/test.jpg')
+
+    def add_followers(self, count):
+        followers = [CustomUser.objects.create_user(username=f'follower{number}', password='pass',
+                                                    email=f'follower{number}@example.com')
+                     for number in range(count)]
+        Follow.objects.bulk_create([Follow(user_from=follower, user_to=self.owner) for follower in followers])
+        return [follower.id for follower in followers]
+
+    def split(self, chunk_size):
+        ranges = list(get_follower_ranges(self.owner.id, chunk_size))
+        chunks = [[user_id for user_id, _, _ in get_followers(self.owner.id, start, end)] for start, end in ranges]
+        return ranges, chunks
+
+    def test_follower_ranges_cover_followers_once(self, *mocks):
+        self.assertEqual(list(get_follower_ranges(self.owner.id, 2)), [(0, None)])
+
+        follower_ids = self.add_followers(5)
+        ranges, chunks = self.split(2)
+        self.assertEqual(chunks, [follower_ids[0:2], follower_ids[2:4], follower_ids[4:]])
+        self.assertIsNone(ranges[-1][1])
+        # Конец диапазона - начало следующего
+        self.assertEqual([end for _, end in ranges[:-1]], [start for start, _ in ranges[1:]])
+
+    def test_last_range_is_empty_for_full_chunks(self, *mocks):
+        follower_ids = self.add_followers(4)
+        _, chunks = self.split(2)
+        self.assertEqual(chunks, [follower_ids[0:2], follower_ids[2:4], []])
+
+    def test_retry_skips_notified_followers(self, *mocks):
+        self.add_followers(3)
+        followers = get_followers(self.owner.id, 0, None)
+        send_messages = EmailBackend.send_messages
+
+        def fail_second(backend, messages):
+            if len(mail.outbox) == 1:
+                raise SMTPException
+            return send_messages(backend, messages)
+
+        with mock.patch.object(EmailBackend, 'send_messages', fail_second):
+            with self.assertRaises(SMTPException):
+                send_post_notifications(self.image, followers)
+        self.assertEqual(len(mail.outbox), 1)
+
+        # Повтор задачи отправляет только оставшимся, следующий повтор - никому
+        self.assertEqual(send_post_notifications(self.image, followers), 2)
+        self.assertEqual(send_post_notifications(self.image, followers), 0)
+        self.assertCountEqual([message.to[0] for message in mail.outbox],
+                              [email for _, email, _ in followers])
+
+
+@mock.patch('image.signals.SearchIndex')
+class DigestBufferTest(RedisTestCase):
+
+    def setUp(self):
+        super().setUp()
+        owner = CustomUser.objects.create_user(username='owner', email='owner@example.com', password='pass')
+        category = Category.objects.create(name='nature')
+        self.images = [Image.objects.create(category=category, owner=owner, title=f'image {number}',
+                                            image='images/test.jpg')
+                       for number in range(3)]
+        self.instant = CustomUser.objects.create_user(username='instant', email='instant@example.com',
+                                                      password='pass')
+        self.digest = [CustomUser.objects.create_user(username=f'digest{number}', password='pass',
+                                                      email=f'digest{number}@example.com',
+                                                      notification_mode=CustomUser.NOTIFICATION_DIGEST)
+                       for number in range(2)]
+
+    def followers(self):
+        return [(user.id, user.email, user.notification_mode) for user in [self.instant, *self.digest]]
+
+    @override_settings(NOTIFICATION_DIGEST_MAX_IMAGES=2)
+    def test_buffer_keeps_latest_images(self, *mocks):
+        buffer = DigestBuffer()
+        for image in self.images:
+            buffer.append(image.id, [self.digest[0].id])
+        self.assertEqual(buffer.pop(10), {self.digest[0].id: [self.images[1].id, self.images[2].id]})
+        self.assertEqual(buffer.pop(10), {})
+
+    def test_digest_followers_are_buffered(self, *mocks):
+        self.assertEqual(send_post_notifications(self.images[0], self.followers()), 1)
+        self.assertEqual([message.to for message in mail.outbox], [[self.instant.email]])
+        # Повтор не добавляет изображение в буфер второй раз
+        send_post_notifications(self.images[0], self.followers())
+        self.assertEqual(DigestBuffer().pop(10), {user.id: [self.images[0].id] for user in self.digest})
+
+    def test_send_digests_sends_one_email_per_follower(self, *mocks):
+        for image in self.images[:2]:
+            send_post_notifications(image, self.followers())
+        mail.outbox.clear()
+
+        self.assertEqual(send_digests(batch_size=1), 2)
+        self.assertCountEqual([message.to[0] for message in mail.outbox], [user.email for user in self.digest])
+        for message in mail.outbox:
+            self.assertIn(self.images[0].title, message.body)
+            self.assertIn(self.images[1].title, message.body)
+        self.assertEqual(send_digests(batch_size=1), 0)
+
+    def test_failed_digest_is_pushed_back(self, *mocks):
+        send_post_notifications(self.images[0], self.followers())
+        mail.outbox.clear()
+
+        with mock.patch.object(EmailBackend, 'send_messages', side_effect=SMTPException):
+            with self.assertRaises(SMTPException):
+                send_digests(batch_size=10)
+        self.assertEqual(mail.outbox, [])
+
+        self.assertEqual(send_digests(batch_size=10), 2)
+        self.assertEqual(len(mail.outbox), 2)
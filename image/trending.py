@@ -0,0 +1,169 @@
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count
+from django.utils.timezone import now
+from django_redis import get_redis_connection
+from taggit.models import TaggedItem
+
+from image.models import Image
+
+
+class TrendingIndex:
+    """
+    Индекс трендовых изображений в Redis sorted set'ах: общий, по категориям и по тегам.
+    Score - сумма весов событий (просмотр, лайк, комментарий) с экспоненциальным затуханием:
+    при каждом обновлении все score умножаются на 2^(-dt / TRENDING_HALF_LIFE).
+    События копятся в hash и переносятся в индекс периодической задачей.
+    """
+    pending_key = 'trending:pending'
+    keys_key = 'trending:keys'
+    updated_key = 'trending:updated'
+    global_key = 'trending:global'
+    min_score = 0.01
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
+        self.half_life = settings.TRENDING_HALF_LIFE.total_seconds()
+        self.weights = settings.TRENDING_WEIGHTS
+        self.size = settings.TRENDING_INDEX_SIZE
+
+    def get_category_key(self, category_id):
+        return f'trending:category:{category_id}'
+
+    def get_tag_key(self, tag_id):
+        return f'trending:tag:{tag_id}'
+
+    def record(self, image_id, event, count=1):
+        """Запоминает событие: event - 'view', 'like' или 'comment'"""
+        self.redis.hincrbyfloat(self.pending_key, image_id, self.weights[event] * count)
+
+    def record_many(self, counts, event):
+        """counts - словарь {id изображения: количество событий}"""
+        with self.redis.pipeline(transaction=False) as pipe:
+            for image_id, count in counts.items():
+                pipe.hincrbyfloat(self.pending_key, image_id, self.weights[event] * count)
+            pipe.execute()
+
+    def top(self, limit=20, category_id=None, tag_id=None):
+        """Id самых трендовых изображений"""
+        if tag_id is not None:
+            key = self.get_tag_key(tag_id)
+        elif category_id is not None:
+            key = self.get_category_key(category_id)
+        else:
+            key = self.global_key
+        return [int(image_id) for image_id in self.redis.zrevrange(key, 0, limit - 1)]
+
+    def remove(self, image_id, category_id, tag_ids=()):
+        """Убирает изображение из общего индекса, индекса категории и индексов тегов"""
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zrem(self.global_key, image_id)
+            pipe.zrem(self.get_category_key(category_id), image_id)
+            for tag_id in tag_ids:
+                pipe.zrem(self.get_tag_key(tag_id), image_id)
+            pipe.execute()
+
+    def remove_tags(self, image_id, tag_ids):
+        """Убирает изображение из индексов снятых с него тегов"""
+        if not tag_ids:
+            return
+        with self.redis.pipeline(transaction=False) as pipe:
+            for tag_id in tag_ids:
+                pipe.zrem(self.get_tag_key(tag_id), image_id)
+            pipe.execute()
+
+    def update(self):
+        """Применяет затухание и добавляет накопленные события"""
+        if not self.redis.exists(self.updated_key):
+            return self.rebuild()
+
+        timestamp = time.time()
+        last_update = float(self.redis.get(self.updated_key))
+        factor = 0.5 ** ((timestamp - last_update) / self.half_life)
+
+        with self.redis.pipeline() as pipe:
+            pipe.hgetall(self.pending_key)
+            pipe.delete(self.pending_key)
+            pending, _ = pipe.execute()
+
+        keys = self.redis.smembers(self.keys_key)
+        with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.zunionstore(key, {key: factor})
+            pipe.execute()
+
+        scores = {int(image_id): float(score) for image_id, score in pending.items()}
+        self._add(scores)
+        self._trim(keys)
+        self.redis.set(self.updated_key, timestamp)
+        return len(scores)
+
+    def rebuild(self):
+        """Заполняет индекс по данным БД: просмотры, лайки и комментарии за последнее время"""
+        timestamp = time.time()
+        window_start = now() - timedelta(seconds=self.half_life * 8)
+        images = Image.objects.filter(created__gte=window_start) \
+            .annotate(comments_count=Count('comments')) \
+            .values_list('id', 'created', 'views', 'total_likes', 'comments_count')
+
+        scores = {}
+        today = now().date()
+        for image_id, created, views, total_likes, comments_count in images.iterator():
+            age = (today - created).total_seconds()
+            score = (views * self.weights['view']
+                     + total_likes * self.weights['like']
+                     + comments_count * self.weights['comment'])
+            scores[image_id] = score * 0.5 ** (age / self.half_life)
+
+        keys = self.redis.smembers(self.keys_key)
+        with self.redis.pipeline() as pipe:
+            for key in keys:
+                pipe.delete(key)
+            pipe.delete(self.keys_key, self.pending_key)
+            pipe.execute()
+
+        self._add(scores)
+        self._trim(self.redis.smembers(self.keys_key))
+        self.redis.set(self.updated_key, timestamp)
+        return len(scores)
+
+    def _add(self, scores):
+        if not scores:
+            return
+        image_ct = ContentType.objects.get_for_model(Image)
+        categories = dict(Image.objects.filter(id__in=list(scores)).values_list('id', 'category_id'))
+        tags = defaultdict(list)
+        for image_id, tag_id in TaggedItem.objects.filter(content_type=image_ct, object_id__in=list(scores)) \
+                .values_list('object_id', 'tag_id'):
+            tags[image_id].append(tag_id)
+
+        with self.redis.pipeline(transaction=False) as pipe:
+            for image_id, score in scores.items():
+                # Удаленные изображения пропускаем
+                if image_id not in categories:
+                    continue
+                keys = [self.global_key, self.get_category_key(categories[image_id])]
+                keys += [self.get_tag_key(tag_id) for tag_id in tags[image_id]]
+                for key in keys:
+                    pipe.zincrby(key, score, image_id)
+                pipe.sadd(self.keys_key, *keys)
+            pipe.execute()
+
+    def _trim(self, keys):
+        """Убирает затухшие записи и ограничивает размер индексов"""
+        keys = list(keys)
+        with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.zremrangebyscore(key, '-inf', self.min_score)
+                pipe.zremrangebyrank(key, 0, -self.size - 1)
+                pipe.exists(key)
+            results = pipe.execute()
+
+        # Опустевшие индексы (например, редких тегов) больше не отслеживаем
+        empty = [key for key, exists in zip(keys, results[2::3]) if not exists]
+        if empty:
+            self.redis.srem(self.keys_key, *empty)
@@ -1,34 +1,47 @@
-from datetime import timedelta
-
-from django.core.cache import cache
-from django.db.models import When, Case, Value, IntegerField
+from django.conf import settings
+from django.db.models import When, Case, Count, Q, Value, IntegerField
 from django.shortcuts import get_object_or_404
-from django.utils.timezone import now
 from rest_framework.response import Response
 from rest_framework import viewsets, mixins
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.filters import OrderingFilter
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly, AllowAny
 from django_filters.rest_framework import DjangoFilterBackend
+from taggit.models import Tag
 from action.utils import create_action
+from pinterest.pagination import KeysetPagination
+from user.models import Follow
 from user.serializers import CustomUserSerializer
 from .count_views import CountViewsImage
+from .duplicates import dhash, find_duplicate
+from .facets import FacetCounts, filtered_facets
 from .favourites import FavoriteSessionManager
+from .likes import LikeStore
 from .permissions  import IsOwnerOrReadOnly
+from .similarity import get_index as get_similarity_index
 from .models import *
 from .serializers import *
-from .tasks import post_image, generate_thumbnail, generate_image_tags
-from .filters import ImageFilter
+from .trending import TrendingIndex
+from .tagging import bulk_add_tags, enqueue_tagging
+from .tasks import post_image, generate_renditions, generate_thumbnail
+from .filters import ImageFilter, ImageSearchFilter
 
 
 class ImageViewSet(viewsets.ModelViewSet):
 
     queryset = Image.objects.all()
     permission_classes = [IsAuthenticatedOrReadOnly, IsOwnerOrReadOnly]
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, ImageSearchFilter, OrderingFilter]
     filterset_class = ImageFilter
-    search_fields = ['title', 'category__name', 'tags__name', 'owner__username']
     ordering_fields = ['created', 'updated', 'total_likes']
+    pagination_class = KeysetPagination
+
+    @property
+    def cursor_ordering(self):
+        """Результаты поиска по умолчанию идут по релевантности"""
+        if ImageSearchFilter().get_search_terms(self.request):
+            return 'search_rank'
+        return '-created'
 
 
     def get_serializer_class(self):
@@ -39,7 +52,7 @@ class ImageViewSet(viewsets.ModelViewSet):
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
         count = CountViewsImage()
-        views = count.incr(instance.id)
+        views = count.incr(instance.id, base=instance.views)
         serializer = self.get_serializer(instance,
                                          context={
                                              'request': request,
@@ -48,38 +61,134 @@ class ImageViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
     def perform_create(self, serializer):
-        instance = serializer.save(owner=self.request.user)
+        phash = self._get_phash(serializer.validated_data['image'])
+        duplicate = find_duplicate(phash) if phash is not None else None
+        instance = serializer.save(owner=self.request.user, phash=phash, duplicate_of=duplicate)
         create_action(self.request.user, 'posted', target=instance)
         post_image.delay(instance.id, self.request.user.id)
+
+        if duplicate and settings.DUPLICATE_REUSE and any(duplicate.renditions.values()):
+            # Повторная загрузка: берем готовые версии и теги исходного изображения.
+            # Пока версии исходного не готовы, создаем свои
+            self._reuse_duplicate(instance, duplicate)
+            return
+
+        generate_renditions.delay(instance.id, instance.image.name)
+        if not instance.tags.exists():
+            enqueue_tagging(instance.id, instance.image.name)
+
+    def _get_phash(self, image_file):
+        try:
+            return dhash(image_file)
+        except OSError:
+            return None
+        finally:
+            image_file.seek(0)
+
+    def _reuse_duplicate(self, instance, duplicate):
+        Image.objects.filter(id=instance.id).update(renditions=duplicate.renditions)
+        instance.renditions = duplicate.renditions
+        # Миниатюра строится по имени файла изображения, поэтому у каждого своя
         generate_thumbnail.delay(instance.image.name)
         if not instance.tags.exists():
-            generate_image_tags.delay(instance.id, instance.image.name)
+            tags = list(duplicate.tags.names())
+            if tags:
+                bulk_add_tags({instance.id: tags})
+            else:
+                enqueue_tagging(instance.id, instance.image.name)
 
     @action(methods=['get'],
             detail=False)
     def most_popular(self, request):
-        """Самые популярные изображения выложенные за последние 2 недели"""
-        two_week_ago = now() - timedelta(weeks=2)
-        images = cache.get('most_popular_images')
-        if not images:
-            images = Image.objects.filter(created__gt=two_week_ago
-                                     ).order_by('-views')[:20]
-            cache.set('most_popular_images', images, 15*60)
+        """
+        Трендовые изображения: просмотры, лайки и комментарии с затуханием по времени.
+        Можно ограничить категорией (?category=) или тегом (?tag=)
+        """
+        category_id = tag_id = None
+        if 'category' in request.query_params:
+            category_id = Category.objects.filter(name__iexact=request.query_params['category']) \
+                .values_list('id', flat=True).first()
+            if category_id is None:
+                return Response([])
+        if 'tag' in request.query_params:
+            tag_id = Tag.objects.filter(name=request.query_params['tag']) \
+                .values_list('id', flat=True).first()
+            if tag_id is None:
+                return Response([])
+
+        image_ids = TrendingIndex().top(20, category_id=category_id, tag_id=tag_id)
+        images = Image.objects.in_bulk(image_ids)
+        images = [images[image_id] for image_id in image_ids if image_id in images]
+        serializers = ImageSerializer(images, many=True, context={'request': request})
+        return Response(serializers.data)
+
+    @action(methods=['get'],
+            detail=True)
+    def similar(self, request, pk):
+        """Визуально похожие изображения по эмбеддингам модели"""
+        image = get_object_or_404(Image, id=pk)
+        matches = get_similarity_index().similar(image.id, settings.SIMILAR_LIMIT)
+        image_ids = [image_id for _, image_id in matches]
+        images = Image.objects.in_bulk(image_ids)
+        images = [images[image_id] for image_id in image_ids if image_id in images]
         serializers = ImageSerializer(images, many=True, context={'request': request})
         return Response(serializers.data)
 
+    @action(methods=['get'],
+            detail=True)
+    def duplicates(self, request, pk):
+        """Кластер дубликатов изображения: исходное изображение и его повторные загрузки"""
+        image = get_object_or_404(Image, id=pk)
+        original_id = image.duplicate_of_id or image.id
+        images = Image.objects.filter(Q(id=original_id) | Q(duplicate_of_id=original_id))
+        page = self.paginate_queryset(images)
+        serializers = ImageSerializer(page, many=True, context={'request': request})
+        return self.get_paginated_response(serializers.data)
+
+    @action(methods=['get'],
+            detail=False)
+    def facets(self, request):
+        """
+        Количество изображений по тегам и категориям для фильтров.
+        Без фильтров и поиска берутся готовые счетчики, иначе считаются по отфильтрованным изображениям
+        """
+        try:
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), 100)
+        except ValueError:
+            limit = 20
+
+        filterset = ImageFilter(request.query_params, queryset=self.get_queryset(), request=request)
+        if not filterset.form.has_changed() and not ImageSearchFilter().get_search_terms(request):
+            return Response(FacetCounts().top(limit))
+        return Response(filtered_facets(self.filter_queryset(self.get_queryset()), limit))
+
+    @action(methods=['get'],
+            detail=False)
+    def duplicate_clusters(self, request):
+        """Изображения, у которых есть дубликаты, с количеством дубликатов"""
+        images = Image.objects.annotate(duplicates_count=Count('duplicates')) \
+            .filter(duplicates_count__gt=0)
+        page = self.paginate_queryset(images)
+        serializers = ImageSerializer(page, many=True, context={'request': request})
+        for data, image in zip(serializers.data, page):
+            data['duplicates_count'] = image.duplicates_count
+        return self.get_paginated_response(serializers.data)
+
     @action(methods=['post', 'delete'],
             detail=True,
             permission_classes=[IsAuthenticated])
     def like(self, request, pk):
         """Добавление или удаления лайка у изображения"""
         image = get_object_or_404(Image, id=pk)
+        likes = LikeStore()
         if request.method == 'POST':
-            image.users_like.add(request.user)
-            create_action(request.user, 'liked', target=image)
+            if likes.add(image.id, request.user.id):
+                TrendingIndex().record(image.id, 'like')
+                create_action(request.user, 'liked', target=image)
             return Response({'detail': 'like добавлен'})
         else:
-            image.users_like.remove(request.user)
+            if likes.remove(image.id, request.user.id):
+                TrendingIndex().record(image.id, 'like', -1)
             return Response({'detail': 'like удален'})
 
     @action(methods=['get'],
@@ -87,18 +196,18 @@ class ImageViewSet(viewsets.ModelViewSet):
     def users_like(self, request, pk):
         """Список пользователей, которым понравилось изображение"""
         image = get_object_or_404(Image, id=pk)
-        users_like = image.users_like.all()
-
-        followings_ids = request.user.following.values_list('id', flat=True)
+        users_like = image.users_like.order_by('username')
 
         #Сортируем: сначала те, на кого подписан текущий пользователь
-        users_like = users_like.annotate(
-            is_following=Case(
-                When(id__in=followings_ids, then=Value(1)),
-                default=Value(0),
-                output_field=IntegerField()
-            )
-        ).order_by('-is_following', 'username')
+        if request.user.is_authenticated:
+            followings_ids = Follow.objects.filter(user_from=request.user).values('user_to_id')
+            users_like = users_like.annotate(
+                is_following=Case(
+                    When(id__in=followings_ids, then=Value(1)),
+                    default=Value(0),
+                    output_field=IntegerField()
+                )
+            ).order_by('-is_following', 'username')
 
         serializers = CustomUserSerializer(users_like, many=True, context={'request': request})
         return Response(serializers.data)
@@ -107,8 +216,7 @@ class ImageViewSet(viewsets.ModelViewSet):
             detail=False)
     def favorites(self, request):
         """Список избранных изображений"""
-        session_manager = FavoriteSessionManager(request)
-        favorites = set(session_manager.get_favorites())
+        favorites = FavoriteSessionManager(request).get_favorites()
 
         images = Image.objects.filter(id__in=favorites)
         serializers =  ImageSerializer(images, many=True, context={'request': request})
@@ -120,12 +228,13 @@ class ImageViewSet(viewsets.ModelViewSet):
             permission_classes = [AllowAny])
     def favorite(self, request, pk):
         """Добавление или удаление изображения из списка избранных"""
+        image = get_object_or_404(Image, id=pk)
         session_manager = FavoriteSessionManager(request)
         if request.method == 'POST':
-            session_manager.add_favorite(pk)
+            session_manager.add_favorite(image.id)
             return Response({'detail': 'изображение добавлено'})
         else:
-            session_manager.remove_favorite(pk)
+            session_manager.remove_favorite(image.id)
             return Response({'detail': 'изображение удалено'})
 
 
@@ -143,6 +252,7 @@ class CommentViewSet(mixins.CreateModelMixin,
     def perform_create(self, serializer):
         image = get_object_or_404(Image, id=self.kwargs['image_pk'])
         instance = serializer.save(owner=self.request.user, image=image)
+        TrendingIndex().record(image.id, 'comment')
         create_action(self.request.user, 'commented', target=instance)
 
 
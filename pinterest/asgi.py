@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pinterest.settings')
 
 application = get_asgi_application()
+
+# Индекс дубликатов загружается в фоне при старте процесса, а не в первом запросе загрузки
+from image.duplicates import warm_up  # noqa: E402
+
+warm_up()
@@ -0,0 +1,212 @@
+import base64
+import binascii
+import json
+from collections import OrderedDict
+from datetime import date, datetime
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) пагинация.
+    Страница выбирается условием WHERE по (поле сортировки, id) последнего элемента,
+    поэтому глубина прокрутки не влияет на скорость, а COUNT(*) не выполняется.
+
+    Сортировка берется из параметра ?ordering= (как у OrderingFilter), допустимые поля
+    берутся из view.ordering_fields, по умолчанию - view.cursor_ordering.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    ordering_query_param = api_settings.ORDERING_PARAM
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 100
+    default_ordering = '-created'
+    invalid_cursor_message = 'Неверный курсор.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request, view, queryset)
+        self.fields = self.get_fields(self.ordering)
+
+        cursor = self.decode_cursor(request)
+        reverse = bool(cursor and cursor['r'])
+
+        queryset = queryset.order_by(*self._order_by(reverse))
+        if cursor:
+            try:
+                queryset = queryset.filter(self._after(cursor['p'], reverse))
+            except (DjangoValidationError, ValueError, TypeError):
+                # Значение позиции не приводится к типу поля
+                raise NotFound(self.invalid_cursor_message)
+
+        # Берем на один элемент больше, чтобы понять, есть ли следующая страница
+        results = list(queryset[:self.page_size + 1])
+        has_extra = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        if reverse:
+            self.has_next, self.has_previous = True, has_extra
+        else:
+            self.has_next, self.has_previous = has_extra, cursor is not None
+
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Курсор страницы.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Количество элементов на странице.',
+                'schema': {'type': 'integer'},
+            },
+        ]
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_ordering(self, request, view, queryset=None):
+        """Возвращает сортировку вида '-created', если она поддерживается view и queryset"""
+        default = getattr(view, 'cursor_ordering', self.default_ordering)
+        allowed = getattr(view, 'ordering_fields', None) or [default.lstrip('-')]
+
+        ordering = request.query_params.get(self.ordering_query_param, '')
+        ordering = ordering.split(',')[0].strip()
+        if ordering.lstrip('-') not in allowed:
+            ordering = default
+        # Сортировка по аннотации (например, search_rank) возможна, только если queryset ее получил:
+        # дополнительные действия view могут пагинировать другие querysets
+        if queryset is not None and not self.has_field(queryset, ordering.lstrip('-')):
+            return self.default_ordering
+        return ordering
+
+    def has_field(self, queryset, field):
+        if field in queryset.query.annotations or field == 'pk':
+            return True
+        try:
+            queryset.model._meta.get_field(field)
+        except FieldDoesNotExist:
+            return False
+        return True
+
+    def get_fields(self, ordering):
+        """Список (поле, по убыванию) - поле сортировки и id для однозначности"""
+        descending = ordering.startswith('-')
+        field = ordering.lstrip('-')
+        if field in ('id', 'pk'):
+            return [('id', descending)]
+        return [(field, descending), ('id', descending)]
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.build_link(self.get_position(self.page[-1]), reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.build_link(self.get_position(self.page[0]), reverse=True)
+
+    def get_position(self, item):
+        position = []
+        for field, _ in self.fields:
+            value = getattr(item, field)
+            if isinstance(value, (date, datetime)):
+                value = value.isoformat()
+            position.append(value)
+        return position
+
+    def build_link(self, position, reverse=False):
+        url = self.request.build_absolute_uri()
+        cursor = self.encode_cursor(position, self.ordering, reverse)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def encode_cursor(self, position, ordering, reverse=False):
+        payload = json.dumps({'o': ordering, 'p': position, 'r': int(reverse)},
+                             separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            cursor = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+        # Курсор мог быть собран вручную - проверяем структуру, а не только кодировку
+        if (not isinstance(cursor, dict) or cursor.get('r') not in (0, 1)
+                or not isinstance(cursor.get('p'), list)
+                or not all(isinstance(value, (str, int, float)) for value in cursor['p'])):
+            raise NotFound(self.invalid_cursor_message)
+
+        # Курсор от другой сортировки не подходит
+        if cursor.get('o') != self.ordering or len(cursor['p']) != len(self.fields):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def _order_by(self, reverse):
+        order_by = []
+        for field, descending in self.fields:
+            if descending != reverse:
+                order_by.append(f'-{field}')
+            else:
+                order_by.append(field)
+        return order_by
+
+    def _after(self, position, reverse):
+        """
+        Условие "строго после позиции" в порядке сортировки:
+        (a < va) OR (a = va AND id < vid)
+        """
+        condition = Q()
+        equal = Q()
+        for (field, descending), value in zip(self.fields, position):
+            lookup = 'lt' if descending != reverse else 'gt'
+            condition |= equal & Q(**{f'{field}__{lookup}': value})
+            equal &= Q(**{field: value})
+        return condition
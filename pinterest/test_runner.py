@@ -0,0 +1,21 @@
+import os
+import tempfile
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    """Индекс поиска в тестах пишется во временный каталог, а не в рабочий файл проекта"""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.search_dir = tempfile.TemporaryDirectory()
+        self.search_settings = override_settings(
+            SEARCH_INDEX_PATH=os.path.join(self.search_dir.name, 'search.sqlite3'))
+        self.search_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.search_settings.disable()
+        self.search_dir.cleanup()
+        super().teardown_test_environment(**kwargs)
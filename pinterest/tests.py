@@ -0,0 +1,84 @@
+import base64
+import json
+from datetime import timedelta
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from action.models import Action
+from user.models import CustomUser
+from .pagination import KeysetPagination
+
+
+class KeysetPaginationTest(TestCase):
+    """Обход страниц по курсорам и разбор некорректных курсоров"""
+
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        user = CustomUser.objects.create_user(username='user', email='user@example.com', password='pass')
+        now = timezone.now()
+        # По два действия на одну метку времени - порядок внутри определяет id
+        Action.objects.bulk_create([
+            Action(user=user, verb='posted', created=now - timedelta(minutes=number // 2))
+            for number in range(7)
+        ])
+        self.expected = list(Action.objects.order_by('-created', '-id').values_list('id', flat=True))
+
+    def paginate(self, view=None, **params):
+        request = Request(self.factory.get('/actions/', {'limit': 3, **params}))
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(Action.objects.all(), request, view)
+        return [action.id for action in page], paginator
+
+    def get_cursor(self, link):
+        return parse_qs(urlparse(link).query)['cursor'][0]
+
+    def encode(self, payload):
+        return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+    def test_pages_cover_queryset_without_gaps(self):
+        ids, paginator = self.paginate()
+        collected = ids
+        self.assertIsNone(paginator.get_previous_link())
+        while paginator.get_next_link():
+            ids, paginator = self.paginate(cursor=self.get_cursor(paginator.get_next_link()))
+            collected += ids
+        self.assertEqual(collected, self.expected)
+
+    def test_previous_link_returns_previous_page(self):
+        first_page, paginator = self.paginate()
+        second_page, paginator = self.paginate(cursor=self.get_cursor(paginator.get_next_link()))
+        self.assertEqual(second_page, self.expected[3:6])
+
+        previous_page, paginator = self.paginate(cursor=self.get_cursor(paginator.get_previous_link()))
+        self.assertEqual(previous_page, first_page)
+        self.assertIsNone(paginator.get_previous_link())
+
+    def test_invalid_cursors_are_not_found(self):
+        now = timezone.now().isoformat()
+        cursors = [
+            'not-base64!',
+            base64.urlsafe_b64encode(b'\xff\xfe').decode(),
+            self.encode([now, 1]),
+            self.encode({'o': '-created', 'p': [now, 1]}),
+            self.encode({'o': '-created', 'p': now, 'r': 0}),
+            self.encode({'o': '-created', 'p': [[now], 1], 'r': 0}),
+            self.encode({'o': '-created', 'p': [now], 'r': 0}),
+            self.encode({'o': 'id', 'p': [now, 1], 'r': 0}),
+            self.encode({'o': '-created', 'p': ['yesterday', 1], 'r': 0}),
+        ]
+        for cursor in cursors:
+            with self.subTest(cursor=cursor), self.assertRaises(NotFound):
+                self.paginate(cursor=cursor)
+
+    def test_missing_annotation_falls_back_to_default_ordering(self):
+        # Например, ?search= у действия view, queryset которого не проходил поиск
+        view = mock.Mock(cursor_ordering='search_rank', ordering_fields=None)
+        ids, paginator = self.paginate(view=view)
+        self.assertEqual(paginator.ordering, '-created')
+        self.assertEqual(ids, self.expected[:3])
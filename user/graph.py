@@ -0,0 +1,83 @@
+from django_redis import get_redis_connection
+
+from user.models import Follow
+
+
+class SocialGraph:
+    """
+    Подписки в Redis: для каждого пользователя set'ы id подписчиков и подписок,
+    загруженные из БД при первом обращении (маркер 0 означает, что set загружен).
+    Обновляются сигналами сохранения и удаления Follow (user/signals.py).
+    Количество подписчиков и подписок хранится в ProfileStats, а не здесь.
+    """
+    loaded_marker = 0
+    ttl = 24 * 60 * 60
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
+
+    def get_followers_key(self, user_id):
+        return f'user:{user_id}:followers'
+
+    def get_followings_key(self, user_id):
+        return f'user:{user_id}:followings'
+
+    def follow(self, user_id, target_id):
+        self._change(user_id, target_id, 'sadd')
+
+    def unfollow(self, user_id, target_id):
+        self._change(user_id, target_id, 'srem')
+
+    def is_following(self, user_id, target_id):
+        return target_id in self.following_ids(user_id, [target_id])
+
+    def following_ids(self, user_id, target_ids):
+        """Id из target_ids, на которых подписан пользователь - один pipeline на страницу"""
+        target_ids = list(target_ids)
+        key = self.get_followings_key(user_id)
+        self._ensure_loaded([key])
+        with self.redis.pipeline(transaction=False) as pipe:
+            for target_id in target_ids:
+                pipe.sismember(key, target_id)
+            results = pipe.execute()
+        return {target_id for target_id, following in zip(target_ids, results) if following}
+
+    def is_mutual(self, user_id, other_id):
+        """Подписаны ли пользователи друг на друга"""
+        followings_key, followers_key = self.get_followings_key(user_id), self.get_followers_key(user_id)
+        self._ensure_loaded([followings_key, followers_key])
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.sismember(followings_key, other_id)
+            pipe.sismember(followers_key, other_id)
+            return all(pipe.execute())
+
+    def _change(self, user_id, target_id, command):
+        # Незагруженный set без маркера при чтении дозагрузится из БД
+        followings_key, followers_key = self.get_followings_key(user_id), self.get_followers_key(target_id)
+        with self.redis.pipeline(transaction=False) as pipe:
+            getattr(pipe, command)(followings_key, target_id)
+            getattr(pipe, command)(followers_key, user_id)
+            pipe.expire(followings_key, self.ttl)
+            pipe.expire(followers_key, self.ttl)
+            pipe.execute()
+
+    def _ensure_loaded(self, keys):
+        """Загружает из БД set'ы без маркера"""
+        with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.sismember(key, self.loaded_marker)
+            results = pipe.execute()
+
+        for key, loaded in zip(keys, results):
+            if not loaded:
+                user_ids = self._load(key)
+                with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.sadd(key, self.loaded_marker, *user_ids)
+                    pipe.expire(key, self.ttl)
+                    pipe.execute()
+
+    def _load(self, key):
+        _, user_id, kind = key.split(':')
+        if kind == 'followers':
+            return Follow.objects.filter(user_to_id=user_id).order_by().values_list('user_from_id', flat=True)
+        return Follow.objects.filter(user_from_id=user_id).order_by().values_list('user_to_id', flat=True)
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.17 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0007_alter_customuser_photo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='notification_mode',
+            field=models.CharField(choices=[('instant', 'Письмо о каждом посте'), ('digest', 'Дайджест')], default='instant', max_length=10),
+        ),
+    ]
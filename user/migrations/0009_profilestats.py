@@ -0,0 +1,26 @@
+# Generated by Django 4.2.17 on 2026-10-18 12:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0008_customuser_notification_mode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('total_views', models.BigIntegerField(default=0)),
+                ('total_likes', models.BigIntegerField(default=0)),
+                ('followers_count', models.IntegerField(default=0)),
+                ('followings_count', models.IntegerField(default=0)),
+                ('images_count', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
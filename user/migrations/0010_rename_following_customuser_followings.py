@@ -0,0 +1,18 @@
+# Generated by Django 4.2.17 on 2026-10-18 08:30
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0009_profilestats'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='customuser',
+            old_name='following',
+            new_name='followings',
+        ),
+    ]
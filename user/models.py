@@ -6,6 +6,13 @@ from django.urls import reverse
 
 
 class CustomUser(AbstractUser):
+    NOTIFICATION_INSTANT = 'instant'
+    NOTIFICATION_DIGEST = 'digest'
+    NOTIFICATION_MODES = [
+        (NOTIFICATION_INSTANT, 'Письмо о каждом посте'),
+        (NOTIFICATION_DIGEST, 'Дайджест'),
+    ]
+
     email = models.EmailField(max_length=255, unique=True)
     date_of_birth = models.DateField(blank=True, null=True)
     photo = models.ImageField(upload_to='users/%Y/%m/%d',
@@ -16,6 +23,9 @@ class CustomUser(AbstractUser):
                                        symmetrical=False,
                                        blank=True)
     is_open_liked_images = models.BooleanField(default=False)
+    notification_mode = models.CharField(max_length=10,
+                                         choices=NOTIFICATION_MODES,
+                                         default=NOTIFICATION_INSTANT)
 
     def get_absolute_url(self):
         return reverse('customuser-detail', args=[self.id])
@@ -30,4 +40,23 @@ class Follow(models.Model):
         ordering = ['-created']
 
     def __str__(self):
-        return f'{self.user_from} follows {self.user_to}'
\ No newline at end of file
+        return f'{self.user_from} follows {self.user_to}'
+
+
+class ProfileStats(models.Model):
+    """
+    Счетчики профиля пользователя. Меняются инкрементально там же, где счетчики изображений
+    и подписки, периодическая задача сверяет их с БД
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL,
+                                primary_key=True,
+                                related_name='stats',
+                                on_delete=models.CASCADE)
+    total_views = models.BigIntegerField(default=0)
+    total_likes = models.BigIntegerField(default=0)
+    followers_count = models.IntegerField(default=0)
+    followings_count = models.IntegerField(default=0)
+    images_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'Stats of {self.user_id}'
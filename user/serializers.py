@@ -1,8 +1,14 @@
+from django.conf import settings
 from djoser.serializers import UserCreateSerializer
 from rest_framework import serializers
-from .models import CustomUser
+from rest_framework.reverse import reverse
+from rest_framework.utils.urls import replace_query_param
+from .models import CustomUser, ProfileStats
+from image.relations import get_relations
 from image.serializers import ImageSerializer
+from pinterest.pagination import KeysetPagination
 from .common_serializers import CustomUserSerializer
+from .stats import get_stats
 
 
 class CustomUserCreateSerializer(UserCreateSerializer):
@@ -24,18 +30,26 @@ class CustomUserCreateSerializer(UserCreateSerializer):
         return value
 
 
+class ProfileStatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ProfileStats
+        exclude = ('user', )
+
+
 class CustomDetailUserSerializer(serializers.ModelSerializer):
-    images = ImageSerializer(many=True, read_only=True)
+    images = serializers.SerializerMethodField()
+    images_next = serializers.SerializerMethodField()
     is_following = serializers.SerializerMethodField()
     images_views = serializers.SerializerMethodField()
+    stats = serializers.SerializerMethodField()
 
     class Meta:
         model = CustomUser
         fields = (
             'id', 'username', 'email',
             'date_of_birth', 'photo',
-            'is_open_liked_images', 'is_following',
-            'images_views', 'images',
+            'is_open_liked_images', 'notification_mode', 'is_following',
+            'images_views', 'stats', 'images', 'images_next',
         )
 
         read_only_fields = ('email', 'username')
@@ -43,13 +57,38 @@ class CustomDetailUserSerializer(serializers.ModelSerializer):
 
     def get_is_following(self, obj):
         request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            return request.user.following.filter(id=obj.id).exists()
-        return False
+        return bool(request) and get_relations(request).is_following(obj.id)
+
+    def get_images(self, obj):
+        """Первая страница изображений, остальные - по ссылке images_next"""
+        images = self._get_first_images(obj)[:settings.USER_IMAGES_PREVIEW_SIZE]
+        return ImageSerializer(images, many=True, context=self.context).data
+
+    def get_images_next(self, obj):
+        images = self._get_first_images(obj)
+        if len(images) <= settings.USER_IMAGES_PREVIEW_SIZE:
+            return None
+        paginator = KeysetPagination()
+        paginator.fields = paginator.get_fields(paginator.default_ordering)
+        position = paginator.get_position(images[settings.USER_IMAGES_PREVIEW_SIZE - 1])
+        url = reverse('customuser-images', args=[obj.id], request=self.context.get('request'))
+        return replace_query_param(url, paginator.cursor_query_param,
+                                   paginator.encode_cursor(position, paginator.default_ordering))
+
+    def _get_first_images(self, obj):
+        """Загружаем на одно изображение больше первой страницы, чтобы понять, есть ли следующая"""
+        if not hasattr(obj, '_first_images'):
+            obj._first_images = list(
+                obj.images.select_related('owner', 'category').prefetch_related('tags')
+                .order_by('-created', '-id')[:settings.USER_IMAGES_PREVIEW_SIZE + 1]
+            )
+        return obj._first_images
 
     def get_images_views(self, obj):
-        # Получаем количество просмотров из контекста
-        return self.context.get('images_views', 0)
+        return get_stats(obj).total_views
+
+    def get_stats(self, obj):
+        return ProfileStatsSerializer(get_stats(obj)).data
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
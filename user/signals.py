@@ -0,0 +1,27 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .graph import SocialGraph
+from .models import Follow
+from .stats import change_stats
+
+
+@receiver(post_save, sender=Follow)
+def add_follow_to_graph(sender, instance, created, **kwargs):
+    """Новая подписка попадает в set'ы подписок и подписчиков и в счетчики после сохранения транзакции"""
+    if created:
+        transaction.on_commit(lambda: SocialGraph().follow(instance.user_from_id, instance.user_to_id))
+        transaction.on_commit(lambda: change_stats({instance.user_from_id: {'followings_count': 1},
+                                                    instance.user_to_id: {'followers_count': 1}}))
+
+
+@receiver(post_delete, sender=Follow)
+def remove_follow_from_graph(sender, instance, **kwargs):
+    """
+    Подписка удаляется и при отписке, и каскадно вместе с пользователем -
+    в обоих случаях убираем ее из set'ов и счетчиков, а не ждем их истечения и сверки
+    """
+    transaction.on_commit(lambda: SocialGraph().unfollow(instance.user_from_id, instance.user_to_id))
+    transaction.on_commit(lambda: change_stats({instance.user_from_id: {'followings_count': -1},
+                                                instance.user_to_id: {'followers_count': -1}}))
@@ -0,0 +1,86 @@
+from collections import defaultdict
+
+from django.db.models import Count, F, Sum
+
+from image.models import Image
+from user.models import CustomUser, Follow, ProfileStats
+
+STATS_FIELDS = ('total_views', 'total_likes', 'followers_count', 'followings_count', 'images_count')
+
+
+def get_stats(user):
+    """Счетчики пользователя; если их еще нет - считаются по БД"""
+    try:
+        return user.stats
+    except ProfileStats.DoesNotExist:
+        # Запоминаем в кеше связи, чтобы следующее обращение не пересчитывало снова
+        user.stats = rebuild_stats([user.id])[user.id]
+        return user.stats
+
+
+def change_stats(deltas):
+    """
+    Прибавляет изменения к счетчикам: deltas - {id пользователя: {поле: изменение}}.
+    Для пользователей без строки счетчиков она создается по БД, где изменения уже учтены
+    """
+    deltas = {user_id: changes for user_id, changes in deltas.items() if any(changes.values())}
+    if not deltas:
+        return
+    existing = set(ProfileStats.objects.filter(user_id__in=list(deltas)).values_list('user_id', flat=True))
+    missing = deltas.keys() - existing
+    if missing:
+        # Пользователь мог быть удален вместе с подписками - его счетчики не создаем
+        rebuild_stats(CustomUser.objects.filter(id__in=missing).values_list('id', flat=True))
+
+    fields = sorted({field for changes in deltas.values() for field in changes})
+    ProfileStats.objects.bulk_update([
+        ProfileStats(user_id=user_id, **{field: F(field) + changes.get(field, 0) for field in fields})
+        for user_id, changes in deltas.items() if user_id in existing
+    ], fields)
+
+
+def change_owner_stats(field, deltas):
+    """Прибавляет к счетчику field владельцев изображений deltas - {id изображения: изменение}"""
+    owners = dict(Image.objects.filter(id__in=list(deltas)).values_list('id', 'owner_id'))
+    owner_deltas = defaultdict(lambda: {field: 0})
+    for image_id, delta in deltas.items():
+        if image_id in owners:
+            owner_deltas[owners[image_id]][field] += delta
+    change_stats(owner_deltas)
+
+
+def rebuild_stats(user_ids):
+    """Пересчитывает счетчики пользователей по БД и сохраняет их"""
+    user_ids = list(user_ids)
+    stats = {user_id: ProfileStats(user_id=user_id) for user_id in user_ids}
+
+    images = Image.objects.filter(owner_id__in=user_ids).order_by().values('owner_id') \
+        .annotate(views=Sum('views'), likes=Sum('total_likes'), count=Count('id'))
+    for row in images:
+        user_stats = stats[row['owner_id']]
+        user_stats.total_views, user_stats.total_likes, user_stats.images_count = \
+            row['views'], row['likes'], row['count']
+
+    for user_field, stats_field in (('user_to_id', 'followers_count'), ('user_from_id', 'followings_count')):
+        counts = Follow.objects.filter(**{f'{user_field}__in': user_ids}).order_by() \
+            .values_list(user_field).annotate(count=Count('id'))
+        for user_id, count in counts:
+            setattr(stats[user_id], stats_field, count)
+
+    ProfileStats.objects.bulk_create(stats.values(), update_conflicts=True,
+                                     unique_fields=['user'], update_fields=STATS_FIELDS)
+    return stats
+
+
+def reconcile_stats(batch_size=1000):
+    """Сверяет счетчики всех пользователей с БД, пачками по id"""
+    total = 0
+    last_id = 0
+    while True:
+        user_ids = list(CustomUser.objects.filter(id__gt=last_id).order_by('id')
+                        .values_list('id', flat=True)[:batch_size])
+        if not user_ids:
+            return total
+        rebuild_stats(user_ids)
+        last_id = user_ids[-1]
+        total += len(user_ids)
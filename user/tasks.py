@@ -0,0 +1,10 @@
+from celery import shared_task
+
+from .stats import reconcile_stats
+
+
+@shared_task
+def reconcile_profile_stats():
+    """Сверяет счетчики профилей с БД, исправляя расхождения инкрементальных обновлений"""
+    reconciled = reconcile_stats()
+    return f"Счетчики профилей сверены, пользователей: {reconciled}"
@@ -1,3 +1,95 @@
 from django.test import TestCase
 
-# Create your tests here.
+from image.tests import RedisTestCase
+from .graph import SocialGraph
+from .models import CustomUser, Follow, ProfileStats
+from .stats import get_stats
+
+
+class ProfileStatsTest(TestCase):
+
+    def test_missing_stats_are_rebuilt_once(self):
+        user = CustomUser.objects.create_user(username='user', email='user@example.com', password='pass')
+        ProfileStats.objects.filter(user=user).delete()
+        user = CustomUser.objects.get(id=user.id)
+
+        self.assertEqual(get_stats(user).followers_count, 0)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_stats(user).images_count, 0)
+        self.assertTrue(ProfileStats.objects.filter(user=user).exists())
+
+
+class SocialGraphTest(RedisTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.first, self.second, self.third = [
+            CustomUser.objects.create_user(username=f'user{number}', email=f'user{number}@example.com',
+                                           password='pass')
+            for number in range(3)
+        ]
+
+    def follow(self, user_from, user_to):
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.create(user_from=user_from, user_to=user_to)
+
+    def test_mutual_follow(self):
+        graph = SocialGraph()
+        self.follow(self.first, self.second)
+        self.assertFalse(graph.is_mutual(self.first.id, self.second.id))
+
+        self.follow(self.second, self.first)
+        self.assertTrue(graph.is_mutual(self.second.id, self.first.id))
+        # Set'ы загружены - дальше проверка без запросов к БД
+        with self.assertNumQueries(0):
+            self.assertTrue(graph.is_mutual(self.first.id, self.second.id))
+
+    def test_cascade_deletion_updates_sets(self):
+        graph = SocialGraph()
+        self.follow(self.first, self.second)
+        self.follow(self.third, self.second)
+        # Загружаем set'ы второго пользователя
+        self.assertFalse(graph.is_mutual(self.second.id, self.third.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.third.delete()
+        self.assertEqual(self.redis.smembers(graph.get_followers_key(self.second.id)),
+                         {b'0', str(self.first.id).encode()})
+
+
+class FollowStatsTest(RedisTestCase):
+    """Счетчики подписок меняются сигналами Follow - и из view, и при каскадном удалении"""
+
+    def setUp(self):
+        super().setUp()
+        self.first, self.second, self.third = [
+            CustomUser.objects.create_user(username=f'user{number}', email=f'user{number}@example.com',
+                                           password='pass')
+            for number in range(3)
+        ]
+
+    def counts(self, user):
+        stats = ProfileStats.objects.get(user=user)
+        return stats.followers_count, stats.followings_count
+
+    def test_follow_and_unfollow_change_counters(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.create(user_from=self.first, user_to=self.second)
+        self.assertEqual(self.counts(self.first), (0, 1))
+        self.assertEqual(self.counts(self.second), (1, 0))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.filter(user_from=self.first).delete()
+        self.assertEqual(self.counts(self.first), (0, 0))
+        self.assertEqual(self.counts(self.second), (0, 0))
+
+    def test_user_deletion_updates_counters_of_others(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.create(user_from=self.first, user_to=self.second)
+            Follow.objects.create(user_from=self.second, user_to=self.third)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.second.delete()
+        self.assertEqual(self.counts(self.first), (0, 0))
+        self.assertEqual(self.counts(self.third), (0, 0))
+        self.assertFalse(ProfileStats.objects.filter(user_id=self.second.id).exists())
@@ -1,4 +1,3 @@
-from django.db.models import Q
 from django.shortcuts import get_object_or_404
 from rest_framework import status
 from rest_framework.exceptions import NotFound, ValidationError
@@ -8,13 +7,14 @@ from rest_framework.mixins import ListModelMixin, RetrieveModelMixin, UpdateMode
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated
 from rest_framework.viewsets import GenericViewSet
 from action.utils import create_action
-from image.count_views import CountViewsImage
 from image.tasks import generate_thumbnail
+from .graph import SocialGraph
 from .models import CustomUser, Follow
 from .permissions import IsSelfOrReadOnly, IsSelf
 from .serializers import CustomUserSerializer, CustomDetailUserSerializer
 from image.models import Comment, Image
 from image.serializers import CommentSerializer, ImageSerializer
+from pinterest.pagination import KeysetPagination
 from rest_framework.filters import SearchFilter, OrderingFilter
 
 class UserViewSet(ListModelMixin,
@@ -33,21 +33,6 @@ class UserViewSet(ListModelMixin,
             return CustomDetailUserSerializer
         return CustomUserSerializer
 
-    def retrieve(self, request, *args, **kwargs):
-        # Получаем пользователя
-        user = self.get_object()
-        count = CountViewsImage()
-        # Получаем количество просмотров всех изображений пользователя
-        images_views = 0
-        images = user.images.all()
-        for image in images:
-            images_views += int(count.get(image.id))
-
-        # Передаем общее количество просмотров в контексте сериализатора
-        serializer = self.get_serializer(user, context={'request': request,
-                                                        'images_views': images_views})
-        return Response(serializer.data)
-
     def perform_update(self, serializer):
         instance = serializer.save()
         generate_thumbnail.delay(instance.photo.name)
@@ -85,25 +70,34 @@ class UserViewSet(ListModelMixin,
 
         return self._serialize_comments(request, comments)
 
+    @action(methods=['get'],
+            detail=True)
+    def images(self, request, pk=None):
+        """Изображения пользователя с keyset-пагинацией"""
+        target_user = get_object_or_404(CustomUser, id=pk)
+        images = target_user.images.select_related('owner', 'category').prefetch_related('tags')
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(images, request, view=self)
+        serializer = ImageSerializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
+
     @action(methods=['get'],
             detail=True,
             permission_classes=[IsAuthenticated])
     def followings(self, request, pk=None):
-        """Возвращает список на кого подписан пользователь"""
+        """Возвращает список на кого подписан пользователь с keyset-пагинацией"""
         target_user = get_object_or_404(CustomUser, id=pk)
-        followings = target_user.following.all()
-        serializer = CustomUserSerializer(followings, many=True, context={'request': request})
-        return Response(serializer.data)
+        follows = Follow.objects.filter(user_from=target_user).select_related('user_to')
+        return self._paginate_follows(request, follows, 'user_to')
 
     @action(methods=['get'],
             detail=True,
             permission_classes=[IsAuthenticated])
     def followers(self, request, pk=None):
-        """Возвращает список подписчиков"""
+        """Возвращает список подписчиков с keyset-пагинацией"""
         target_user = get_object_or_404(CustomUser, id=pk)
-        followers = target_user.followers.all()
-        serializer = CustomUserSerializer(followers, many=True, context={'request': request})
-        return Response(serializer.data)
+        follows = Follow.objects.filter(user_to=target_user).select_related('user_from')
+        return self._paginate_follows(request, follows, 'user_from')
 
     @action(methods=['get'],
             detail=True,
@@ -132,10 +126,15 @@ class UserViewSet(ListModelMixin,
 
     def _is_mutual_follow(self, user1, user2):
         """Проверяет, подписаны ли пользователи друг на друга"""
-        return Follow.objects.filter(
-                    Q(user_from=user1, user_to=user2)|
-                    Q(user_from=user2, user_to=user1)
-                ).count() == 2
+        return SocialGraph().is_mutual(user1.id, user2.id)
+
+    def _paginate_follows(self, request, follows, user_field):
+        """Страница подписок по дате подписки, отдает пользователей из поля user_field"""
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(follows, request, view=self)
+        users = [getattr(follow, user_field) for follow in page]
+        serializer = CustomUserSerializer(users, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
 
     def _serialize_comments(self, request, comments):
         serializer = CommentSerializer(comments, many=True, context={'request': request}, include_image_url=True)